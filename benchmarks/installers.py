@@ -0,0 +1,100 @@
+"""
+compare the python installer engines by bundling the same requirements with each.
+
+    python benchmarks/installers.py [-r 3.11] [--rounds 3] [requirements.txt]
+
+The first round of an engine is cold: the build image may be pulled, uv is installed into
+its derived image and the uv cache is empty. Later rounds are warm. The layouts of the
+layers built by each engine are compared, ignoring the installer metadata in dist-info.
+"""
+
+from pathlib import Path
+import argparse
+import statistics
+import tempfile
+import shutil
+import time
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from layermake.api import build_python_layer  # noqa: E402
+from layermake.diff import read_entries  # noqa: E402
+from layermake.installers import INSTALLERS  # noqa: E402
+
+_DEFAULT_MANIFEST = (
+    Path(__file__).resolve().parent.parent
+    / "test-manifests"
+    / "python"
+    / "requirements.txt"
+)
+
+# written differently by every installer
+_INSTALLER_METADATA = {"INSTALLER", "RECORD", "REQUESTED", "direct_url.json"}
+
+
+def layout(zip_path: Path):
+    with open(zip_path, "rb") as f:
+        names = set(read_entries(f))
+    return {
+        n
+        for n in names
+        if not (".dist-info/" in n and n.rsplit("/", 1)[-1] in _INSTALLER_METADATA)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("manifest", nargs="?", default=str(_DEFAULT_MANIFEST))
+    parser.add_argument("-r", "--runtime", default="3.11")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--installer",
+        action="append",
+        choices=list(INSTALLERS),
+        help="engines to compare, defaults to all",
+    )
+    args = parser.parse_args()
+
+    layouts = {}
+    for name in args.installer or list(INSTALLERS):
+        times = []
+        for n in range(args.rounds):
+            output = Path(tempfile.mkdtemp(prefix="layermake-bench-"))
+            try:
+                start = time.perf_counter()
+                build = build_python_layer(
+                    str(output),
+                    runtime=args.runtime,
+                    manifest=args.manifest,
+                    installer=name,
+                )
+                times.append(time.perf_counter() - start)
+                layouts[name] = layout(build.paths[0])
+            finally:
+                shutil.rmtree(output, ignore_errors=True)
+            print(f"{name} round {n + 1}: {times[-1]:.1f}s", flush=True)
+
+        warm = (
+            f", warm median {statistics.median(times[1:]):.1f}s"
+            if len(times) > 1
+            else ""
+        )
+        print(f"{name}: cold {times[0]:.1f}s{warm}")
+
+    reference, *others = list(layouts)
+    for name in others:
+        missing = layouts[reference] - layouts[name]
+        extra = layouts[name] - layouts[reference]
+        if missing or extra:
+            print(f"{name} layout differs from {reference}:")
+            for n in sorted(missing):
+                print(f"  - {n}")
+            for n in sorted(extra):
+                print(f"  + {n}")
+        else:
+            print(f"{name} layout matches {reference} ({len(layouts[name])} entries)")
+
+
+if __name__ == "__main__":
+    main()
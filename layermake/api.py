@@ -0,0 +1,315 @@
+from typing import Callable, Dict, List, NamedTuple, Optional, Type
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+import contextvars
+import asyncio
+from .bundler import Bundler
+from .python import PythonBundler
+from .node import NodeBundler
+from .binary import BinaryBundler
+from .publisher import LayerPublisher
+from .elf import LAMBDA_RUNTIME_IMAGE
+from .ccache import DEFAULT_CCACHE_SIZE
+from .runtimes import BINARY_RUNTIMES
+from .errors import LayermakeError, BuildError, PublishError
+from .logger import Logger, use_logger
+
+_MB = 1024 * 1024
+
+
+class LayerBuild(NamedTuple):
+    """
+    a bundled layer that is ready to be published
+    """
+
+    layer_type: str
+    # the layer zip, the zips of a split layer in the order they should be attached,
+    # or the output dir when the layer was not zipped
+    paths: List[Path]
+    runtimes: List[str]
+    zipped: bool = True
+
+
+class PublishedLayer(NamedTuple):
+    """
+    a layer version published to one or more regions
+    """
+
+    name: str
+    # the layer version ARN by region
+    arns: Dict[str, str]
+
+
+@contextmanager
+def _library_call(log: Optional[Logger], error: Type[LayermakeError]):
+    with use_logger(log or Logger(quiet=True), raise_errors=True):
+        try:
+            yield
+        except error:
+            raise
+        except Exception as e:
+            raise error(str(e)) from e
+
+
+def _bundle(
+    bundler: Bundler,
+    layer_type: str,
+    runtimes: List[str],
+    split_size_mb: Optional[int],
+    split_total_mb: Optional[int],
+) -> LayerBuild:
+    if split_size_mb:
+        paths = bundler.bundle_parts(
+            max_part_size=split_size_mb * _MB,
+            max_total_size=split_total_mb * _MB if split_total_mb else None,
+        )
+    else:
+        paths = [bundler.bundle()]
+    return LayerBuild(layer_type, paths, runtimes, zipped=not bundler.no_zip)
+
+
+def build_python_layer(
+    output: str,
+    runtime: str = "3.11",
+    packages: List[str] = None,
+    manifest: str = None,
+    artifact_dir: str = None,
+    container: str = None,
+    staging_dir: str = None,
+    native: bool = False,
+    arch: str = "x86_64",
+    installer: str = "pip",
+    export: bool = False,
+    profile_resources: bool = False,
+    exclude_provided: bool = True,
+    no_zip: bool = False,
+    split_size_mb: int = None,
+    split_total_mb: int = None,
+    logger: Logger = None,
+) -> LayerBuild:
+    """
+    bundle a python layer, see the python command for the options
+    :param output: The directory that receives the layer.
+    :param split_size_mb: Split the layer into parts of at most this many MB.
+    :param logger: Logs the build, defaults to a quiet logger.
+    :raises BuildError: When bundling fails.
+    """
+    runtime = runtime.replace("python", "")
+    with _library_call(logger, BuildError):
+        bundler = PythonBundler(
+            runtime=runtime,
+            local_dir=output,
+            packages=packages,
+            manifest=manifest,
+            artifact_dir=artifact_dir,
+            container=container,
+            staging_dir=staging_dir,
+            native=native,
+            arch=arch,
+            installer=installer,
+            export=export,
+            profile_resources=profile_resources,
+            exclude_provided=exclude_provided,
+            no_zip=no_zip,
+        )
+        return _bundle(
+            bundler, "python", [f"python{runtime}"], split_size_mb, split_total_mb
+        )
+
+
+def build_node_layer(
+    output: str,
+    runtime: str = "18.x",
+    packages: List[str] = None,
+    manifest: str = None,
+    artifact_dir: str = None,
+    container: str = None,
+    staging_dir: str = None,
+    dev_dependencies: bool = False,
+    prune: bool = True,
+    prune_globs: List[str] = None,
+    prune_keep: List[str] = None,
+    export: bool = False,
+    profile_resources: bool = False,
+    exclude_provided: bool = True,
+    no_zip: bool = False,
+    split_size_mb: int = None,
+    split_total_mb: int = None,
+    logger: Logger = None,
+) -> LayerBuild:
+    """
+    bundle a nodejs layer, see the nodejs command for the options
+    :param output: The directory that receives the layer.
+    :param split_size_mb: Split the layer into parts of at most this many MB.
+    :param logger: Logs the build, defaults to a quiet logger.
+    :raises BuildError: When bundling fails.
+    """
+    runtime = runtime.replace("nodejs", "")
+    if "." not in runtime:
+        runtime = runtime + ".x"
+    with _library_call(logger, BuildError):
+        bundler = NodeBundler(
+            runtime=runtime,
+            local_dir=output,
+            packages=packages,
+            manifest=manifest,
+            artifact_dir=artifact_dir,
+            container=container,
+            staging_dir=staging_dir,
+            dev_dependencies=dev_dependencies,
+            prune=prune,
+            prune_globs=prune_globs,
+            prune_keep=prune_keep,
+            export=export,
+            profile_resources=profile_resources,
+            exclude_provided=exclude_provided,
+            no_zip=no_zip,
+        )
+        return _bundle(
+            bundler, "nodejs", [f"nodejs{runtime}"], split_size_mb, split_total_mb
+        )
+
+
+def build_binary_layer(
+    artifact: str,
+    output: str,
+    runtimes: List[str] = None,
+    dockerfile: str = None,
+    base_image: str = "amazonlinux:latest",
+    build_cmd: str = None,
+    packages: List[str] = None,
+    workdir: str = "/opt",
+    staging_dir: str = None,
+    strip: bool = False,
+    dedup_libs: bool = False,
+    collect_libs: List[str] = None,
+    runtime_image: str = LAMBDA_RUNTIME_IMAGE,
+    jobs: int = None,
+    cpus: float = None,
+    memory: str = None,
+    ccache: bool = False,
+    ccache_dir: str = None,
+    ccache_size: str = DEFAULT_CCACHE_SIZE,
+    export: bool = False,
+    profile_resources: bool = False,
+    no_zip: bool = False,
+    logger: Logger = None,
+) -> LayerBuild:
+    """
+    bundle a binary layer, see the binary command for the options
+    :param artifact: The build script or a directory containing one.
+    :param output: The directory that receives the layer.
+    :param runtimes: The compatible runtimes, defaults to all.
+    :param logger: Logs the build, defaults to a quiet logger.
+    :raises BuildError: When bundling fails.
+    """
+    with _library_call(logger, BuildError):
+        bundler = BinaryBundler(
+            build_artifact=artifact,
+            local_dir=output,
+            dockerfile=dockerfile,
+            base_image=base_image,
+            build_cmd=build_cmd,
+            yum_packages=packages,
+            workdir=workdir,
+            staging_dir=staging_dir,
+            strip=strip,
+            dedup_libs=dedup_libs,
+            collect_libs=collect_libs,
+            runtime_image=runtime_image,
+            jobs=jobs,
+            cpus=cpus,
+            memory=memory,
+            ccache=ccache,
+            ccache_dir=ccache_dir,
+            ccache_size=ccache_size,
+            export=export,
+            profile_resources=profile_resources,
+            no_zip=no_zip,
+        )
+        return _bundle(bundler, "binary", list(runtimes or BINARY_RUNTIMES), None, None)
+
+
+def publish(
+    build: LayerBuild,
+    name: str,
+    regions: List[str] = None,
+    description: str = None,
+    license_text: str = None,
+    license_file: str = None,
+    arch: List[str] = None,
+    profile: str = None,
+    s3_bucket: str = None,
+    endpoint_url: str = None,
+    logger: Logger = None,
+) -> List[PublishedLayer]:
+    """
+    publish a bundled layer, see the common command options
+    :param build: The layer returned by one of the build functions.
+    :param name: The layer name, the parts of a split layer are named <name>-<n>.
+    :param regions: The regions to publish to, defaults to the session's region.
+    :param logger: Logs publishing, defaults to a quiet logger.
+    :return: The published layer, or each published part in the order they should be attached.
+    :raises PublishError: When publishing fails in any region.
+    """
+    with _library_call(logger, PublishError):
+        if not build.zipped:
+            raise PublishError("a layer that was not zipped cannot be published")
+        publisher = LayerPublisher(
+            name=name,
+            license_text=license_text,
+            license_file=license_file,
+            description=description,
+            profile=profile,
+            arch=arch,
+            regions=regions,
+            s3_bucket=s3_bucket,
+            endpoint_url=endpoint_url,
+        )
+        publisher.runtimes = build.runtimes
+        if len(build.paths) == 1:
+            arns = publisher.publish_layer(build.paths[0], build.layer_type)
+            return [PublishedLayer(name, arns)]
+        return [
+            PublishedLayer(f"{name}-{n + 1}", arns)
+            for n, arns in enumerate(
+                publisher.publish_layers(build.paths, build.layer_type)
+            )
+        ]
+
+
+async def _run_async(fn: Callable, *args, **kwargs):
+    # the worker thread runs in a copy of the caller's context
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        None, partial(ctx.run, fn, *args, **kwargs)
+    )
+
+
+async def build_python_layer_async(*args, **kwargs) -> LayerBuild:
+    """
+    build_python_layer in a worker thread
+    """
+    return await _run_async(build_python_layer, *args, **kwargs)
+
+
+async def build_node_layer_async(*args, **kwargs) -> LayerBuild:
+    """
+    build_node_layer in a worker thread
+    """
+    return await _run_async(build_node_layer, *args, **kwargs)
+
+
+async def build_binary_layer_async(*args, **kwargs) -> LayerBuild:
+    """
+    build_binary_layer in a worker thread
+    """
+    return await _run_async(build_binary_layer, *args, **kwargs)
+
+
+async def publish_async(*args, **kwargs) -> List[PublishedLayer]:
+    """
+    publish in a worker thread
+    """
+    return await _run_async(publish, *args, **kwargs)
@@ -0,0 +1,113 @@
+from typing import BinaryIO, Callable, Dict, Iterable
+from pathlib import Path
+import tempfile
+import tarfile
+import zipfile
+import shutil
+import stat
+import time
+
+# bytes copied at a time from the tar stream into the zip
+_CHUNK_SIZE = 1024 * 1024
+
+# zip timestamps cannot be older than 1980
+_MIN_ZIP_TIME = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))
+
+
+def zip_files(root: Path, files: Iterable[Path], zip_path: Path) -> Path:
+    """
+    Write files into a zip archive with paths relative to root.
+    Symlinks are followed like the zip command does by default.
+    :param root: The directory entry names are relative to.
+    :param files: The files to add.
+    :param zip_path: The archive to create.
+    """
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for f in sorted(files):
+            if not f.is_file():
+                # dangling symlinks and symlinked dirs are skipped
+                continue
+            zf.write(f, f.relative_to(root).as_posix())
+    return zip_path
+
+
+def _zip_info(member: tarfile.TarInfo, name: str, file_type: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, time.localtime(max(member.mtime, _MIN_ZIP_TIME))[:6])
+    info.external_attr = (file_type | stat.S_IMODE(member.mode)) << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def zip_tar_stream(
+    stream: BinaryIO,
+    zip_path: Path,
+    symlinks: bool = False,
+    include: Callable[[str, int], bool] = None,
+    extract: Callable[[str], bool] = None,
+    extract_dir: Path = None,
+) -> int:
+    """
+    Convert a tar stream into a zip archive in a single pass with bounded memory.
+    Directories are implied by the file names like in zip_files.
+    :param stream: The tar stream, e.g. the output of docker cp.
+    :param zip_path: The archive to create.
+    :param symlinks: Store symlinks as links, otherwise they are skipped.
+    :param include: Whether a file, given by its name and size, is added to the zip.
+    :param extract: Whether a file is written below extract_dir instead of the zip.
+    :param extract_dir: Receives the extracted files.
+    :return: The number of files added to the zip.
+    """
+    count = 0
+    # the first member of each hard linked inode, later links copy its content
+    written: Dict[str, zipfile.ZipInfo] = {}
+    links = []
+    with tarfile.open(fileobj=stream, mode="r|") as tar, zipfile.ZipFile(
+        zip_path, "w", compression=zipfile.ZIP_DEFLATED
+    ) as zf:
+        for member in tar:
+            name = member.name
+            while name.startswith("./"):
+                name = name[2:]
+            if not name or name == "." or member.isdir():
+                continue
+
+            if extract and extract(name):
+                if member.isfile():
+                    target = extract_dir / name
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    with tar.extractfile(member) as src, open(target, "wb") as dst:
+                        shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+                continue
+
+            if include and not include(name, member.size):
+                continue
+
+            if member.issym():
+                if symlinks:
+                    zf.writestr(_zip_info(member, name, stat.S_IFLNK), member.linkname)
+                    count += 1
+            elif member.islnk():
+                links.append((member, name))
+            elif member.isfile():
+                info = _zip_info(member, name, stat.S_IFREG)
+                info.file_size = member.size
+                with tar.extractfile(member) as src, zf.open(info, "w") as dst:
+                    shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+                written[member.name] = info
+                count += 1
+
+        # a zip cannot be read while it is written, link targets are spooled
+        for member, name in links:
+            target = written.get(member.linkname)
+            if not target:
+                continue
+            with tempfile.SpooledTemporaryFile(_CHUNK_SIZE) as spool:
+                with zf.open(target) as src:
+                    shutil.copyfileobj(src, spool, _CHUNK_SIZE)
+                spool.seek(0)
+                info = _zip_info(member, name, stat.S_IFREG)
+                info.file_size = target.file_size
+                with zf.open(info, "w") as dst:
+                    shutil.copyfileobj(spool, dst, _CHUNK_SIZE)
+            count += 1
+    return count
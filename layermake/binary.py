@@ -1,15 +1,37 @@
 from typing import List, Set
 from pathlib import Path
-import uuid
+import shlex
+import math
+import os
 from .cmd import docker_build
 from .bundler import Bundler
+from .ccache import (
+    CONTAINER_CCACHE_DIR,
+    DEFAULT_CCACHE_SIZE,
+    DOCKERFILE as CCACHE_DOCKERFILE,
+    default_ccache_dir,
+    stats_cmd,
+    read_stats,
+    log_stats,
+)
+from .elf import (
+    COLLECT_LIBS_SCRIPT,
+    LAMBDA_RUNTIME_IMAGE,
+    OPTIMIZE_SCRIPT,
+    runtime_libraries,
+    log_collected,
+    read_report,
+    log_savings,
+)
 from .logger import logger
 
 # list of filenames to look for when provided a directory instead of a file as a build artifact
 _build_filenames = ["build", "install", "layer", "build-layer"]
 
 # include .sh extensions
-DIR_BUILD_FILENAMES = _build_filenames.extend([f"{x}.sh" for x in _build_filenames])
+DIR_BUILD_FILENAMES = _build_filenames + [f"{x}.sh" for x in _build_filenames]
+
+_MAKEFILE_NAMES = ["Makefile", "makefile", "GNUmakefile"]
 
 
 class BinaryBundler(Bundler):
@@ -29,44 +51,112 @@ class BinaryBundler(Bundler):
         workdir: str = "/opt",
         container_output_dir: str = "/opt",
         no_zip: bool = False,
+        staging_dir: str = None,
+        strip: bool = False,
+        dedup_libs: bool = False,
+        collect_libs: List[str] = None,
+        runtime_image: str = LAMBDA_RUNTIME_IMAGE,
+        jobs: int = None,
+        cpus: float = None,
+        memory: str = None,
+        ccache: bool = False,
+        ccache_dir: str = None,
+        ccache_size: str = DEFAULT_CCACHE_SIZE,
+        export: bool = False,
+        profile_resources: bool = False,
     ):
+        """
+        :param strip: Strip debug sections from ELF files after the build.
+        :param dedup_libs: Replace byte-identical shared libraries with symlinks to one copy.
+        :param collect_libs: Executables, libraries or directories below the output dir whose
+            shared library dependencies are copied into lib/ after the build.
+        :param runtime_image: The lambda base image whose libraries are not collected.
+        :param jobs: Parallel compile jobs, defaults to the CPUs available to the container.
+        :param cpus: Limits the CPUs the build container may use.
+        :param memory: Limits the memory the build container may use, e.g. 4g.
+        :param ccache: Compile through ccache with a cache dir that persists between builds.
+        :param ccache_dir: The host directory ccache stores its cache in.
+        :param ccache_size: The size limit of the ccache dir, e.g. 5G.
+        :param export: Build in the container's filesystem and stream the layer out.
+        :param profile_resources: Sample the resource usage of the build container.
+        """
         super(BinaryBundler, self).__init__(
             workdir=workdir,
             local_dir=local_dir,
             build_artifact=build_artifact,
+            container_output_dir=container_output_dir,
             no_zip=no_zip,
+            staging_dir=staging_dir,
+            cpus=cpus,
+            memory=memory,
+            export=export,
+            profile_resources=profile_resources,
+        )
+        if not jobs:
+            jobs = os.cpu_count() or 1
+            if cpus:
+                jobs = max(1, min(jobs, math.ceil(cpus)))
+        logger().debug(f"building with {jobs} parallel jobs")
+        # picked up by make, cmake --build and numpy.distutils based builds
+        self._container_env.update(
+            MAKEFLAGS=f"-j{jobs}",
+            CMAKE_BUILD_PARALLEL_LEVEL=str(jobs),
+            NPY_NUM_BUILD_JOBS=str(jobs),
         )
-        self.__yum_packages = set(yum_packages)
+        self.__ccache = ccache
+        self.__ccache_size = ccache_size
+        if ccache:
+            host_dir = Path(ccache_dir) if ccache_dir else default_ccache_dir()
+            host_dir.mkdir(parents=True, exist_ok=True)
+            logger().debug(f"using ccache dir {host_dir}")
+            self._container_volumes.append(
+                f"{host_dir.absolute()}:{CONTAINER_CCACHE_DIR}"
+            )
+            self._container_env["CCACHE_MAXSIZE"] = ccache_size
+        self.__yum_packages = set(yum_packages or [])
         self.__yum_packages.add("gzip")
         self.__dockerfile = dockerfile
+        self.__build_ctx = "."
         self.__base_image = base_image
+        self.__workdir = workdir
         self.__container_output_dir = container_output_dir
+        self.__strip = strip
+        self.__dedup_libs = dedup_libs
+        self.__collect_libs = list(collect_libs or [])
+        self.__runtime_image = runtime_image
+        # duplicate libraries are only smaller in the zip when their links are kept
+        self._zip_symlinks = dedup_libs
         if build_cmd:
-            self.__container_cmd = build_cmd
+            self._container_cmd = build_cmd
             return
 
+        build_artifact_path = Path(build_artifact)
         with logger().status("searching for build command..."):
-            if self.__build_artifact_path.is_dir():
-                for p in self.__build_artifact_path.iterdir():
-                    if p.name == "make":
+            if build_artifact_path.is_dir():
+                for p in build_artifact_path.iterdir():
+                    if p.name in _MAKEFILE_NAMES:
                         # if makefile was found, use it
-                        self.__container_cmd = "make install"
+                        self._container_cmd = "make install"
                         logger().info(f"found make file: {p}")
                         break
                     if p.name in DIR_BUILD_FILENAMES:
-                        self.__container_cmd = f"chmod +x ./{p.name} " f"&& ./{p.name}"
+                        self._container_cmd = f"chmod +x ./{p.name} " f"&& ./{p.name}"
                         logger().info(f"found build script: {p}")
                         break
 
-                if not self.__container_cmd:
+                if not self._container_cmd:
                     logger().fatal_error("no valid build file exists in artifact dir")
                 return
 
-            self.__container_cmd = (
-                f"chmod +x ./{self.__build_artifact_path.name} "
-                f"&& ./{self.__build_artifact_path.name}"
+            self._container_cmd = (
+                f"chmod +x ./{build_artifact_path.name} "
+                f"&& ./{build_artifact_path.name}"
             )
-            logger().debug(f"container command will be {self.__container_cmd}")
+            logger().debug(f"container command will be {self._container_cmd}")
+
+    @property
+    def __state_dir(self) -> Path:
+        return self._local_path / ".layermake"
 
     def pre_bundle(self):
         if not self.__dockerfile:
@@ -75,31 +165,81 @@ class BinaryBundler(Bundler):
                     base_image=self.__base_image,
                     workdir=self.__workdir,
                     packages=self.__yum_packages,
+                    ccache=self.__ccache,
                 )
                 logger().debug(f"compiled dockerfile contents:\n {dockerfile_contents}")
-                dockerfile_path = Path(".") / f".tmp-dockerfile-{uuid.uuid4()}"
+                # the workspace is private to this build and deleted with it
+                self.__prep_state_dir()
+                dockerfile_path = self.__state_dir / "Dockerfile"
                 self.__dockerfile = str(dockerfile_path.absolute())
+                # nothing is copied from the build context of a compiled Dockerfile
+                self.__build_ctx = str(self.__state_dir.absolute())
                 try:
                     with open(self.__dockerfile, "w") as f:
                         f.write(dockerfile_contents)
                 except Exception as e:
                     logger().fatal_error(f"Failed to compile Dockerfile: {str(e)}")
-                self.add_cleanup_path(dockerfile_path)
                 logger().success(f"compiled dockerfile saved to {dockerfile_path}")
 
         with logger().status(
             f"building container with Dockerfile: {self.__dockerfile}..."
         ):
-            build_result = docker_build(self.__dockerfile)
-            container_hash = build_result.stdout.decode("utf-8").strip("\n")
+            container_hash = docker_build(self.__dockerfile, self.__build_ctx).strip()
             self._container = container_hash
             logger().success(f"container built successfully: {container_hash}")
 
+        state = f"{self.__container_output_dir}/.layermake"
+        if self.__ccache:
+            # counters before and after the build give this build's hits and misses
+            self.__prep_state_dir()
+            self._container_cmd = (
+                f"{stats_cmd(f'{state}/ccache-before')} && {self._container_cmd} "
+                f"&& {stats_cmd(f'{state}/ccache-after')}"
+            )
+
+        if self.__collect_libs:
+            self.__prep_state_dir()
+            (self.__state_dir / "runtime-libs").write_text(
+                "\n".join(runtime_libraries(self.__runtime_image)) + "\n"
+            )
+            (self.__state_dir / "collect-libs.sh").write_text(COLLECT_LIBS_SCRIPT)
+            targets = " ".join(shlex.quote(t) for t in self.__collect_libs)
+            self._container_cmd += f" && bash {state}/collect-libs.sh {self.__container_output_dir} {targets}"
+
+        # collected libraries are stripped and deduplicated too
+        if self.__strip or self.__dedup_libs:
+            self.__prep_state_dir()
+            (self.__state_dir / "optimize.sh").write_text(OPTIMIZE_SCRIPT)
+            self._container_cmd += (
+                f" && STRIP={int(self.__strip)} DEDUP={int(self.__dedup_libs)} "
+                f"bash {state}/optimize.sh {self.__container_output_dir}"
+            )
+
+    def __prep_state_dir(self):
+        if not self.__state_dir.is_dir():
+            self.__state_dir.mkdir(parents=True)
+            self.add_cleanup_path(self.__state_dir)
+
+    def post_bundle(self):
+        if self.__ccache:
+            log_stats(
+                read_stats(self.__state_dir / "ccache-before"),
+                read_stats(self.__state_dir / "ccache-after"),
+                self.__ccache_size,
+            )
+        collected = self.__state_dir / "collected"
+        if collected.is_file():
+            log_collected(collected, self.__state_dir / "excluded")
+        report = self.__state_dir / "optimize-report"
+        if report.is_file():
+            log_savings(read_report(report))
+
     @staticmethod
     def compile_dockerfile(
         base_image: str = "amazonlinux:latest",
         workdir: str = "/opt",
         packages: Set[str] = None,
+        ccache: bool = False,
     ):
         dockerfile = f"""FROM {base_image}
 ENV OUTPUT_BIN=/opt/bin
@@ -108,6 +248,8 @@ RUN yum -y groupinstall 'Development Tools'
 """
         if packages:
             dockerfile += f"RUN yum -y install {' '.join(packages)}\n"
+        if ccache:
+            dockerfile += CCACHE_DOCKERFILE
 
         dockerfile += f"""
         RUN mkdir -p {workdir}
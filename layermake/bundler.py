@@ -1,8 +1,48 @@
 from pathlib import Path
 from abc import ABC
-from typing import List, Optional
+from typing import ContextManager, Dict, Iterator, List, Optional, Set
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import shutil
+import uuid
 from .logger import logger
-from .cmd import path_copy, docker_run, rmtree
+from .cache import output_lock
+from .cmd import (
+    path_copy,
+    docker_run,
+    docker_cp,
+    docker_cp_stream,
+    docker_container_rm,
+    remove_paths,
+    atomic_move,
+)
+from .archive import zip_files, zip_tar_stream
+from .profiler import (
+    PROFILE_FILENAME,
+    ResourceProfiler,
+    log_summary,
+    summarize,
+    write_profile,
+)
+from .distributions import LayerItem
+from .split import pack_layers, MAX_LAYERS
+
+# the name prefix of the private workspace each build runs in
+WORKSPACE_PREFIX = ".layermake-"
+
+# where the local dir is mounted read-only in export mode
+_EXPORT_INPUT_DIR = "/layermake-input"
+
+# copied out of the container output dir before the layer is streamed in export mode
+EXPORT_METADATA_DIR = ".layermake-metadata"
+
+# replaces symlinks with copies of their targets, which zip -r does implicitly
+_DEREFERENCE_CMD = (
+    "(find {dir} -type l -print0 | while IFS= read -r -d '' l; do"
+    ' [ -e "$l" ] && t="$(readlink -f "$l")" && rm "$l" && cp -a -L "$t" "$l";'
+    " done; true)"
+)
 
 
 class Bundler(ABC):
@@ -15,27 +55,85 @@ class Bundler(ABC):
         build_artifact: str = None,
         container_output_dir: str = None,
         no_zip: bool = False,
+        staging_dir: str = None,
+        cpus: float = None,
+        memory: str = None,
+        export: bool = False,
+        profile_resources: bool = False,
     ):
+        """
+        :param local_dir: The output directory that receives the finished layer.
+            The layer is built in a private workspace inside it, so that concurrent
+            builds with the same output dir do not interfere.
+        :param staging_dir: Optional scratch directory (e.g. tmpfs) to create the
+            workspace in instead. Only the finished artifact is moved into local_dir.
+        :param cpus: Limits the CPUs the build container may use.
+        :param memory: Limits the memory the build container may use, e.g. 4g.
+        :param export: Build in the container's own filesystem and stream the result
+            into the layer zip instead of writing it through a bind mount.
+        :param profile_resources: Sample the CPU, memory, block I/O and network usage
+            of the build container and write them to resource-profile-<container>.json in
+            local_dir.
+        """
         self.__no_zip = no_zip
+        self.__export = export
+        self.__profile_resources = profile_resources
         self._container = container
         self._container_cmd = container_cmd
+        # store symlinks as links when zipping inside the container
+        self._zip_symlinks = False
+        # environment and additional "host:container" volumes of the build container
+        self._container_env: Dict[str, str] = {}
+        self._container_volumes: List[str] = []
+        self.__cpus = cpus
+        self.__memory = memory
         self.__cleanup_paths: List[Path] = []
+        self.__held_locks: Optional[ExitStack] = None
         self.__workdir = workdir
-        self._local_path = Path(local_dir)
+        self._output_path = Path(local_dir)
+        self.__staging_dir = Path(staging_dir) if staging_dir else None
+        # created on first use, so a bundler that fails validation leaves none behind
+        self.__workspace: Optional[Path] = None
         self.__build_artifact_path = Path(build_artifact) if build_artifact else None
-        self.__prep_local(self._local_path, self.__build_artifact_path)
         self.__container_output_dir = (
             container_output_dir if container_output_dir else workdir
         )
 
+    @property
+    def _local_path(self) -> Path:
+        """
+        the private workspace the layer is built in
+        """
+        if self.__workspace is None:
+            workspace_root = self.__staging_dir or self._output_path
+            workspace_root.mkdir(parents=True, exist_ok=True)
+            workspace = Path(
+                tempfile.mkdtemp(prefix=WORKSPACE_PREFIX, dir=workspace_root)
+            ).absolute()
+            if self.__staging_dir:
+                logger().info(f"staging layer in {workspace}")
+            else:
+                logger().debug(f"building layer in {workspace}")
+            self.__workspace = workspace
+            try:
+                self.__prep_local(workspace, self.__build_artifact_path)
+            except BaseException:
+                self._cleanup(background=False)
+                raise
+        return self.__workspace
+
     def __prep_local(self, local_path: Path, build_artifact_path: Optional[Path]):
         local_path.mkdir(parents=True, exist_ok=True)
         if not build_artifact_path:
             return
 
         if build_artifact_path.is_dir():
-            if str(build_artifact_path.resolve()) != str(local_path.resolve()):
-                path_copy(build_artifact_path, local_path)
+            # the artifact dir may contain the workspaces when it is the output dir
+            path_copy(
+                build_artifact_path,
+                local_path,
+                ignore=shutil.ignore_patterns(f"{WORKSPACE_PREFIX}*"),
+            )
         else:
             if str(build_artifact_path.parents[0].resolve()) != str(
                 local_path.resolve()
@@ -43,57 +141,382 @@ class Bundler(ABC):
                 path_copy(build_artifact_path, local_path)
             self.__build_artifact_path = local_path / build_artifact_path.name
 
-    def bundle(self) -> Path:
+    @property
+    def no_zip(self) -> bool:
+        return self.__no_zip
+
+    @property
+    def export(self) -> bool:
+        return self.__export
+
+    def _build(self, zip_layer: bool):
+        if self.__export:
+            return self.__export_build(zip_layer)
+        self.pre_bundle()
+        with logger().status("bundling layer with Docker..."):
+            cmd_str = self._container_cmd
+            if zip_layer:
+                flags = "-r -y" if self._zip_symlinks else "-r"
+                cmd_str += f" && zip {flags} layer.zip *"
+            if self.__container_output_dir != self.__workdir:
+                cmd_str = f"mkdir -p {self.__container_output_dir} && " + cmd_str
+            try:
+                logger().info(
+                    f"starting bundling task with docker container {self._container}"
+                )
+                self.__run_container(
+                    f"{self._local_path.absolute()}:{self.__container_output_dir}",
+                    cmd_str,
+                )
+            except Exception as e:
+                logger().fatal_error(
+                    f"failed bundling layer with docker container {self._container}: {str(e)}"
+                )
+            logger().success("bundling complete!")
+        self.post_bundle()
+
+    def __run_container(
+        self, volume: str, cmd_str: str, name: str = None, rm: bool = True
+    ):
+        """
+        run the build container, sampling its resource usage if requested
+        :param volume: The "host:container" volume of the layer dir.
+        :param cmd_str: The bash command to run.
+        """
+        profiler = None
+        if self.__profile_resources:
+            # docker stats needs a name to find the container by
+            name = name or ResourceProfiler.container_name()
+            profiler = ResourceProfiler(name)
+            profiler.start()
+        try:
+            docker_run(
+                container=self._container,
+                workdir=self.__workdir,
+                volume=[volume] + self._container_volumes,
+                container_cmd=["/bin/bash", "-c", cmd_str],
+                env=self._container_env,
+                cpus=self.__cpus,
+                memory=self.__memory,
+                name=name,
+                rm=rm,
+            )
+        finally:
+            if profiler:
+                # also written when the build fails, e.g. when it ran out of memory
+                samples = profiler.stop()
+                summary = summarize(samples)
+                profile_path = self._output_path / PROFILE_FILENAME.format(
+                    container=name
+                )
+                write_profile(profile_path, name, samples, summary)
+                log_summary(summary, self.__cpus)
+                logger().info(f"wrote resource profile to {profile_path}")
+
+    def __export_build(self, zip_layer: bool):
+        """
+        build without writing to a bind mount: the local dir is copied into the
+        container, and its output is streamed back as a tar and zipped on the fly
+        """
+        if not zip_layer:
+            logger().fatal_error(
+                "export mode always zips the layer, "
+                "it cannot be used with --no-zip, --split or --watch"
+            )
+        self.pre_bundle()
+        output_dir = self.__container_output_dir
+        cmd_str = f"mkdir -p {output_dir} && cp -a {_EXPORT_INPUT_DIR}/. {output_dir}/"
+        if self._container_cmd:
+            cmd_str += f" && cd {self.__workdir} && ({self._container_cmd})"
+        if not self._zip_symlinks:
+            cmd_str += " && " + _DEREFERENCE_CMD.format(dir=output_dir)
+        metadata_cmd = self._export_metadata_cmd()
+        if metadata_cmd:
+            cmd_str += (
+                f" && cd {output_dir} && mkdir -p {EXPORT_METADATA_DIR}"
+                f" && ({metadata_cmd})"
+            )
+
+        name = f"layermake-{uuid.uuid4().hex}"
+        zip_path = self._local_path / "layer.zip"
         try:
-            self.pre_bundle()
             with logger().status("bundling layer with Docker..."):
-                cmd_str = self._container_cmd
-                if not self.__no_zip:
-                    cmd_str += " && zip -r layer.zip *"
-                if self.__container_output_dir != self.__workdir:
-                    cmd_str = f"mkdir -p {self.__container_output_dir} && " + cmd_str
+                logger().info(
+                    f"starting bundling task with docker container {self._container}"
+                )
                 try:
-                    logger().info(
-                        f"starting bundling task with docker container {self._container}"
-                    )
-                    docker_run(
-                        container=self._container,
-                        workdir=self.__workdir,
-                        volume=f"{self._local_path.absolute()}:{self.__container_output_dir}",
-                        container_cmd=["/bin/bash", "-c", cmd_str],
+                    self.__run_container(
+                        f"{self._local_path.absolute()}:{_EXPORT_INPUT_DIR}:ro",
+                        cmd_str,
+                        name=name,
+                        rm=False,
                     )
                 except Exception as e:
                     logger().fatal_error(
                         f"failed bundling layer with docker container {self._container}: {str(e)}"
                     )
                 logger().success("bundling complete!")
-            self.post_bundle()
+
+            if metadata_cmd:
+                metadata_dir = self._local_path / EXPORT_METADATA_DIR
+                docker_cp(
+                    name, f"{output_dir}/{EXPORT_METADATA_DIR}/.", str(metadata_dir)
+                )
+                self._read_export_metadata(metadata_dir)
+
+            with logger().status("streaming layer out of the container..."):
+                with docker_cp_stream(name, f"{output_dir}/.") as stream:
+                    try:
+                        count = zip_tar_stream(
+                            stream,
+                            zip_path,
+                            symlinks=self._zip_symlinks,
+                            include=self._export_include,
+                            # hidden top level entries are build state, zip * skips them
+                            extract=lambda n: n.startswith("."),
+                            extract_dir=self._local_path,
+                        )
+                    except Exception as e:
+                        logger().fatal_error(
+                            f"failed zipping the layer streamed out of {name}: {str(e)}"
+                        )
+                logger().success(f"zipped {count} files to {zip_path}")
+        finally:
+            docker_container_rm(name, missing_ok=True)
+        self.post_bundle()
+
+    def _export_metadata_cmd(self) -> Optional[str]:
+        """
+        a command run in the container output dir after the build in export mode,
+        what it writes to EXPORT_METADATA_DIR is passed to _read_export_metadata
+        """
+        return None
+
+    def _read_export_metadata(self, metadata_dir: Path):
+        """
+        read the metadata copied out of the container before the layer is streamed
+        :param metadata_dir: The host copy of EXPORT_METADATA_DIR.
+        """
+
+    def _export_include(self, name: str, size: int) -> bool:
+        """
+        whether a file streamed out of the container in export mode is added to the layer
+        :param name: The path of the file relative to the container output dir.
+        :param size: The size of the file in bytes.
+        """
+        return True
+
+    def bundle(self) -> Path:
+        try:
+            self._build(zip_layer=not self.__no_zip)
             if not self.__no_zip:
-                # delete all files in the output dir that are not the layer itself
-                for p in self._local_path.iterdir():
-                    if p.name != "layer.zip":
-                        self.add_cleanup_path(p)
+                output = self._finish([self._local_path / "layer.zip"])[0]
+            else:
+                self.__publish_output(
+                    [
+                        p
+                        for p in self._local_path.iterdir()
+                        if p not in self.__cleanup_paths
+                    ]
+                )
+                output = self._output_path
         finally:
-            self.__cleanup()
+            self._cleanup()
 
-        if not self.__no_zip:
-            return self._local_path / "layer.zip"
+        return output
 
-        return self._local_path
+    def bundle_parts(
+        self,
+        max_part_size: int,
+        max_total_size: Optional[int] = None,
+        max_parts: int = MAX_LAYERS,
+    ) -> List[Path]:
+        """
+        bundle the layer content split across as few layer zips as possible.
+        The zips are returned in the order they should be attached.
+        :param max_part_size: The unzipped size budget of a single layer in bytes.
+        :param max_total_size: The combined unzipped size limit of all layers in bytes.
+        :param max_parts: The maximum number of layers that may be produced.
+        """
+        if self.__no_zip:
+            logger().fatal_error("a layer cannot be split when it is not zipped")
+
+        try:
+            self._build(zip_layer=False)
+            with logger().status("splitting layer..."):
+                parts = pack_layers(
+                    self.layer_items(), max_part_size, max_total_size, max_parts
+                )
+                zip_paths = [
+                    self._local_path / f"layer-{n + 1}.zip" for n in range(len(parts))
+                ]
+                with ThreadPoolExecutor() as pool:
+                    list(
+                        pool.map(
+                            lambda part, zip_path: zip_files(
+                                self._local_path,
+                                [f for item in part for f in item.files],
+                                zip_path,
+                            ),
+                            parts,
+                            zip_paths,
+                        )
+                    )
+                logger().success(f"layer split into {len(parts)} parts")
+
+            output = self._finish(zip_paths)
+        finally:
+            self._cleanup()
+
+        return output
+
+    def build_tree(self):
+        """
+        install the layer into the local dir without zipping it and keep the tree,
+        so that it can be updated with sync_sources and zipped with zip_tree
+        """
+        self._build(zip_layer=False)
+
+    def sync_sources(self, source_root: Path, changed: Set[Path]):
+        """
+        copy changed source files into the tree built by build_tree and remove deleted ones
+        :param source_root: The artifact dir the sources are copied from.
+        :param changed: Paths relative to source_root that were added, changed or removed.
+        """
+        for rel in changed:
+            source = source_root / rel
+            for target in self._source_targets(rel):
+                if source.is_file():
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(source, target)
+                    logger().debug(f"synced {source} to {target}")
+                elif target.is_file() or target.is_symlink():
+                    target.unlink()
+                    logger().debug(f"removed {target}")
+
+    def zip_tree(self) -> Path:
+        """
+        zip the tree built by build_tree into the output dir
+        """
+        with logger().status("zipping layer..."):
+            tmp = self._local_path / f".layer-{uuid.uuid4().hex}.zip"
+            zip_files(self._local_path, self.layer_dir().rglob("*"), tmp)
+            target = self._output_path / "layer.zip"
+            try:
+                with self.__output_lock():
+                    atomic_move(tmp, target)
+            except Exception as e:
+                logger().fatal_error(f"failed moving {tmp} to {target}: {str(e)}")
+            logger().success(f"layer zipped to {target}")
+        return target
+
+    def discard_tree(self, keep_tree: bool = False):
+        """
+        delete the tree built by build_tree, leaving the zipped layer in the output dir
+        :param keep_tree: Move the tree into the output dir instead of deleting it.
+        """
+        if keep_tree:
+            self._finish(
+                [p for p in self._local_path.iterdir() if p not in self.__cleanup_paths]
+            )
+        else:
+            # zip_tree already moved the zipped layer into the output dir
+            self._finish([])
+        self._cleanup(background=False)
+
+    def _finish(self, artifacts: List[Path]) -> List[Path]:
+        """
+        marks everything in the local dir that is not one of the artifacts for
+        cleanup and moves the artifacts into the output dir
+        :param artifacts: The finished files or directories directly inside the local dir.
+        :return: The paths of the artifacts in the output dir.
+        """
+        for p in self._local_path.iterdir():
+            if p not in artifacts:
+                self.add_cleanup_path(p)
+        return self.__publish_output(artifacts)
+
+    @contextmanager
+    def holding_output(self) -> Iterator[None]:
+        """
+        once the layer is moved into the output dir, keep the dir locked until the end of
+        this context, so a concurrent build cannot replace the layer before it is published
+        """
+        with ExitStack() as stack:
+            self.__held_locks = stack
+            try:
+                yield
+            finally:
+                self.__held_locks = None
+
+    def __output_lock(self) -> ContextManager[None]:
+        if self.__held_locks:
+            self.__held_locks.enter_context(output_lock(self._output_path))
+            return nullcontext()
+        return output_lock(self._output_path)
+
+    def __publish_output(self, artifacts: List[Path]) -> List[Path]:
+        """
+        moves the finished artifacts from the workspace into the output dir
+        """
+        outputs = []
+        with self.__output_lock(), logger().status(
+            f"moving layer into {self._output_path}..."
+        ):
+            for source in artifacts:
+                target = self._output_path / source.name
+                try:
+                    replaced = atomic_move(source, target)
+                except Exception as e:
+                    logger().fatal_error(
+                        f"failed moving {source} into {self._output_path}: {str(e)}"
+                    )
+                if replaced:
+                    self.add_cleanup_path(replaced)
+                outputs.append(target)
+            logger().success(f"layer moved into {self._output_path}")
+
+        return outputs
 
     def add_cleanup_path(self, p: Path):
         self.__cleanup_paths.append(p)
 
-    def __cleanup(self):
-        with logger().status("cleaning up..."):
-            for p in self.__cleanup_paths:
-                if p.is_dir():
-                    logger().info(f"deleting dir: {p}")
-                    rmtree(p)
-                else:
-                    logger().info(f"deleting file: {p}")
-                    p.unlink(missing_ok=True)
-            logger().success(f"cleaned up {len(self.__cleanup_paths)} file paths")
+    def _cleanup(self, background: bool = True):
+        # everything inside the workspace goes with it
+        paths = [
+            p
+            for p in self.__cleanup_paths
+            if not self.__workspace or self.__workspace not in p.absolute().parents
+        ]
+        if self.__workspace:
+            paths.append(self.__workspace)
+
+        # deletion runs in the background so it does not hold up publishing
+        remove_paths(paths, background=background)
+        if background:
+            logger().info(f"cleaning up {len(paths)} file paths in the background")
+        else:
+            logger().info(f"cleaned up {len(paths)} file paths")
+        self.__cleanup_paths = []
+
+    def layer_dir(self) -> Path:
+        """
+        the top level directory of the layer content in the local dir
+        """
+        logger().fatal_error(f"{type(self).__name__} does not support rebuilding")
+
+    def _source_targets(self, rel: Path) -> List[Path]:
+        """
+        where a file of the artifact dir is copied to in the local dir
+        :param rel: The path of the file relative to the artifact dir.
+        """
+        return []
+
+    def layer_items(self) -> List[LayerItem]:
+        """
+        the units of layer content that can be placed in separate layers when splitting
+        """
+        logger().fatal_error(f"{type(self).__name__} does not support splitting")
 
     def pre_bundle(self):
         pass
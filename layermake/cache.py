@@ -0,0 +1,67 @@
+from typing import Any, ContextManager, Optional
+from pathlib import Path
+import hashlib
+import json
+import uuid
+import os
+from .cmd import file_lock
+
+
+def cache_dir() -> Path:
+    """
+    the directory layermake keeps results in between runs.
+    LAYERMAKE_CACHE_DIR overrides the default of $XDG_CACHE_HOME/layermake.
+    """
+    if os.environ.get("LAYERMAKE_CACHE_DIR"):
+        return Path(os.environ["LAYERMAKE_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "layermake"
+
+
+def read_json(*key: str) -> Optional[Any]:
+    """
+    read a cached value
+    :param key: The path of the entry below the cache dir.
+    :return: The value or None when it is not cached or unreadable.
+    """
+    path = cache_dir().joinpath(*key)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(value: Any, *key: str):
+    """
+    cache a value, readers never see a partially written entry
+    :param value: The value to cache.
+    :param key: The path of the entry below the cache dir.
+    """
+    path = cache_dir().joinpath(*key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.parent / f".{path.name}.{uuid.uuid4().hex}"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def lock(*key: str) -> ContextManager[None]:
+    """
+    an exclusive lock on a cache entry, so that concurrent runs compute it only once
+    :param key: The path of the entry below the cache dir.
+    """
+    path = cache_dir().joinpath("locks", *key)
+    return file_lock(path.with_name(f"{path.name}.lock"))
+
+
+def output_lock(output_dir: Path) -> ContextManager[None]:
+    """
+    an exclusive lock on an output dir, held while layers are moved into it and published
+    :param output_dir: The output dir, the lock lives in the cache dir to keep it clean.
+    """
+    digest = hashlib.sha256(str(Path(output_dir).absolute()).encode()).hexdigest()
+    return lock("outputs", digest[:16])
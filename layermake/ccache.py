@@ -0,0 +1,68 @@
+from typing import Dict
+from pathlib import Path
+from .cache import cache_dir
+from .split import format_size
+from .logger import logger
+
+# where the host cache dir is mounted in the build container
+CONTAINER_CCACHE_DIR = "/ccache"
+
+DEFAULT_CCACHE_SIZE = "5G"
+
+# ccache masquerades as the compilers through these links, they come first on PATH
+_CCACHE_BIN = "/usr/local/lib/ccache"
+
+DOCKERFILE = f"""RUN yum -y install ccache
+RUN mkdir -p {_CCACHE_BIN} && for c in cc gcc c++ g++ clang clang++; do \\
+    ln -sf "$(command -v ccache)" {_CCACHE_BIN}/$c; done
+ENV PATH={_CCACHE_BIN}:$PATH
+ENV CCACHE_DIR={CONTAINER_CCACHE_DIR}
+ENV CCACHE_COMPILERCHECK=content
+"""
+
+
+def default_ccache_dir() -> Path:
+    return cache_dir() / "ccache"
+
+
+def stats_cmd(stats_path: str) -> str:
+    """
+    a container command that writes ccache's counters to stats_path, never failing
+    """
+    return f"(ccache --print-stats > {stats_path} 2>/dev/null || true)"
+
+
+def read_stats(stats_path: Path) -> Dict[str, int]:
+    """
+    read the tab separated counters written by ccache --print-stats
+    """
+    stats = {}
+    if not stats_path.is_file():
+        return stats
+    for line in stats_path.read_text().splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            stats[key] = int(value)
+    return stats
+
+
+def log_stats(before: Dict[str, int], after: Dict[str, int], max_size: str):
+    """
+    log the hits and misses of one build from the counters before and after it
+    """
+    if not after:
+        logger().warn(
+            "no ccache stats, is ccache (>= 4.0) installed in the build image?"
+        )
+        return
+
+    def delta(*keys: str) -> int:
+        return sum(after.get(k, 0) - before.get(k, 0) for k in keys)
+
+    hits = delta("direct_cache_hit", "preprocessed_cache_hit")
+    misses = delta("cache_miss")
+    rate = f" ({hits / (hits + misses) * 100:.1f}% hit rate)" if hits + misses else ""
+    size = format_size(after.get("cache_size_kibibyte", 0) * 1024)
+    logger().success(
+        f"ccache: {hits} hits, {misses} misses{rate}, cache size {size} of {max_size}"
+    )
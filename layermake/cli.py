@@ -5,50 +5,34 @@ import click
 from .python import PythonBundler
 from .binary import BinaryBundler
 from .node import NodeBundler
-import boto3
+from .fleet import PythonFleetBundler
+from .multiruntime import MultiRuntimePythonBundler
+from .elf import LAMBDA_RUNTIME_IMAGE
+from .ccache import DEFAULT_CCACHE_SIZE
+from .installers import INSTALLERS
+from .profiler import PROFILE_FILENAME
+from .diff import load_entries, diff_entries, format_diff, diff_to_dict
+from .watch import watch, PYTHON_INSTALL_FILES, NODE_INSTALL_FILES
+from .server import (
+    BUILD_FUNCTIONS,
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    Client,
+    JobError,
+    JobQueue,
+    serve as serve_jobs,
+    warm_image,
+)
+import os
+import json
 from .publisher import LayerPublisher
+from .bundler import Bundler
+from .split import MAX_LAYER_SIZE_MB
+from .runtimes import NODEJS_RUNTIMES, PYTHON_RUNTIMES, BINARY_RUNTIMES
 from . import header
 from .logger import set_logger
 from functools import wraps
 
-client = boto3.client("lambda")
-
-NODEJS_RUNTIMES = ["4.3", "6.10", "8.10", "10.x", "12.x", "14.x", "16.x", "18.x"]
-PYTHON_RUNTIMES = ["3.6", "3.7", "3.8", "3.9", "3.10", "3.11", "3.12"]
-BINARY_RUNTIMES = [
-    "nodejs",
-    "nodejs4.3",
-    "nodejs6.10",
-    "nodejs8.10",
-    "nodejs10.x",
-    "nodejs12.x",
-    "nodejs14.x",
-    "nodejs16.x",
-    "nodejs18.x",
-    "java8",
-    "java8.al2",
-    "java11",
-    "python2.7",
-    "python3.6",
-    "python3.7",
-    "python3.8",
-    "python3.9",
-    "python3.10",
-    "python3.11",
-    "python3.12",
-    "dotnetcore1.0",
-    "dotnetcore2.0",
-    "dotnetcore2.1",
-    "dotnetcore3.1",
-    "dotnet6",
-    "nodejs4.3-edge",
-    "go1.x",
-    "ruby2.5",
-    "ruby2.7",
-    "provided",
-    "provided.al2",
-]
-
 
 def click_common(f):
     """
@@ -72,6 +56,22 @@ def click_common(f):
         help="architectures this layer is compatible with",
     )
     @click.option("--profile", type=str, help="AWS profile to use")
+    @click.option(
+        "--region",
+        "regions",
+        multiple=True,
+        help="AWS region to publish to; repeat to publish to several regions concurrently",
+    )
+    @click.option(
+        "--s3-bucket",
+        help="stage the layer in this S3 bucket before publishing; "
+        "{region} is replaced with the region being published to",
+    )
+    @click.option(
+        "--endpoint-url",
+        envvar="LAYERMAKE_ENDPOINT_URL",
+        help="send Lambda and S3 requests to this endpoint, e.g. a local stand-in",
+    )
     @click.option("-d", "--description", type=str, help="description of the layer")
     @click.option("-v", "--verbose", is_flag=True, help="verbose output")
     @click.option(
@@ -95,6 +95,9 @@ def click_common(f):
         license_file,
         arch,
         profile,
+        regions,
+        s3_bucket,
+        endpoint_url,
         description,
         verbose,
         quiet,
@@ -118,6 +121,9 @@ def click_common(f):
             license_text=license,
             license_file=license_file,
             profile=profile,
+            regions=regions,
+            s3_bucket=s3_bucket,
+            endpoint_url=endpoint_url,
             arch=arch,
             no_publish=no_publish,
             description=description,
@@ -128,6 +134,100 @@ def click_common(f):
     return new_func
 
 
+def click_split(f):
+    """
+    adds layer splitting options to a command
+    """
+
+    @click.option(
+        "--split",
+        is_flag=True,
+        help="split the layer content across as few layers as possible",
+    )
+    @click.option(
+        "--split-size",
+        type=int,
+        default=MAX_LAYER_SIZE_MB,
+        show_default=True,
+        help="unzipped size budget of each layer in MB when splitting",
+    )
+    @click.option(
+        "--split-total",
+        type=int,
+        default=MAX_LAYER_SIZE_MB,
+        show_default=True,
+        help="combined unzipped size limit of all layers in MB when splitting; lambda "
+        "applies it to the function and all its layers together",
+    )
+    @wraps(f)
+    def new_func(*args, split, split_size, split_total, **kwargs):
+        return f(*args, split=(split, split_size, split_total), **kwargs)
+
+    return new_func
+
+
+def _print_arns(arns):
+    """
+    print published layer version ARNs as JSON, keyed by region
+    """
+    if arns:
+        print(json.dumps(arns, indent=2))
+
+
+def _check_export(publisher: LayerPublisher, export: bool, watch=False, split=None):
+    """
+    --export zips the layer while streaming it out, there is no tree to keep or split
+    """
+    if export and (publisher.no_zip or watch or (split and split[0])):
+        print("--export cannot be used with --no-zip, --watch or --split")
+        sys.exit(2)
+
+
+def _bundle_and_publish(
+    publisher: LayerPublisher, bundler: Bundler, layer_type: str, split
+):
+    split, split_size, split_total = split
+    if not split:
+        with bundler.holding_output():
+            _print_arns(publisher.publish_layer(bundler.bundle(), layer_type))
+        return
+
+    mb = 1024 * 1024
+    with bundler.holding_output():
+        arns = publisher.publish_layers(
+            bundler.bundle_parts(
+                max_part_size=split_size * mb,
+                max_total_size=split_total * mb if split_total else None,
+            ),
+            layer_type,
+        )
+    # the parts are listed in the order they should be attached
+    _print_arns([a for a in arns if a])
+
+
+def _watch(
+    publisher: LayerPublisher,
+    bundler_factory,
+    dir,
+    manifest,
+    install_files,
+    layer_type: str,
+    split,
+):
+    if split[0]:
+        print("--watch cannot be used with --split")
+        sys.exit(2)
+
+    watch(
+        bundler_factory,
+        artifact_dir=Path(dir) if dir else None,
+        manifest=Path(manifest) if manifest else None,
+        install_files=install_files,
+        on_layer=lambda path: _print_arns(publisher.publish_layer(path, layer_type)),
+        no_zip=publisher.no_zip,
+    )
+
+
 @click.group()
 def cli():
     pass
@@ -135,6 +235,7 @@ def cli():
 
 @cli.command()
 @click_common
+@click_split
 @click.option("-r", "--runtime", help="nodejs runtime")
 @click.option("-m", "--manifest", help="nodejs manifest file (package.json)")
 @click.option(
@@ -144,13 +245,78 @@ def cli():
     help="target output directory",
     show_default=True,
 )
+@click.option(
+    "--staging-dir",
+    envvar="LAYERMAKE_STAGING_DIR",
+    help="scratch directory (e.g. tmpfs) to build the layer in; "
+    "only the finished layer is moved into the output directory",
+)
 @click.option(
     "--container", type=str, help="use the provided docker container to build the layer"
 )
 @click.option("--dir", help="directory containing artifacts to bundle into a layer")
+@click.option("--dev", is_flag=True, help="also install devDependencies")
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="rebuild the layer whenever --dir or --manifest change; "
+    "the install step only re-runs when install files change",
+)
+@click.option(
+    "--no-prune",
+    is_flag=True,
+    help="do not remove docs, tests, sources maps and other files "
+    "that are not needed at runtime from node_modules",
+)
+@click.option(
+    "--prune",
+    "prune_globs",
+    multiple=True,
+    help="additional glob pattern of files or directories to prune from node_modules",
+)
+@click.option(
+    "--prune-keep",
+    multiple=True,
+    help="glob pattern of files or directories that are never pruned",
+)
+@click.option(
+    "--export",
+    is_flag=True,
+    help="build in the container's own filesystem and stream the layer out as a tar "
+    "instead of writing it through a bind mount; always zips the layer",
+)
+@click.option(
+    "--profile-resources",
+    is_flag=True,
+    help="sample the CPU, memory, block I/O and network usage of the build container "
+    f"and write them to {PROFILE_FILENAME.format(container='<container>')} in the "
+    "output dir",
+)
+@click.option(
+    "--keep-provided",
+    is_flag=True,
+    help="keep packages the lambda runtime provides, e.g. aws-sdk, and their "
+    "dependencies in the layer even when they are not requested explicitly",
+)
 @click.argument("packages", nargs=-1)
 def nodejs(
-    publisher: LayerPublisher, runtime: str, manifest, output, container, dir, packages
+    publisher: LayerPublisher,
+    runtime: str,
+    manifest,
+    output,
+    staging_dir,
+    container,
+    dir,
+    dev,
+    watch,
+    no_prune,
+    prune_globs,
+    prune_keep,
+    export,
+    profile_resources,
+    keep_provided,
+    packages,
+    split,
 ):
     while not runtime:
         runtime = input(f'NodeJS runtime ({",".join(NODEJS_RUNTIMES)}): ').strip()
@@ -166,22 +332,52 @@ def nodejs(
         runtime = runtime + ".x"
     _runtime_name = f"nodejs{runtime}"
 
-    publisher.__runtimes = [_runtime_name]
-    bundler = NodeBundler(
-        runtime=runtime,
-        artifact_dir=dir,
-        local_dir=output,
-        container=container,
-        manifest=manifest,
-        packages=packages,
-        no_zip=publisher.no_zip,
-    )
-    publisher.publish_layer(bundler.bundle(), _runtime_name)
+    publisher.runtimes = [_runtime_name]
+    _check_export(publisher, export, watch, split)
+
+    def bundler_factory():
+        return NodeBundler(
+            runtime=runtime,
+            artifact_dir=dir,
+            local_dir=output,
+            staging_dir=staging_dir,
+            container=container,
+            manifest=manifest,
+            packages=packages,
+            no_zip=publisher.no_zip,
+            dev_dependencies=dev,
+            prune=not no_prune,
+            prune_globs=prune_globs,
+            prune_keep=prune_keep,
+            export=export,
+            profile_resources=profile_resources,
+            exclude_provided=not keep_provided,
+        )
+
+    if watch:
+        _watch(
+            publisher,
+            bundler_factory,
+            dir,
+            manifest,
+            NODE_INSTALL_FILES,
+            _runtime_name,
+            split,
+        )
+        return
+    _bundle_and_publish(publisher, bundler_factory(), _runtime_name, split)
 
 
 @cli.command()
 @click_common
-@click.option("-r", "--runtime", help="python runtime")
+@click_split
+@click.option(
+    "-r",
+    "--runtime",
+    "runtimes",
+    multiple=True,
+    help="python runtime; repeat to build for several runtimes",
+)
 @click.option("-m", "--manifest", help="python manifest file (requirements.txt)")
 @click.option(
     "-o",
@@ -190,36 +386,229 @@ def nodejs(
     help="target output directory",
     show_default=True,
 )
+@click.option(
+    "--staging-dir",
+    envvar="LAYERMAKE_STAGING_DIR",
+    help="scratch directory (e.g. tmpfs) to build the layer in; "
+    "only the finished layer is moved into the output directory",
+)
 @click.option("--dir", help="directory containing artifacts to bundle into a layer")
 @click.option(
     "--container", type=str, help="use the provided docker container to build the layer"
 )
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="rebuild the layer whenever --dir or --manifest change; "
+    "the install step only re-runs when install files change",
+)
+@click.option(
+    "--native",
+    is_flag=True,
+    help="install wheels with the host's pip instead of Docker; "
+    "falls back to Docker when a distribution has no compatible wheel",
+)
+@click.option(
+    "--installer",
+    type=click.Choice(list(INSTALLERS)),
+    default="pip",
+    help="engine that resolves and installs distributions in the build container",
+    show_default=True,
+)
+@click.option(
+    "--export",
+    is_flag=True,
+    help="build in the container's own filesystem and stream the layer out as a tar "
+    "instead of writing it through a bind mount; always zips the layer",
+)
+@click.option(
+    "--profile-resources",
+    is_flag=True,
+    help="sample the CPU, memory, block I/O and network usage of the build container "
+    f"and write them to {PROFILE_FILENAME.format(container='<container>')} in the "
+    "output dir",
+)
+@click.option(
+    "--keep-provided",
+    is_flag=True,
+    help="keep packages the lambda runtime provides, e.g. boto3, and their "
+    "dependencies in the layer even when they are not requested explicitly",
+)
 @click.argument("packages", nargs=-1)
 def python(
-    publisher: LayerPublisher, runtime: str, manifest, output, dir, container, packages
+    publisher: LayerPublisher,
+    runtimes: List[str],
+    manifest,
+    output,
+    staging_dir,
+    dir,
+    container,
+    watch,
+    native,
+    installer,
+    export,
+    profile_resources,
+    keep_provided,
+    packages,
+    split,
 ):
-    while not runtime:
+    runtimes = list(runtimes)
+    while not runtimes:
         runtime = input(f'Python runtime ({",".join(PYTHON_RUNTIMES)}): ').strip()
         if runtime not in PYTHON_RUNTIMES:
             print(f'runtime must be one of ({",".join(PYTHON_RUNTIMES)})!')
             sys.exit(2)
+        runtimes = [runtime]
 
     if not manifest and not packages and not dir:
         packages = input("Python packages: ").strip().split(" ")
 
+    runtimes = [r.replace("python", "") for r in runtimes]
+    if len(runtimes) > 1:
+        if (
+            dir
+            or container
+            or split[0]
+            or watch
+            or installer != "pip"
+            or native
+            or export
+            or profile_resources
+        ):
+            print(
+                "--dir, --container, --split, --watch, --native, --installer, --export "
+                "and --profile-resources cannot be used with multiple runtimes"
+            )
+            sys.exit(2)
+        bundler = MultiRuntimePythonBundler(
+            runtimes=runtimes,
+            local_dir=output,
+            staging_dir=staging_dir,
+            manifest=manifest,
+            packages=packages,
+            no_zip=publisher.no_zip,
+            exclude_provided=not keep_provided,
+        )
+        with bundler.holding_output():
+            layers = bundler.bundle_runtimes()
+            arns = {}
+            for path, layer_runtimes in layers:
+                name = publisher.name
+                if len(layers) > 1:
+                    # layer names cannot contain dots
+                    name = f"{name}-{layer_runtimes[0].replace('.', '')}"
+                arns[name] = publisher.publish_layer(
+                    path, "python", name=name, runtimes=layer_runtimes
+                )
+        _print_arns({name: a for name, a in arns.items() if a})
+        return
+
+    _check_export(publisher, export, watch, split)
+    runtime = runtimes[0]
+    _runtime_name = f"python{runtime}"
+    publisher.runtimes = [_runtime_name]
+    if native and len(publisher.arch) > 1:
+        print("--native can only build for a single architecture")
+        sys.exit(2)
+
+    def bundler_factory():
+        return PythonBundler(
+            runtime=runtime,
+            artifact_dir=dir,
+            local_dir=output,
+            staging_dir=staging_dir,
+            container=container,
+            manifest=manifest,
+            packages=packages,
+            no_zip=publisher.no_zip,
+            native=native,
+            arch=publisher.arch[0],
+            installer=installer,
+            export=export,
+            profile_resources=profile_resources,
+            exclude_provided=not keep_provided,
+        )
+
+    if watch:
+        _watch(
+            publisher,
+            bundler_factory,
+            dir,
+            manifest,
+            PYTHON_INSTALL_FILES,
+            _runtime_name,
+            split,
+        )
+        return
+    _bundle_and_publish(publisher, bundler_factory(), _runtime_name, split)
+
+
+@cli.command()
+@click_common
+@click.option("-r", "--runtime", required=True, help="python runtime")
+@click.option(
+    "-o",
+    "--output",
+    default=str(Path("./layer")),
+    help="target output directory",
+    show_default=True,
+)
+@click.option(
+    "--staging-dir",
+    envvar="LAYERMAKE_STAGING_DIR",
+    help="scratch directory (e.g. tmpfs) to build the layer in; "
+    "only the finished layer is moved into the output directory",
+)
+@click.option(
+    "--container", type=str, help="use the provided docker container to build the layer"
+)
+@click.option(
+    "--keep-provided",
+    is_flag=True,
+    help="keep packages the lambda runtime provides, e.g. boto3, and their "
+    "dependencies in the layers even when they are not requested explicitly",
+)
+@click.argument("definitions", nargs=-1, required=True)
+def fleet(
+    publisher: LayerPublisher,
+    runtime: str,
+    output,
+    staging_dir,
+    container,
+    keep_provided,
+    definitions,
+):
+    """
+    build several python layers with the distributions they share moved into a
+    base layer named by --name. DEFINITIONS are given as LAYER_NAME=REQUIREMENTS_FILE.
+    """
+    layers = {}
+    for definition in definitions:
+        name, sep, manifest = definition.partition("=")
+        if not sep or not name or not manifest:
+            print(f"layer definition {definition} must be LAYER_NAME=REQUIREMENTS_FILE")
+            sys.exit(2)
+        layers[name] = manifest
+
     runtime = runtime.replace("python", "")
     _runtime_name = f"python{runtime}"
-    publisher.__runtimes = [_runtime_name]
-    bundler = PythonBundler(
+    publisher.runtimes = [_runtime_name]
+    bundler = PythonFleetBundler(
         runtime=runtime,
-        artifact_dir=dir,
+        definitions=layers,
+        base_name=publisher.name or "base",
         local_dir=output,
+        staging_dir=staging_dir,
         container=container,
-        manifest=manifest,
-        packages=packages,
         no_zip=publisher.no_zip,
+        exclude_provided=not keep_provided,
     )
-    publisher.publish_layer(bundler.bundle(), _runtime_name)
+    with bundler.holding_output():
+        arns = {
+            name: publisher.publish_layer(path, _runtime_name, name=name)
+            for name, path in bundler.bundle_fleet().items()
+        }
+    _print_arns({name: a for name, a in arns.items() if a})
 
 
 @cli.command()
@@ -232,6 +621,12 @@ def python(
     help="target output directory",
     show_default=True,
 )
+@click.option(
+    "--staging-dir",
+    envvar="LAYERMAKE_STAGING_DIR",
+    help="scratch directory (e.g. tmpfs) to build the layer in; "
+    "only the finished layer is moved into the output directory",
+)
 @click.option(
     "-w",
     "--workdir",
@@ -267,30 +662,368 @@ def python(
     type=click.Choice(BINARY_RUNTIMES + ["all"]),
     help="compatible runtimes",
 )
+@click.option(
+    "--strip",
+    is_flag=True,
+    help="strip debug sections from ELF binaries and libraries after the build",
+)
+@click.option(
+    "--dedup-libs",
+    is_flag=True,
+    help="replace byte-identical shared libraries with symlinks to a single copy",
+)
+@click.option(
+    "--collect-libs",
+    multiple=True,
+    help="executable, library or directory below /opt (e.g. bin/gpg) whose shared "
+    "library dependencies are copied into /opt/lib; libraries the lambda runtime "
+    "provides are skipped",
+)
+@click.option(
+    "--runtime-image",
+    default=LAMBDA_RUNTIME_IMAGE,
+    help="lambda base image whose libraries are not collected by --collect-libs",
+    show_default=True,
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    help="parallel compile jobs, exported as MAKEFLAGS, CMAKE_BUILD_PARALLEL_LEVEL "
+    "and NPY_NUM_BUILD_JOBS  [default: number of CPUs]",
+)
+@click.option(
+    "--cpus", type=float, help="limit the CPUs the build container may use, e.g. 2.5"
+)
+@click.option("--memory", help="limit the memory the build container may use, e.g. 4g")
+@click.option(
+    "--ccache",
+    is_flag=True,
+    help="compile through ccache with a cache that persists between builds",
+)
+@click.option(
+    "--ccache-dir",
+    envvar="LAYERMAKE_CCACHE_DIR",
+    help="host directory ccache stores its cache in  [default: ~/.cache/layermake/ccache]",
+)
+@click.option(
+    "--ccache-size",
+    default=DEFAULT_CCACHE_SIZE,
+    help="size limit of the ccache dir",
+    show_default=True,
+)
+@click.option(
+    "--export",
+    is_flag=True,
+    help="build in the container's own filesystem and stream the layer out as a tar "
+    "instead of writing it through a bind mount; always zips the layer",
+)
+@click.option(
+    "--profile-resources",
+    is_flag=True,
+    help="sample the CPU, memory, block I/O and network usage of the build container "
+    f"and write them to {PROFILE_FILENAME.format(container='<container>')} in the "
+    "output dir",
+)
 @click.argument("artifact", nargs=1, type=click.Path(exists=True))
 def binary(
     publisher: LayerPublisher,
     dockerfile: str,
     output: str,
+    staging_dir: str,
     workdir: str,
     cmd: str,
     base_image: str,
     packages: List[str],
     runtimes: List[str],
+    strip: bool,
+    dedup_libs: bool,
+    collect_libs: List[str],
+    runtime_image: str,
+    jobs: int,
+    cpus: float,
+    memory: str,
+    ccache: bool,
+    ccache_dir: str,
+    ccache_size: str,
+    export: bool,
+    profile_resources: bool,
     artifact,
 ):
-    publisher.__runtimes = [...[BINARY_RUNTIMES if "all" in runtimes else runtimes]]
+    _check_export(publisher, export)
+    publisher.runtimes = BINARY_RUNTIMES if "all" in runtimes else runtimes
     bundler = BinaryBundler(
-        build_artifact=artifact[0],
+        build_artifact=artifact,
         local_dir=output,
+        staging_dir=staging_dir,
         base_image=base_image,
         yum_packages=packages,
         dockerfile=dockerfile,
         build_cmd=cmd,
         workdir=workdir,
         no_zip=publisher.no_zip,
+        strip=strip,
+        dedup_libs=dedup_libs,
+        collect_libs=collect_libs,
+        runtime_image=runtime_image,
+        jobs=jobs,
+        cpus=cpus,
+        memory=memory,
+        ccache=ccache,
+        ccache_dir=ccache_dir,
+        ccache_size=ccache_size,
+        export=export,
+        profile_resources=profile_resources,
+    )
+    with bundler.holding_output():
+        _print_arns(publisher.publish_layer(bundler.bundle(), "binary"))
+
+
+@cli.command()
+@click.option("--profile", type=str, help="AWS profile to use")
+@click.option("--region", help="AWS region of published layer versions")
+@click.option(
+    "--endpoint-url",
+    envvar="LAYERMAKE_ENDPOINT_URL",
+    help="send Lambda requests to this endpoint, e.g. a local stand-in",
+)
+@click.option("--json", "as_json", is_flag=True, help="print the diff as JSON")
+@click.option(
+    "--no-files",
+    is_flag=True,
+    help="only print the per package summary, not every changed file",
+)
+@click.option("-v", "--verbose", is_flag=True, help="verbose output")
+@click.option(
+    "-q",
+    "--quiet",
+    is_flag=True,
+    help="quiet output. Only display errors and warnings. Turn off animations.",
+)
+@click.argument("old")
+@click.argument("new")
+def diff(
+    profile: str,
+    region: str,
+    endpoint_url: str,
+    as_json: bool,
+    no_files: bool,
+    verbose: bool,
+    quiet: bool,
+    old: str,
+    new: str,
+):
+    """
+    compare two layers by the metadata in their zip central directories.
+    OLD and NEW are layer zips, layer version ARNs or <layer name>:<version>.
+    """
+    set_logger(verbose, quiet or as_json)
+    old_entries, new_entries = (
+        load_entries(ref, profile=profile, region=region, endpoint_url=endpoint_url)
+        for ref in (old, new)
     )
-    publisher.publish_layer(bundler.bundle(), "binary")
+    layer_diff = diff_entries(old_entries, new_entries)
+    if as_json:
+        print(json.dumps(diff_to_dict(layer_diff), indent=2))
+    else:
+        print(format_diff(layer_diff, files=not no_files))
+
+
+@cli.command()
+@click.option(
+    "--host", default=DEFAULT_HOST, help="address to listen on", show_default=True
+)
+@click.option(
+    "--port",
+    type=int,
+    default=DEFAULT_PORT,
+    help="port to listen on",
+    show_default=True,
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    envvar="LAYERMAKE_SOCKET",
+    help="listen on this unix socket instead of --host and --port",
+)
+@click.option(
+    "--token",
+    envvar="LAYERMAKE_TOKEN",
+    help="bearer token clients must send, generated when not given; a unix socket "
+    "needs none",
+)
+@click.option(
+    "--root",
+    "roots",
+    multiple=True,
+    type=click.Path(exists=True, file_okay=False),
+    help="directory jobs may read manifests from and write layers to; repeat for "
+    "several  [default: the current directory]",
+)
+@click.option(
+    "--max-builds",
+    type=click.IntRange(min=1),
+    default=2,
+    help="jobs that may build at the same time",
+    show_default=True,
+)
+@click.option(
+    "--max-publishes",
+    type=click.IntRange(min=1),
+    default=4,
+    help="jobs that may publish at the same time",
+    show_default=True,
+)
+@click.option(
+    "--warm",
+    multiple=True,
+    help="runtime (e.g. python3.12, nodejs20.x) or image whose build image is pulled "
+    "at startup; repeat for several",
+)
+@click.option("-v", "--verbose", is_flag=True, help="verbose output")
+@click.option(
+    "-q",
+    "--quiet",
+    is_flag=True,
+    help="quiet output. Only display errors and warnings. Turn off animations.",
+)
+def serve(
+    host: str,
+    port: int,
+    socket_path: str,
+    token: str,
+    roots: List[str],
+    max_builds: int,
+    max_publishes: int,
+    warm: List[str],
+    verbose: bool,
+    quiet: bool,
+):
+    """
+    run a local build server that queues build and publish jobs submitted with
+    layermake submit. Images and caches stay warm between jobs.
+    """
+    set_logger(verbose, quiet)
+    for name in warm:
+        warm_image(name)
+    serve_jobs(
+        JobQueue(
+            max_builds=max_builds,
+            max_publishes=max_publishes,
+            roots=list(roots) or [os.getcwd()],
+        ),
+        host=host,
+        port=port,
+        socket_path=socket_path,
+        token=token,
+    )
+
+
+def _job_params(values: List[str]) -> dict:
+    """
+    parse KEY=VALUE job parameters, values are JSON or plain strings and repeated keys
+    become lists
+    """
+    params = {}
+    for value in values:
+        key, sep, raw = value.partition("=")
+        if not sep:
+            raise click.BadParameter(f"{value} is not KEY=VALUE")
+        try:
+            parsed = json.loads(raw)
+        except ValueError:
+            parsed = raw
+        key = key.replace("-", "_")
+        if key in params:
+            previous = params[key]
+            params[key] = (previous if isinstance(previous, list) else [previous]) + [
+                parsed
+            ]
+        else:
+            params[key] = parsed
+    return params
+
+
+@cli.command()
+@click.option(
+    "--url",
+    envvar="LAYERMAKE_SERVER",
+    help=f"server URL  [default: http://{DEFAULT_HOST}:{DEFAULT_PORT}]",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    envvar="LAYERMAKE_SOCKET",
+    help="connect to the server on this unix socket",
+)
+@click.option(
+    "--token",
+    envvar="LAYERMAKE_TOKEN",
+    help="the server's token  [default: the one a server on this machine wrote]",
+)
+@click.option("-t", "--type", "job_type", type=click.Choice(list(BUILD_FUNCTIONS)))
+@click.option(
+    "-b",
+    "--build",
+    "build_params",
+    multiple=True,
+    help="build parameter as KEY=VALUE, e.g. runtime=3.12 or manifest=requirements.txt",
+)
+@click.option(
+    "-p",
+    "--publish",
+    "publish_params",
+    multiple=True,
+    help="publish parameter as KEY=VALUE, e.g. name=my-layer; the layer is only "
+    "published when at least one is given",
+)
+@click.option("--no-wait", is_flag=True, help="print the job id and return at once")
+@click.argument("job", type=click.File("r"), required=False)
+def submit(
+    url: str,
+    socket_path: str,
+    token: str,
+    job_type: str,
+    build_params: List[str],
+    publish_params: List[str],
+    no_wait: bool,
+    job,
+):
+    """
+    submit a job to a layermake server, stream its log and print its result as JSON.
+    JOB is a JSON file (- for stdin) of the form
+    {"type": "python", "build": {...}, "publish": {...}}; the build and publish
+    parameters are those of the python, nodejs or binary command and are merged with
+    --type, --build and --publish.
+    """
+    request = json.load(job) if job else {}
+    if job_type:
+        request["type"] = job_type
+    request.setdefault("build", {}).update(_job_params(build_params))
+    if publish_params:
+        request.setdefault("publish", {}).update(_job_params(publish_params))
+    # relative paths are resolved by the server against the client's directory
+    request["cwd"] = os.getcwd()
+
+    client = Client(url=url, socket_path=socket_path, token=token)
+    try:
+        submitted = client.submit(request)
+    except (JobError, OSError) as e:
+        print(f"failed submitting job: {e}", file=sys.stderr)
+        sys.exit(1)
+    job_id = submitted["job"]["id"]
+    if submitted["deduplicated"]:
+        print(f"an identical job is in flight, following job {job_id}", file=sys.stderr)
+    if no_wait:
+        print(job_id)
+        return
+
+    for line in client.follow(job_id):
+        print(line, file=sys.stderr)
+    result = client.job(job_id)
+    print(json.dumps(result, indent=2))
+    if result["state"] != "succeeded":
+        sys.exit(1)
 
 
 if __name__ == "__main__":
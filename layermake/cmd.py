@@ -1,11 +1,20 @@
-from typing import List, Union, Callable
+from typing import BinaryIO, Dict, Iterator, List, Union, Callable, Optional
+from contextlib import contextmanager
 import subprocess
 from pathlib import Path
+import threading
+import queue
 import shutil
-from .logger import logger
+import uuid
+from .logger import logger, with_logger
 import stat
 import os
 
+try:
+    import fcntl
+except ImportError:  # windows, locks are no-ops there
+    fcntl = None
+
 
 def popen(cmd: List[str], output_prepend: str = "") -> Union[str, int]:
     """
@@ -53,18 +62,71 @@ def run(
     return return_code
 
 
+def capture(cmd: List[str]) -> str:
+    """
+    Run a command and return its output.
+    """
+    logger().debug("executing command:", " ".join(cmd))
+    try:
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, "stderr", None) or str(e)
+        logger().fatal_error(
+            f'command failed! Command "{" ".join(cmd)}": {stderr.strip()}'
+        )
+    return result.stdout
+
+
 # docker run --rm $volume_params -w "/layer" "$docker_image" /bin/bash -c "$install_command && $zip_command"
 def docker_run(
-    container: str, workdir: str, volume: str, container_cmd: Union[str, List[str]]
+    container: str,
+    workdir: str,
+    volume: Union[str, List[str]],
+    container_cmd: Union[str, List[str]],
+    entrypoint: str = None,
+    env: Dict[str, str] = None,
+    cpus: float = None,
+    memory: str = None,
+    name: str = None,
+    rm: bool = True,
 ):
     """
     Run a command in a docker container.
     :param container: The docker container to run the command in.
     :param workdir: The working directory to run the command in.
-    :param volume: The volume to mount into the container.
+    :param volume: The volume or volumes to mount into the container.
     :param container_cmd: The command to run in the container.
+    :param entrypoint: Overrides the entrypoint of the image.
+    :param env: Environment variables set in the container.
+    :param cpus: Limits the number of CPUs the container may use, e.g. 1.5.
+    :param memory: Limits the memory the container may use, e.g. 4g.
+    :param name: The name of the container.
+    :param rm: Remove the container when it exits.
     """
-    cmd = ["docker", "run", "--rm", "-v", volume, "-w", workdir, container]
+    cmd = ["docker", "run"]
+    if rm:
+        cmd.append("--rm")
+    if name:
+        cmd.extend(["--name", name])
+    for v in [volume] if isinstance(volume, str) else volume:
+        cmd.extend(["-v", v])
+    cmd.extend(["-w", workdir])
+    if entrypoint:
+        cmd.extend(["--entrypoint", entrypoint])
+    for key, value in (env or {}).items():
+        cmd.extend(["-e", f"{key}={value}"])
+    if cpus:
+        cmd.extend(["--cpus", str(cpus)])
+    if memory:
+        # without a swap limit the container could swap instead of failing
+        cmd.extend(["--memory", memory, "--memory-swap", memory])
+    cmd.append(container)
     if isinstance(container_cmd, str):
         cmd.append(container_cmd)
     else:
@@ -73,41 +135,99 @@ def docker_run(
     return run(cmd, output_prepend="docker run>\t")
 
 
-def docker_cp(image_hash: str, local_dir: str):
+def docker_cp(container: str, source: str, target: str):
     """
     Copy a file or directory from a container to the host.
-    :param image_hash: The hash of the image to copy from.
-    :param local_dir: The local directory to copy to.
+    :param container: The name or id of the container to copy from.
+    :param source: The path in the container.
+    :param target: The path on the host to copy to.
     """
     return run(
-        ["docker", "cp", f"{image_hash}:/opt/layer.zip", local_dir],
+        ["docker", "cp", f"{container}:{source}", target],
         output_prepend="docker cp>\t",
     )
 
 
+@contextmanager
+def docker_cp_stream(container: str, source: str) -> Iterator[BinaryIO]:
+    """
+    Stream a file or directory of a container as a tar archive.
+    :param container: The name or id of the container to copy from.
+    :param source: The path in the container, a trailing /. streams the contents of a directory.
+    """
+    cmd = ["docker", "cp", f"{container}:{source}", "-"]
+    logger().debug("executing command:", " ".join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode(errors="replace")
+        proc.stderr.close()
+        return_code = proc.wait()
+    if return_code != 0:
+        logger().fatal_error(
+            f'command failed! Command "{" ".join(cmd)}": {stderr.strip()}'
+        )
+
+
 def docker_build(
-    dockerfile: str = "Dockerfile", ctx_dir: str = ".", quiet: bool = True
+    dockerfile: str = "Dockerfile",
+    ctx_dir: str = ".",
+    quiet: bool = True,
+    tag: str = None,
 ):
     """
     Build a docker image.
     :param dockerfile: The path to the Dockerfile to build.
     :param ctx_dir: The context directory to build the Dockerfile in.
     :param quiet: Whether to suppress the build output.
+    :param tag: The name the image is tagged with.
     """
     cmd = ["docker", "build", "-f", dockerfile, ctx_dir]
+    if tag:
+        cmd[2:2] = ["-t", tag]
     if quiet:
         cmd = cmd[0:2] + ["--quiet"] + cmd[2:]
-    return run(cmd)
+    return capture(cmd)
+
+
+def _inspect_image(image: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["docker", "image", "inspect", "--format", "{{.Id}}", image],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+
+
+def docker_image_exists(image: str) -> bool:
+    """
+    whether an image is present locally
+    """
+    return _inspect_image(image).returncode == 0
+
+
+def docker_image_id(image: str) -> str:
+    """
+    The content addressed id of an image, the image is pulled when it is not present locally.
+    """
+    result = _inspect_image(image)
+    if result.returncode == 0:
+        return result.stdout.strip()
+    run(["docker", "pull", image], output_prepend="docker pull>\t")
+    return capture(["docker", "image", "inspect", "--format", "{{.Id}}", image]).strip()
 
 
-def docker_container_rm(container_hash: str):
+def docker_container_rm(container_hash: str, missing_ok: bool = False):
     return run(
         [
             "docker",
             "container",
             "rm",
             container_hash,
-        ]
+        ],
+        return_codes=[0, 1] if missing_ok else 0,
     )
 
 
@@ -122,17 +242,17 @@ def docker_image_rm(image_hash: str):
     )
 
 
-def path_copy(source: Path, target: Path):
+def path_copy(source: Path, target: Path, ignore: Callable = None):
     """
     Copy a file or directory to a target directory.
     :param source: The source file or directory to copy.
     :param target: The target directory to copy the source to.
+    :param ignore: Excludes files when copying a directory, see shutil.copytree.
     """
     if source.is_dir():
         with logger().status(f"copying contents of {source} into {target}..."):
             try:
-                target.mkdir(parents=True, exist_ok=True)
-                shutil.copytree(source, target)
+                shutil.copytree(source, target, dirs_exist_ok=True, ignore=ignore)
             except Exception as e:
                 logger().fatal_error(
                     f"Failed copying {source} contents into {target}: {str(e)}"
@@ -211,3 +331,162 @@ def rmtree(p: os.PathLike):
     Remove a directory tree.
     """
     shutil.rmtree(p, onerror=_rmtree_onerror)
+
+
+def _remove_path(p: Path):
+    if p.is_dir() and not p.is_symlink():
+        rmtree(p)
+    else:
+        p.unlink(missing_ok=True)
+
+
+def _remove_paths(paths: List[Path]):
+    # split directories on their top-level entries so that a single large tree
+    # is spread across the workers instead of being deleted by one of them
+    dirs = [p for p in paths if p.is_dir() and not p.is_symlink()]
+    entries: "queue.SimpleQueue[Path]" = queue.SimpleQueue()
+    for p in paths:
+        if p not in dirs:
+            entries.put(p)
+    for d in dirs:
+        for p in d.iterdir():
+            entries.put(p)
+
+    # plain threads rather than an executor, which refuses new work once the
+    # interpreter starts shutting down (e.g. after a fatal error)
+    def worker():
+        while True:
+            try:
+                p = entries.get_nowait()
+            except queue.Empty:
+                return
+            err = _try_remove_path(p)
+            if err:
+                logger().warn(f"failed to delete {p}: {err}")
+
+    workers = [
+        threading.Thread(target=with_logger(worker), name="layermake-rm")
+        for _ in range(min(32, (os.cpu_count() or 1) * 4, entries.qsize() or 1))
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    for d in dirs:
+        err = _try_remove_path(d)
+        if err:
+            logger().warn(f"failed to delete {d}: {err}")
+
+
+def _try_remove_path(p: Path) -> Optional[Exception]:
+    try:
+        _remove_path(p)
+    except Exception as e:
+        return e
+    return None
+
+
+def remove_paths(
+    paths: List[Path], background: bool = False
+) -> Optional[threading.Thread]:
+    """
+    Delete files and directory trees in parallel.
+    :param paths: The files and directories to delete.
+    :param background: Delete in a background thread and return it instead of blocking.
+        The thread is not a daemon so the interpreter waits for it before exiting.
+    """
+    if not background:
+        _remove_paths(paths)
+        return None
+
+    thread = threading.Thread(
+        target=with_logger(_remove_paths), args=(list(paths),), name="layermake-cleanup"
+    )
+    thread.start()
+    return thread
+
+
+def atomic_move(source: Path, target: Path) -> Optional[Path]:
+    """
+    Move a file or directory to target so that target is never observed half written.
+    A rename is used when source and target share a filesystem, otherwise source is
+    copied next to target first and then renamed into place.
+    :param source: The file or directory to move.
+    :param target: The destination path (not the parent directory).
+    :return: The path an existing target directory was moved aside to, if any.
+        The caller is responsible for deleting it.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    replaced = None
+    if target.is_dir() and not target.is_symlink():
+        # os.replace cannot overwrite a non-empty directory, move it aside first
+        replaced = target.with_name(f".{target.name}.old-{uuid.uuid4().hex}")
+        os.replace(target, replaced)
+
+    try:
+        os.replace(source, target)
+        return replaced
+    except OSError:
+        # most likely EXDEV: source and target are on different filesystems
+        pass
+
+    tmp = target.with_name(f".{target.name}.tmp-{uuid.uuid4().hex}")
+    try:
+        if source.is_dir():
+            shutil.copytree(source, tmp, symlinks=True)
+        else:
+            shutil.copy2(source, tmp)
+        os.replace(tmp, target)
+    except Exception:
+        if tmp.exists():
+            _remove_path(tmp)
+        raise
+
+    return replaced
+
+
+class _FileLock:
+    """
+    the state of a lock file held by this process
+    """
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd: Optional[int] = None
+
+
+_file_locks: Dict[str, _FileLock] = {}
+_file_locks_guard = threading.Lock()
+
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a lock file, across processes and threads.
+    The lock is re-entrant within a thread.
+    :param path: The lock file, it is created when it does not exist.
+    """
+    path = Path(path).absolute()
+    with _file_locks_guard:
+        lock = _file_locks.setdefault(str(path), _FileLock())
+    with lock.thread_lock:
+        if lock.depth == 0 and fcntl:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger().info(f"waiting for another layermake run to release {path}")
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            lock.fd = fd
+        lock.depth += 1
+        try:
+            yield
+        finally:
+            lock.depth -= 1
+            if lock.depth == 0 and lock.fd is not None:
+                fcntl.flock(lock.fd, fcntl.LOCK_UN)
+                os.close(lock.fd)
+                lock.fd = None
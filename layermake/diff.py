@@ -0,0 +1,398 @@
+from typing import BinaryIO, Dict, List, NamedTuple, Tuple
+from pathlib import Path
+import urllib.request
+import zipfile
+import struct
+import re
+import io
+import boto3
+from .logger import logger
+
+# prefixes below which the first path component names a package
+_PACKAGE_ROOTS = [
+    re.compile(r"^python/lib/python[^/]+/site-packages/"),
+    re.compile(r"^python/"),
+    re.compile(r"^nodejs/node[^/]*/node_modules/"),
+    re.compile(r"^nodejs/node_modules/"),
+]
+
+_DIST_INFO = re.compile(r"^(.+?)-[^-]+\.(dist-info|egg-info)$")
+
+# end of central directory record, zip64 locator and record and central directory header
+_EOCD = struct.Struct("<4s4H2LH")
+_ZIP64_LOCATOR = struct.Struct("<4sLQL")
+_ZIP64_EOCD = struct.Struct("<4sQ2H2L4Q")
+# only the signature, flags, crc, sizes and name, extra and comment lengths
+_CD_HEADER = struct.Struct("<4s4xH6x3L3H12x")
+
+# bytes fetched per request beyond what zipfile asks for, the end of central directory
+# record and a small central directory are read in one request
+_READ_AHEAD = 1024 * 1024
+
+
+class ZipEntry(NamedTuple):
+    """
+    a file of a zip as listed by its central directory
+    """
+
+    name: str
+    size: int
+    compressed_size: int
+    crc: int
+
+
+class ChangedEntry(NamedTuple):
+    old: ZipEntry
+    new: ZipEntry
+
+
+class GroupDiff(NamedTuple):
+    """
+    the changes to one package or directory
+    """
+
+    name: str
+    added: int
+    removed: int
+    changed: int
+    size_delta: int
+    compressed_delta: int
+
+
+class LayerDiff(NamedTuple):
+    added: List[ZipEntry]
+    removed: List[ZipEntry]
+    changed: List[ChangedEntry]
+    groups: List[GroupDiff]
+    old_size: int
+    new_size: int
+    old_compressed_size: int
+    new_compressed_size: int
+
+
+class HttpRangeReader(io.RawIOBase):
+    """
+    a seekable read only file over HTTP that fetches only the ranges that are read
+    """
+
+    def __init__(self, url: str):
+        self.__url = url
+        self.__pos = 0
+        self.requests = 0
+        # presigned urls are only valid for GET, the size comes from the first range read
+        self.__buffer, self.__buffer_start, self.__size = self.__fetch(
+            f"-{_READ_AHEAD}"
+        )
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.__pos
+        elif whence == io.SEEK_END:
+            offset += self.__size
+        self.__pos = max(0, offset)
+        return self.__pos
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.__size - self.__pos
+        end = min(self.__pos + size, self.__size)
+        if end <= self.__pos:
+            return b""
+
+        buffer_end = self.__buffer_start + len(self.__buffer)
+        if not (self.__buffer_start <= self.__pos and end <= buffer_end):
+            fetch_end = min(self.__size, max(end, self.__pos + _READ_AHEAD))
+            self.__buffer, self.__buffer_start, _ = self.__fetch(
+                f"{self.__pos}-{fetch_end - 1}"
+            )
+
+        offset = self.__pos - self.__buffer_start
+        data = self.__buffer[offset : offset + (end - self.__pos)]
+        self.__pos += len(data)
+        return data
+
+    def __fetch(self, byte_range: str) -> Tuple[bytes, int, int]:
+        """
+        fetch a range of bytes
+        :return: The bytes, their offset and the size of the whole file.
+        """
+        req = urllib.request.Request(
+            self.__url, headers={"Range": f"bytes={byte_range}"}
+        )
+        self.requests += 1
+        with urllib.request.urlopen(req) as resp:
+            data = resp.read()
+            content_range = resp.headers.get("Content-Range")
+        if resp.status != 206 or not content_range:
+            # the server ignored the range and sent the whole file
+            return data, 0, len(data)
+        # e.g. "bytes 100-199/1000"
+        span, _, size = content_range.split(" ")[-1].partition("/")
+        return data, int(span.split("-")[0]), int(size)
+
+
+def read_entries(f: BinaryIO) -> Dict[str, ZipEntry]:
+    """
+    read the file entries of a zip from its central directory without extracting anything
+    """
+    f.seek(0, io.SEEK_END)
+    size = f.tell()
+    tail_size = min(size, _EOCD.size + 0xFFFF)
+    f.seek(size - tail_size)
+    tail = f.read(tail_size)
+    eocd = tail.rfind(b"PK\x05\x06")
+    if eocd < 0:
+        raise zipfile.BadZipFile("end of central directory record not found")
+    _, _, _, _, count, cd_size, cd_offset, _ = _EOCD.unpack_from(tail, eocd)
+
+    if 0xFFFFFFFF in (cd_size, cd_offset) or count == 0xFFFF:
+        locator = eocd - _ZIP64_LOCATOR.size
+        _, _, zip64_offset, _ = _ZIP64_LOCATOR.unpack_from(tail, locator)
+        f.seek(zip64_offset)
+        record = _ZIP64_EOCD.unpack(f.read(_ZIP64_EOCD.size))
+        count, cd_size, cd_offset = record[7], record[8], record[9]
+
+    f.seek(cd_offset)
+    cd = f.read(cd_size)
+    entries = {}
+    pos = 0
+    unpack = _CD_HEADER.unpack_from
+    header_size = _CD_HEADER.size
+    for _ in range(count):
+        (
+            sig,
+            flags,
+            crc,
+            compressed_size,
+            file_size,
+            name_len,
+            extra_len,
+            comment_len,
+        ) = unpack(cd, pos)
+        if sig != b"PK\x01\x02":
+            raise zipfile.BadZipFile("bad central directory entry")
+        pos += header_size
+        name = cd[pos : pos + name_len].decode("utf-8" if flags & 0x800 else "cp437")
+        if file_size == 0xFFFFFFFF or compressed_size == 0xFFFFFFFF:
+            file_size, compressed_size = _zip64_sizes(
+                cd[pos + name_len : pos + name_len + extra_len],
+                file_size,
+                compressed_size,
+            )
+        pos += name_len + extra_len + comment_len
+        if name[-1:] != "/":
+            entries[name] = ZipEntry(name, file_size, compressed_size, crc)
+    return entries
+
+
+def _zip64_sizes(extra: bytes, file_size: int, compressed_size: int) -> Tuple[int, int]:
+    """
+    the sizes of an entry from its zip64 extra field, which holds only the sizes that
+    did not fit in the central directory header
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, pos)
+        if header_id == 0x0001:
+            values = iter(struct.unpack_from(f"<{length // 8}Q", extra, pos + 4))
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = next(values)
+            break
+        pos += 4 + length
+    return file_size, compressed_size
+
+
+def published_layer_url(
+    ref: str, profile: str = None, region: str = None, endpoint_url: str = None
+) -> str:
+    """
+    the download url of a published layer version
+    :param ref: A layer version ARN or <layer name>:<version>.
+    """
+    session = boto3.Session(profile_name=profile) if profile else boto3.Session()
+    if ref.startswith("arn:"):
+        region = region or ref.split(":")[3]
+    client = session.client("lambda", region_name=region, endpoint_url=endpoint_url)
+    try:
+        if ref.startswith("arn:"):
+            resp = client.get_layer_version_by_arn(Arn=ref)
+        else:
+            name, _, version = ref.rpartition(":")
+            resp = client.get_layer_version(LayerName=name, VersionNumber=int(version))
+    except Exception as e:
+        logger().fatal_error(f"failed getting layer version {ref}: {str(e)}")
+    return resp["Content"]["Location"]
+
+
+def load_entries(
+    ref: str, profile: str = None, region: str = None, endpoint_url: str = None
+) -> Dict[str, ZipEntry]:
+    """
+    read the entries of a local layer zip or of a published layer version
+    :param ref: A path to a zip, a layer version ARN or <layer name>:<version>.
+    """
+    if Path(ref).is_file():
+        with open(ref, "rb") as f:
+            return read_entries(f)
+
+    if ":" not in ref:
+        logger().fatal_error(f"{ref} is neither a file nor a published layer version")
+
+    with logger().status(f"reading {ref}..."):
+        reader = HttpRangeReader(
+            published_layer_url(ref, profile, region, endpoint_url)
+        )
+        entries = read_entries(reader)
+        logger().debug(
+            f"read the central directory of {ref} in {reader.requests} requests"
+        )
+    return entries
+
+
+def group_name(name: str) -> str:
+    """
+    the package a file belongs to, or its top level directory outside package roots
+    """
+    for root in _PACKAGE_ROOTS:
+        match = root.match(name)
+        if match:
+            rest = name[match.end() :].split("/")
+            if rest[0].startswith("@") and len(rest) > 2:
+                return f"{rest[0]}/{rest[1]}"
+            if len(rest) == 1:
+                # top level module files, e.g. six.py
+                return rest[0].split(".")[0]
+            dist = _DIST_INFO.match(rest[0])
+            return dist.group(1) if dist else rest[0]
+    top, _, rest = name.partition("/")
+    return top if rest else "/"
+
+
+def diff_entries(old: Dict[str, ZipEntry], new: Dict[str, ZipEntry]) -> LayerDiff:
+    """
+    compare two zips by name, size and CRC-32 of their entries
+    """
+    added = [new[n] for n in sorted(new.keys() - old.keys())]
+    removed = [old[n] for n in sorted(old.keys() - new.keys())]
+    changed = [
+        ChangedEntry(old[n], new[n])
+        for n in sorted(old.keys() & new.keys())
+        if old[n].crc != new[n].crc or old[n].size != new[n].size
+    ]
+
+    groups: Dict[str, List[int]] = {}
+
+    def count(name: str, kind: int, size: int, compressed: int):
+        g = groups.setdefault(group_name(name), [0, 0, 0, 0, 0])
+        g[kind] += 1
+        g[3] += size
+        g[4] += compressed
+
+    for e in added:
+        count(e.name, 0, e.size, e.compressed_size)
+    for e in removed:
+        count(e.name, 1, -e.size, -e.compressed_size)
+    for c in changed:
+        count(
+            c.new.name,
+            2,
+            c.new.size - c.old.size,
+            c.new.compressed_size - c.old.compressed_size,
+        )
+
+    return LayerDiff(
+        added=added,
+        removed=removed,
+        changed=changed,
+        groups=sorted(
+            (GroupDiff(name, *g) for name, g in groups.items()),
+            key=lambda g: (-abs(g.size_delta), g.name),
+        ),
+        old_size=sum(e.size for e in old.values()),
+        new_size=sum(e.size for e in new.values()),
+        old_compressed_size=sum(e.compressed_size for e in old.values()),
+        new_compressed_size=sum(e.compressed_size for e in new.values()),
+    )
+
+
+def _size(size: int, signed: bool = False) -> str:
+    sign = ("+" if size > 0 else "-" if size < 0 else "") if signed else ""
+    size = abs(size)
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024 or unit == "MB":
+            break
+        size /= 1024
+    return f"{sign}{size:.0f} {unit}" if unit == "B" else f"{sign}{size:.1f} {unit}"
+
+
+def format_diff(diff: LayerDiff, files: bool = True) -> str:
+    """
+    render a diff as text
+    :param files: List every added, removed and changed file, not only the summary.
+    """
+    lines = []
+    if files:
+        lines += [f"+ {e.name} ({_size(e.size)})" for e in diff.added]
+        lines += [f"- {e.name} ({_size(e.size)})" for e in diff.removed]
+        lines += [
+            f"~ {c.new.name} ({_size(c.old.size)} -> {_size(c.new.size)})"
+            for c in diff.changed
+        ]
+        if lines:
+            lines.append("")
+
+    if diff.groups:
+        width = max(len("package"), *(len(g.name) for g in diff.groups))
+        lines.append(
+            f"{'package':<{width}}  {'added':>7}  {'removed':>7}  {'changed':>7}  "
+            f"{'size':>10}  {'zipped':>10}"
+        )
+        for g in diff.groups:
+            lines.append(
+                f"{g.name:<{width}}  {g.added:>7}  {g.removed:>7}  {g.changed:>7}  "
+                f"{_size(g.size_delta, True):>10}  {_size(g.compressed_delta, True):>10}"
+            )
+        lines.append("")
+
+    lines.append(
+        f"{len(diff.added)} added, {len(diff.removed)} removed, "
+        f"{len(diff.changed)} changed; "
+        f"size {_size(diff.old_size)} -> {_size(diff.new_size)} "
+        f"({_size(diff.new_size - diff.old_size, True)}), "
+        f"zipped {_size(diff.old_compressed_size)} -> {_size(diff.new_compressed_size)} "
+        f"({_size(diff.new_compressed_size - diff.old_compressed_size, True)})"
+    )
+    return "\n".join(lines)
+
+
+def diff_to_dict(diff: LayerDiff) -> dict:
+    return {
+        "added": [e._asdict() for e in diff.added],
+        "removed": [e._asdict() for e in diff.removed],
+        "changed": [
+            {
+                "name": c.new.name,
+                "old_size": c.old.size,
+                "new_size": c.new.size,
+                "old_compressed_size": c.old.compressed_size,
+                "new_compressed_size": c.new.compressed_size,
+            }
+            for c in diff.changed
+        ],
+        "groups": [g._asdict() for g in diff.groups],
+        "old_size": diff.old_size,
+        "new_size": diff.new_size,
+        "old_compressed_size": diff.old_compressed_size,
+        "new_compressed_size": diff.new_compressed_size,
+    }
@@ -0,0 +1,133 @@
+from typing import List, NamedTuple, Set
+from pathlib import Path
+import csv
+import os
+
+
+class LayerItem(NamedTuple):
+    """
+    a unit of layer content that has to stay together, e.g. a python distribution or a node module
+    """
+
+    name: str
+    files: List[Path]
+    size: int
+
+
+def _file_size(p: Path) -> int:
+    try:
+        return os.lstat(p).st_size
+    except OSError:
+        return 0
+
+
+def _walk_files(p: Path) -> List[Path]:
+    if not p.is_dir() or p.is_symlink():
+        return [p]
+
+    files = []
+    for root, dirs, names in os.walk(p):
+        root_path = Path(root)
+        files.extend(root_path / n for n in names)
+        # symlinked dirs are not followed by os.walk, keep them as entries
+        files.extend(root_path / d for d in dirs if (root_path / d).is_symlink())
+    return files
+
+
+def _item(name: str, files: List[Path]) -> LayerItem:
+    return LayerItem(name=name, files=files, size=sum(_file_size(f) for f in files))
+
+
+def dist_info_files(dist_info: Path, site_dir: Path) -> List[Path]:
+    """
+    list the files a distribution installed into site_dir according to its RECORD
+    :param dist_info: The .dist-info directory of the distribution.
+    :param site_dir: The directory the distribution was installed into.
+    """
+    record = dist_info / "RECORD"
+    if not record.is_file():
+        return _walk_files(dist_info)
+
+    site = site_dir.resolve()
+    files = []
+    with open(record, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            p = (site_dir / row[0]).resolve()
+            # skip console scripts and data files installed outside the site dir
+            if site not in p.parents or not p.exists():
+                continue
+            files.append(site_dir / p.relative_to(site))
+    return files
+
+
+def python_distributions(site_dir: Path) -> List[LayerItem]:
+    """
+    measure the installed size of every distribution in a pip --target directory.
+    Files that are not owned by any distribution (e.g. copied sources) are grouped
+    by their top level entry.
+    :param site_dir: The directory packages were installed into (the layer's python dir).
+    """
+    items = []
+    owned: Set[Path] = set()
+    for dist_info in sorted(site_dir.glob("*.dist-info")):
+        files = dist_info_files(dist_info, site_dir)
+        owned.update(files)
+        items.append(_item(dist_info.name[: -len(".dist-info")], files))
+
+    for entry in sorted(site_dir.iterdir()):
+        files = [f for f in _walk_files(entry) if f not in owned]
+        if files:
+            items.append(_item(entry.name, files))
+
+    return items
+
+
+def node_modules(node_modules_dir: Path) -> List[LayerItem]:
+    """
+    measure the installed size of every top level module in a node_modules directory.
+    Scoped packages (@scope/name) are measured individually.
+    :param node_modules_dir: The node_modules directory.
+    """
+    items = []
+    for entry in sorted(node_modules_dir.iterdir()):
+        if entry.name.startswith("@") and entry.is_dir():
+            for scoped in sorted(entry.iterdir()):
+                items.append(_item(f"{entry.name}/{scoped.name}", _walk_files(scoped)))
+            continue
+        items.append(_item(entry.name, _walk_files(entry)))
+    return items
+
+
+def top_level_modules(dist_info: Path, site_dir: Path) -> List[str]:
+    """
+    the importable top level modules of a distribution, from top_level.txt when
+    present and otherwise derived from the installed files
+    :param dist_info: The .dist-info directory of the distribution.
+    :param site_dir: The directory the distribution was installed into.
+    """
+    top_level = dist_info / "top_level.txt"
+    if top_level.is_file():
+        names = top_level.read_text().split()
+    else:
+        names = []
+        for f in dist_info_files(dist_info, site_dir):
+            first = f.relative_to(site_dir).parts[0]
+            if first.endswith(".py"):
+                names.append(first[: -len(".py")])
+            elif first.endswith(".so"):
+                names.append(first.split(".")[0])
+            elif (site_dir / first).is_dir() and not first.endswith(
+                (".dist-info", ".data")
+            ):
+                names.append(first)
+
+    # "bin" holds console scripts and private modules are implementation details
+    return sorted(
+        {
+            n.replace("/", ".")
+            for n in names
+            if n and n not in ("bin", "__pycache__") and not n.startswith("_")
+        }
+    )
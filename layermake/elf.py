@@ -0,0 +1,195 @@
+from typing import Dict, List, Tuple
+from pathlib import Path
+import tempfile
+from .split import format_size
+from .cache import lock, read_json, write_json
+from .cmd import docker_image_id, docker_run, rmtree
+from .logger import logger
+
+# the lambda base image whose libraries are not collected by default
+LAMBDA_RUNTIME_IMAGE = "public.ecr.aws/lambda/provided:al2023"
+
+_LIBRARY_DIRS = ["/lib64", "/usr/lib64", "/lib", "/usr/lib"]
+
+# runs inside the build container before OPTIMIZE_SCRIPT with the targets as arguments.
+# Copied libraries are written to collected as "<name> <bytes>", skipped ones to excluded.
+COLLECT_LIBS_SCRIPT = r"""#!/bin/bash
+set -euo pipefail
+root="$1"
+shift
+state="$root/.layermake"
+cd "$root"
+mkdir -p lib
+# libraries that are already part of the layer resolve from /opt/lib like on lambda
+export LD_LIBRARY_PATH="$root/lib${LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}"
+: > "$state/ldd"
+for target in "$@"; do
+  if [ ! -e "$target" ]; then
+    echo "collect-libs target $target does not exist" >&2
+    exit 1
+  fi
+  find -H "$target" -type f -print0 | while IFS= read -r -d '' f; do
+    # non ELF files and static executables have no dependencies
+    ldd "$f" >> "$state/ldd" 2>/dev/null || true
+  done
+done
+
+missing=$(awk '$2 == "=>" && $3 == "not" {print $1}' "$state/ldd" | sort -u)
+if [ -n "$missing" ]; then
+  echo "shared libraries not found in the build image:" $missing >&2
+  exit 1
+fi
+
+: > "$state/collected"
+: > "$state/excluded"
+awk '$2 == "=>" && $3 ~ /^\// {print $1, $3}' "$state/ldd" | sort -u   | while read -r name path; do
+    case "$path" in "$root"/*) continue ;; esac
+    if grep -qxF "$name" "$state/runtime-libs"; then
+      echo "$name" >> "$state/excluded"
+    elif [ ! -e "lib/$name" ]; then
+      cp -L "$path" "lib/$name"
+      echo "$name $(stat -c %s "lib/$name")" >> "$state/collected"
+    fi
+  done
+"""
+
+# runs inside the build container after the build command.
+# Every file that shrinks writes "<type> <bytes before> <bytes after>" to the report.
+OPTIMIZE_SCRIPT = r"""#!/bin/bash
+set -euo pipefail
+root="$1"
+state="$root/.layermake"
+export report="$state/optimize-report"
+: > "$report"
+jobs="$(nproc 2>/dev/null || echo 2)"
+
+file_type() {
+  case "$1" in
+    *.so|*.so.*) echo shared-library ;;
+    *.o) echo object ;;
+    *) echo executable ;;
+  esac
+}
+
+strip_file() {
+  local f="$1"
+  # only ELF files, identified by their magic bytes
+  [ "$(head -c 4 "$f" | od -An -c | tr -d ' \n')" = '177ELF' ] || return 0
+  local before mode
+  before=$(stat -c %s "$f")
+  mode=$(stat -c %a "$f")
+  chmod u+w "$f"
+  if strip --strip-debug -p "$f" 2>/dev/null; then
+    echo "$(file_type "$f") $before $(stat -c %s "$f")" >> "$report"
+  fi
+  chmod "$mode" "$f"
+}
+export -f file_type strip_file
+
+if [ "${STRIP:-1}" = 1 ]; then
+  find "$root" -path "$state" -prune -o -type f -print0 \
+    | xargs -0 -r -n 32 -P "$jobs" bash -c 'for f; do strip_file "$f"; done' _
+fi
+
+if [ "${DEDUP:-1}" = 1 ]; then
+  # hash after stripping, libraries that only differed in debug info are duplicates now
+  find "$root" -path "$state" -prune -o -type f \( -name '*.so' -o -name '*.so.*' \) -print0 \
+    | xargs -0 -r -n 32 -P "$jobs" sha256sum | sort > "$state/libs.sha256"
+  prev=""
+  canonical=""
+  while read -r sum path; do
+    if [ "$sum" = "$prev" ]; then
+      size=$(stat -c %s "$path")
+      # relative links stay valid wherever the layer is extracted
+      ln -sfr "$canonical" "$path"
+      echo "duplicate-library $size 0" >> "$report"
+    else
+      prev="$sum"
+      canonical="$path"
+    fi
+  done < "$state/libs.sha256"
+fi
+"""
+
+
+def runtime_libraries(image: str) -> List[str]:
+    """
+    the names of the shared libraries a lambda base image provides,
+    cached per image digest. Only this list is cached, the ldd walk over the built
+    binaries depends on the build and runs every time.
+    :param image: The lambda base image, e.g. public.ecr.aws/lambda/provided:al2023.
+    """
+    digest = docker_image_id(image)
+    key = ("runtime-libs", f"{digest.replace(':', '-')}.json")
+    cached = read_json(*key)
+    if cached is None:
+        # concurrent runs wait for the first one to list the image
+        with lock(*key):
+            cached = read_json(*key)
+            if cached is None:
+                names = _list_libraries(image)
+                write_json(names, *key)
+                return names
+    logger().debug(f"using cached library list of {image} ({digest})")
+    return cached
+
+
+def _list_libraries(image: str) -> List[str]:
+    with logger().status(f"listing libraries provided by {image}..."):
+        out = Path(tempfile.mkdtemp(prefix="layermake-"))
+        try:
+            docker_run(
+                container=image,
+                workdir="/",
+                volume=f"{out}:/out",
+                entrypoint="/bin/sh",
+                container_cmd=[
+                    "-c",
+                    f"ls -1 {' '.join(_LIBRARY_DIRS)} > /out/libs.txt 2>/dev/null; true",
+                ],
+            )
+            names = sorted(
+                {n for n in (out / "libs.txt").read_text().split() if ".so" in n}
+            )
+        finally:
+            rmtree(out)
+        logger().success(f"{image} provides {len(names)} libraries")
+    return names
+
+
+def log_collected(collected_path: Path, excluded_path: Path):
+    collected = [line.split() for line in collected_path.read_text().splitlines()]
+    excluded = excluded_path.read_text().split()
+    for name, size in collected:
+        logger().debug(f"collected {name} ({format_size(int(size))})")
+    logger().success(
+        f"collected {len(collected)} shared libraries "
+        f"({format_size(sum(int(size) for _, size in collected))}) into /opt/lib, "
+        f"{len(excluded)} are provided by the lambda runtime"
+    )
+
+
+def read_report(report_path: Path) -> Dict[str, Tuple[int, int, int]]:
+    """
+    read the report written by OPTIMIZE_SCRIPT
+    :return: The number of files and their total size before and after per file type.
+    """
+    totals: Dict[str, Tuple[int, int, int]] = {}
+    for line in report_path.read_text().splitlines():
+        kind, before, after = line.split()
+        files, b, a = totals.get(kind, (0, 0, 0))
+        totals[kind] = (files + 1, b + int(before), a + int(after))
+    return totals
+
+
+def log_savings(totals: Dict[str, Tuple[int, int, int]]):
+    saved = 0
+    for kind, (files, before, after) in sorted(totals.items()):
+        saved += before - after
+        logger().info(
+            f"{kind}: {files} files, {format_size(before)} -> {format_size(after)} "
+            f"(saved {format_size(before - after)})"
+        )
+    logger().success(
+        f"saved {format_size(saved)} by stripping and deduplicating ELF files"
+    )
@@ -0,0 +1,16 @@
+class LayermakeError(Exception):
+    """
+    raised instead of exiting when layermake is used as a library
+    """
+
+
+class BuildError(LayermakeError):
+    """
+    bundling a layer failed
+    """
+
+
+class PublishError(LayermakeError):
+    """
+    publishing a layer failed
+    """
@@ -0,0 +1,312 @@
+from typing import Dict, List, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import shutil
+import json
+import csv
+import os
+from .bundler import Bundler
+from .python import PYTHON_ECR_TEMPLATE, clean_cmds
+from .distributions import dist_info_files, top_level_modules
+from .archive import zip_files
+from .cmd import path_copy, docker_run
+from .provided import exclude_python_packages, python_requirement_names
+from .runtimes import PYTHON_PROVIDED_PACKAGES
+from .logger import logger
+
+# written by pip next to METADATA, they differ with how a distribution was requested
+_INSTALL_METADATA = {"INSTALLER", "REQUESTED", "direct_url.json", "RECORD"}
+
+_VERIFY_SCRIPT = """import importlib, json, sys
+failed = {}
+for name in sys.argv[2:]:
+    try:
+        importlib.import_module(name)
+    except BaseException as e:
+        failed[name] = f"{type(e).__name__}: {e}"
+with open(sys.argv[1], "w") as f:
+    json.dump(failed, f)
+"""
+
+
+def _link_files(files: List[Path], src_root: Path, dst_root: Path):
+    """
+    hard link files below src_root into the same relative location below dst_root,
+    falling back to copies when hard links are not possible
+    """
+    for f in files:
+        target = dst_root / f.relative_to(src_root)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if f.is_symlink():
+            shutil.copy2(f, target, follow_symlinks=False)
+            continue
+        try:
+            os.link(f, target)
+        except OSError:
+            shutil.copy2(f, target)
+
+
+def _installed_files(dist_info: Path) -> Optional[List[Tuple[str, ...]]]:
+    """
+    the sorted RECORD rows of a distribution without those of the files pip writes
+    about the install itself, e.g. REQUESTED only for directly requested distributions
+    """
+    record = dist_info / "RECORD"
+    if not record.is_file():
+        return None
+    with open(record, newline="", encoding="utf-8") as f:
+        return sorted(
+            tuple(row)
+            for row in csv.reader(f)
+            if row
+            and not (
+                row[0].startswith(f"{dist_info.name}/")
+                and row[0].split("/")[-1] in _INSTALL_METADATA
+            )
+        )
+
+
+class PythonFleetBundler(Bundler):
+    """
+    PythonFleetBundler builds several python layers together. Distributions that are
+    installed identically by every layer are moved into one shared base layer, the
+    remaining distributions stay in the layer that needs them.
+    """
+
+    def __init__(
+        self,
+        runtime: str,
+        definitions: Dict[str, str],
+        local_dir: Path,
+        base_name: str,
+        container: str = None,
+        no_zip: bool = False,
+        staging_dir: str = None,
+        exclude_provided: bool = True,
+    ):
+        """
+        :param definitions: The layers to build as a mapping of layer name to requirements file.
+        :param base_name: The name of the shared base layer.
+        :param exclude_provided: Remove the packages the lambda runtime provides, e.g.
+            boto3, and the dependencies only they need, unless a definition requests
+            them explicitly.
+        """
+        if base_name in definitions:
+            logger().fatal_error(
+                f"the base layer name {base_name} is also used by a layer definition"
+            )
+
+        for name, manifest in definitions.items():
+            if not Path(manifest).is_file():
+                logger().fatal_error(
+                    f"manifest {manifest} for layer {name} does not exist"
+                )
+
+        self.__definitions = {name: Path(m) for name, m in definitions.items()}
+        self.__base_name = base_name
+        self.__provided = (
+            PYTHON_PROVIDED_PACKAGES.get(runtime, ()) if exclude_provided else ()
+        )
+
+        if not container:
+            container = PYTHON_ECR_TEMPLATE.substitute(
+                runtime=runtime, version="latest"
+            )
+
+        super(PythonFleetBundler, self).__init__(
+            workdir="/opt",
+            container=container,
+            container_cmd="",
+            local_dir=local_dir,
+            no_zip=no_zip,
+            staging_dir=staging_dir,
+        )
+
+    def __install_dir(self, name: str) -> Path:
+        return self._local_path / ".install" / name
+
+    def pre_bundle(self):
+        manifests = self._local_path / ".manifests"
+        manifests.mkdir(parents=True, exist_ok=True)
+
+        container_cmds = []
+        for name, manifest in self.__definitions.items():
+            path_copy(manifest, manifests / f"{name}.txt")
+            target = f".install/{name}"
+            container_cmds.append(f"pip install -t {target} -r .manifests/{name}.txt")
+            container_cmds.extend(clean_cmds(target))
+
+        self._container_cmd = "; ".join(container_cmds)
+
+    def bundle_fleet(self) -> Dict[str, Path]:
+        """
+        bundle the shared base layer and every layer definition
+        :return: The bundled layers keyed by layer name, starting with the shared base
+            layer when any distributions are shared.
+        """
+        try:
+            self._build(zip_layer=False)
+            if self.__provided:
+                for name in self.__definitions:
+                    exclude_python_packages(
+                        self.__install_dir(name),
+                        self.__provided,
+                        python_requirement_names(
+                            [], [self._local_path / ".manifests" / f"{name}.txt"]
+                        ),
+                    )
+            with logger().status("finding shared distributions..."):
+                shared = self.__shared_distributions()
+            if shared:
+                logger().success(
+                    f"{len(shared)} distributions are shared: {', '.join(sorted(shared))}"
+                )
+            else:
+                logger().warn("the layer definitions do not share any distributions")
+
+            with logger().status("splitting layers..."):
+                trees = self.__split_trees(shared)
+            self.__verify(trees)
+
+            names = list(trees.keys())
+            if self.no_zip:
+                artifacts = [trees[n] for n in names]
+            else:
+                with logger().status("zipping layers..."):
+                    artifacts = [self._local_path / f"{n}.zip" for n in names]
+                    with ThreadPoolExecutor() as pool:
+                        list(
+                            pool.map(
+                                lambda tree, zip_path: zip_files(
+                                    tree,
+                                    [f for f in (tree / "python").rglob("*")],
+                                    zip_path,
+                                ),
+                                [trees[n] for n in names],
+                                artifacts,
+                            )
+                        )
+
+            outputs = self._finish(artifacts)
+        finally:
+            self._cleanup()
+
+        return dict(zip(names, outputs))
+
+    def __shared_distributions(self) -> Set[str]:
+        """
+        the .dist-info names of distributions with an identical RECORD in every definition
+        """
+        records: Dict[str, List[Optional[List[Tuple[str, ...]]]]] = {}
+        for name in self.__definitions:
+            for dist_info in self.__install_dir(name).glob("*.dist-info"):
+                records.setdefault(dist_info.name, []).append(
+                    _installed_files(dist_info)
+                )
+
+        return {
+            dist
+            for dist, found in records.items()
+            if len(found) == len(self.__definitions)
+            and found[0] is not None
+            and all(r == found[0] for r in found)
+        }
+
+    def __split_trees(self, shared: Set[str]) -> Dict[str, Path]:
+        """
+        link every layer's files into <name>/python trees
+        """
+        trees = {}
+        first = self.__install_dir(next(iter(self.__definitions)))
+        if shared:
+            base_files = [
+                f for d in sorted(shared) for f in dist_info_files(first / d, first)
+            ]
+            trees[self.__base_name] = self._local_path / self.__base_name
+            _link_files(base_files, first, trees[self.__base_name] / "python")
+
+        for name in self.__definitions:
+            install_dir = self.__install_dir(name)
+            shared_files = {
+                f for d in shared for f in dist_info_files(install_dir / d, install_dir)
+            }
+            files = [
+                f
+                for f in install_dir.rglob("*")
+                if (f.is_file() or f.is_symlink()) and f not in shared_files
+            ]
+            trees[name] = self._local_path / name
+            _link_files(files, install_dir, trees[name] / "python")
+
+        return trees
+
+    def __verify(self, trees: Dict[str, Path]):
+        """
+        import every top level module of each definition with the base and specific
+        layer stacked and fail if anything that imported from the full install no longer does
+        """
+        verify_dir = self._local_path / ".verify"
+        verify_dir.mkdir(parents=True, exist_ok=True)
+        (verify_dir / "verify_imports.py").write_text(_VERIFY_SCRIPT)
+
+        modules = {}
+        container_cmds = []
+        for name in self.__definitions:
+            install_dir = self.__install_dir(name)
+            stacked = verify_dir / name / "python"
+            for tree in [trees.get(self.__base_name), trees[name]]:
+                if tree:
+                    _link_files(
+                        [f for f in (tree / "python").rglob("*") if not f.is_dir()],
+                        tree / "python",
+                        stacked,
+                    )
+            stacked.mkdir(parents=True, exist_ok=True)
+
+            modules[name] = sorted(
+                {
+                    m
+                    for d in install_dir.glob("*.dist-info")
+                    for m in top_level_modules(d, install_dir)
+                }
+            )
+            mods = " ".join(modules[name])
+            container_cmds.append(
+                f"PYTHONPATH=.install/{name} python .verify/verify_imports.py "
+                f".verify/{name}-installed.json {mods}"
+            )
+            container_cmds.append(
+                f"PYTHONPATH=.verify/{name}/python python .verify/verify_imports.py "
+                f".verify/{name}-stacked.json {mods}"
+            )
+
+        with logger().status("verifying stacked layers import cleanly..."):
+            try:
+                docker_run(
+                    container=self._container,
+                    workdir="/opt",
+                    volume=f"{self._local_path.absolute()}:/opt",
+                    container_cmd=["/bin/bash", "-c", " && ".join(container_cmds)],
+                )
+            except Exception as e:
+                logger().fatal_error(f"failed verifying layers: {str(e)}")
+
+            for name in self.__definitions:
+                installed = json.loads(
+                    (verify_dir / f"{name}-installed.json").read_text()
+                )
+                stacked = json.loads((verify_dir / f"{name}-stacked.json").read_text())
+                for module, err in installed.items():
+                    logger().debug(
+                        f"{name}: {module} does not import on its own: {err}"
+                    )
+                broken = {m: e for m, e in stacked.items() if m not in installed}
+                if broken:
+                    logger().fatal_error(
+                        f"layer {name} does not import cleanly when stacked on "
+                        f"{self.__base_name}: "
+                        + "; ".join(f"{m} ({e})" for m, e in broken.items())
+                    )
+                logger().success(
+                    f"{name}: {len(modules[name]) - len(installed)} modules import cleanly"
+                )
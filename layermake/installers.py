@@ -0,0 +1,118 @@
+from typing import Dict, List
+from pathlib import Path
+import tempfile
+from .cache import cache_dir, lock
+from .cmd import docker_build, docker_image_exists, docker_image_id, rmtree
+from .logger import logger
+
+# the uv release installed into derived build images, part of their tag
+UV_VERSION = "0.5.11"
+
+# where the host uv cache dir is mounted in the build container
+CONTAINER_UV_CACHE_DIR = "/uv-cache"
+
+
+class Installer:
+    """
+    Installer installs python distributions into a target dir inside the build container
+    with pip
+    """
+
+    name = "pip"
+
+    def image(self, base_image: str) -> str:
+        """
+        the image to build with, the base image itself for pip
+        :param base_image: The python build image.
+        """
+        return base_image
+
+    def volumes(self) -> List[str]:
+        """
+        extra volumes mounted into the build container
+        """
+        return []
+
+    def env(self) -> Dict[str, str]:
+        """
+        extra environment of the build container
+        """
+        return {}
+
+    def install_cmd(self, target: str, args: List[str]) -> str:
+        """
+        the container command installing into target
+        :param target: The install target relative to the workdir, e.g. python.
+        :param args: Requirement specifiers, local paths and -r <file> arguments.
+        """
+        return f"pip install -t {target} " + " ".join(args)
+
+
+class UvInstaller(Installer):
+    """
+    UvInstaller resolves and installs with uv, which is installed into a derived
+    image of the build image on first use. Its download cache persists on the host.
+    """
+
+    name = "uv"
+
+    def image(self, base_image: str) -> str:
+        # the tag changes whenever the base image is updated
+        base_id = docker_image_id(base_image).split(":")[-1]
+        tag = f"layermake-uv:{UV_VERSION}-{base_id[:12]}"
+        if docker_image_exists(tag):
+            logger().debug(f"using cached uv image {tag}")
+            return tag
+
+        # concurrent runs wait for the first one to build the image
+        with lock("images", tag.replace(":", "-")):
+            if not docker_image_exists(tag):
+                self.__build_image(base_image, tag)
+        return tag
+
+    @staticmethod
+    def __build_image(base_image: str, tag: str):
+        with logger().status(f"installing uv {UV_VERSION} into {base_image}..."):
+            ctx = Path(tempfile.mkdtemp(prefix="layermake-"))
+            try:
+                dockerfile = ctx / "Dockerfile"
+                dockerfile.write_text(
+                    f"FROM {base_image}\n"
+                    f"RUN pip install --no-cache-dir uv=={UV_VERSION}\n"
+                    # the cache is on another filesystem, hard links would fail
+                    f"ENV UV_LINK_MODE=copy\n"
+                )
+                docker_build(str(dockerfile), str(ctx), tag=tag)
+            finally:
+                rmtree(ctx)
+            logger().success(f"built {tag}")
+
+    def volumes(self) -> List[str]:
+        host_cache = cache_dir() / "uv"
+        host_cache.mkdir(parents=True, exist_ok=True)
+        return [f"{host_cache}:{CONTAINER_UV_CACHE_DIR}"]
+
+    def env(self) -> Dict[str, str]:
+        return {"UV_CACHE_DIR": CONTAINER_UV_CACHE_DIR}
+
+    def install_cmd(self, target: str, args: List[str]) -> str:
+        # --target installs the same flat layout as pip -t
+        return (
+            f'uv pip install --python "$(command -v python)" --target {target} '
+            + " ".join(args)
+        )
+
+
+INSTALLERS: Dict[str, Installer] = {i.name: i for i in [Installer(), UvInstaller()]}
+
+
+def get_installer(name: str) -> Installer:
+    """
+    the installer engine of a name
+    :param name: One of INSTALLERS, e.g. pip or uv.
+    """
+    if name not in INSTALLERS:
+        logger().fatal_error(
+            f"unknown installer {name}, expected one of {', '.join(INSTALLERS)}"
+        )
+    return INSTALLERS[name]
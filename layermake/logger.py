@@ -1,6 +1,11 @@
 import sys
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
 from rich.console import Console
-from typing import Any
+from typing import Any, Callable, Optional
+from .errors import LayermakeError
 
 
 class QuietStatus:
@@ -25,17 +30,29 @@ class QuietStatus:
         pass
 
 
-class _Logger:
-    """global context object to be initialized at beginning of program with set_ctx()"""
+class Logger:
+    """
+    logs progress to a rich console. The CLI installs one globally with set_logger(),
+    library callers can scope their own to a block of code with use_logger().
+    """
 
-    def __init__(self, verbose: bool, quiet: bool):
+    def __init__(
+        self,
+        verbose: bool = False,
+        quiet: bool = False,
+        console: Console = None,
+        raise_errors: bool = False,
+    ):
         """
         :param verbose: Whether to enable verbose logging.
         :param quiet: Whether to suppress all INFO and debug level logging.
+        :param console: The console to log to, defaults to stdout.
+        :param raise_errors: Raise LayermakeError on fatal errors instead of exiting.
         """
         self._verbose = verbose
         self._quiet = quiet
-        self._rc = Console(log_path=False, log_time_format="[%X.%f] ")
+        self._raise_errors = raise_errors
+        self._rc = console or Console(log_path=False, log_time_format="[%X.%f] ")
 
     @property
     def verbose(self):
@@ -52,6 +69,8 @@ class _Logger:
 
     def fatal_error(self, msg: str, **kwargs):
         self._rc.log(f"[bold red]{msg}", **kwargs)
+        if self._raise_errors or _raise_errors.get():
+            raise LayermakeError(msg)
         sys.exit(1)
 
     def info(self, *objects: Any, **kwargs):
@@ -73,17 +92,92 @@ class _Logger:
             self.info(*objects, **kwargs)
 
 
-# singleton
+class LoggingAdapter(Logger):
+    """
+    forwards layermake's output to a standard library logger
+    """
+
+    def __init__(self, log: logging.Logger, raise_errors: bool = True):
+        super(LoggingAdapter, self).__init__(
+            verbose=log.isEnabledFor(logging.DEBUG), raise_errors=raise_errors
+        )
+        self.__log = log
+
+    def status(self, status_text: str, log_text: bool = False, **kwargs):
+        self.__log.info(status_text)
+        return QuietStatus()
+
+    def fatal_error(self, msg: str, **kwargs):
+        self.__log.error(msg)
+        if self._raise_errors or _raise_errors.get():
+            raise LayermakeError(msg)
+        sys.exit(1)
+
+    def info(self, *objects: Any, **kwargs):
+        self.__log.info(" ".join(str(o) for o in objects))
+
+    def error(self, msg: Any, **kwargs):
+        self.__log.error(msg)
+
+    def success(self, msg: Any, **kwargs):
+        self.__log.info(msg)
+
+    def warn(self, msg: Any, **kwargs):
+        self.__log.warning(msg)
+
+    def debug(self, *objects: Any, **kwargs):
+        self.__log.debug(" ".join(str(o) for o in objects))
+
+
+# singleton used by the CLI
 _logger = None
 
+# set by use_logger, takes precedence over the singleton in the current context
+_context_logger: ContextVar[Optional[Logger]] = ContextVar("logger", default=None)
+_raise_errors: ContextVar[bool] = ContextVar("raise_errors", default=False)
+
 
 def set_logger(verbose: bool, quiet: bool):
     global _logger
     if verbose:
         print("verbose output enabled")
-    _logger = _Logger(verbose, quiet)
-
-
-def logger() -> _Logger:
-    assert _logger
-    return _logger
+    _logger = Logger(verbose, quiet)
+
+
+@contextmanager
+def use_logger(log: Logger, raise_errors: bool = False):
+    """
+    use a logger for everything called within the block, including in threads started
+    through with_logger. Concurrent blocks in other threads or tasks keep their own logger.
+    :param log: The logger to use.
+    :param raise_errors: Raise LayermakeError on fatal errors even if the logger would exit.
+    """
+    logger_token = _context_logger.set(log)
+    raise_token = _raise_errors.set(raise_errors or _raise_errors.get())
+    try:
+        yield log
+    finally:
+        _raise_errors.reset(raise_token)
+        _context_logger.reset(logger_token)
+
+
+def with_logger(fn: Callable) -> Callable:
+    """
+    bind the current logger to fn so that it is used when fn runs in another thread,
+    which does not inherit context variables
+    """
+    log = logger()
+    raise_errors = _raise_errors.get()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with use_logger(log, raise_errors):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def logger() -> Logger:
+    log = _context_logger.get() or _logger
+    assert log
+    return log
@@ -0,0 +1,279 @@
+from typing import Dict, List, NamedTuple, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+import posixpath
+import shutil
+import shlex
+import json
+import os
+from .bundler import Bundler
+from .python import PYTHON_ECR_TEMPLATE, clean_cmds
+from .archive import zip_files
+from .cmd import docker_run
+from .provided import exclude_python_packages, python_requirement_names
+from .runtimes import PYTHON_PROVIDED_PACKAGES
+from .logger import logger, with_logger
+
+
+class ResolvedArtifact(NamedTuple):
+    """
+    a distribution pip resolved for a runtime and the exact artifact it selected
+    """
+
+    name: str
+    version: str
+    requirement: str
+    # a wheel that installs identically for every python version
+    portable: bool
+
+
+def _portable_wheel(url: str) -> bool:
+    """
+    whether an artifact is a pure python or abi3 wheel. Sdists, VCS checkouts and local
+    directories are built by the interpreter that installs them.
+    """
+    filename = posixpath.basename(unquote(urlparse(url).path))
+    if not filename.endswith(".whl"):
+        return False
+    # {name}-{version}(-{build})?-{python tag}-{abi tag}-{platform tag}.whl
+    parts = filename[: -len(".whl")].split("-")
+    if len(parts) < 5:
+        return False
+    abi, platform = parts[-2], parts[-1]
+    return (abi == "none" and platform == "any") or "abi3" in abi.split(".")
+
+
+def _resolved_artifacts(report_path: Path) -> List[ResolvedArtifact]:
+    """
+    read the artifacts selected by pip from a pip install --report file
+    """
+    with open(report_path) as f:
+        report = json.load(f)
+
+    artifacts = []
+    for item in report.get("install", []):
+        info = item["download_info"]
+        url = info["url"]
+        portable = "vcs_info" not in info and _portable_wheel(url)
+        if "vcs_info" in info:
+            vcs = info["vcs_info"]
+            url = f"{vcs['vcs']}+{url}@{vcs['commit_id']}"
+        name = item["metadata"]["name"]
+        artifacts.append(
+            ResolvedArtifact(
+                name=name,
+                version=item["metadata"]["version"],
+                requirement=f"{name} @ {url}",
+                portable=portable,
+            )
+        )
+    return artifacts
+
+
+def _link_tree(src: Path, dst: Path):
+    """
+    hard link every file of src into dst, falling back to copies
+    """
+    for root, _, names in os.walk(src):
+        target_dir = dst / Path(root).relative_to(src)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        for n in names:
+            try:
+                os.link(Path(root) / n, target_dir / n, follow_symlinks=False)
+            except OSError:
+                shutil.copy2(Path(root) / n, target_dir / n, follow_symlinks=False)
+
+
+class MultiRuntimePythonBundler(Bundler):
+    """
+    MultiRuntimePythonBundler builds the same requirements for several python runtimes.
+    The requirements are resolved for every runtime concurrently. Pure python and abi3 wheels
+    that pip selects identically for every runtime are installed once, sdists and every
+    other distribution are installed in each runtime's image.
+    """
+
+    def __init__(
+        self,
+        runtimes: List[str],
+        local_dir: Path,
+        packages: List[str] = None,
+        manifest: str = None,
+        no_zip: bool = False,
+        staging_dir: str = None,
+        exclude_provided: bool = True,
+    ):
+        """
+        :param runtimes: The python versions to build for, e.g. 3.11.
+        :param exclude_provided: Remove the packages the lambda runtimes provide, e.g.
+            boto3, and the dependencies only they need, unless requested explicitly.
+        """
+        self.__runtimes = list(runtimes)
+        self.__exclude_provided = exclude_provided
+        self.__packages = packages
+        self.__manifest = manifest
+        super(MultiRuntimePythonBundler, self).__init__(
+            workdir="/opt",
+            container_cmd="",
+            local_dir=local_dir,
+            build_artifact=manifest,
+            no_zip=no_zip,
+            staging_dir=staging_dir,
+        )
+
+    @staticmethod
+    def __container(runtime: str) -> str:
+        return PYTHON_ECR_TEMPLATE.substitute(runtime=runtime, version="latest")
+
+    def __run(self, runtime: str, cmd: str):
+        try:
+            docker_run(
+                container=self.__container(runtime),
+                workdir="/opt",
+                volume=f"{self._local_path.absolute()}:/opt",
+                container_cmd=["/bin/bash", "-c", cmd],
+            )
+        except Exception as e:
+            logger().fatal_error(f"failed bundling layer for python{runtime}: {str(e)}")
+
+    def __resolve(self, runtime: str) -> List[ResolvedArtifact]:
+        requirements = ""
+        if self.__manifest:
+            requirements += f" -r {shlex.quote(Path(self.__manifest).name)}"
+        if self.__packages:
+            requirements += " " + " ".join(shlex.quote(p) for p in self.__packages)
+
+        report = f".reports/{runtime}.json"
+        cmd = f"pip install -q --dry-run --ignore-installed --report {report}{requirements}"
+        # --report needs pip >= 22.2
+        self.__run(
+            runtime,
+            f"mkdir -p .reports && ({cmd} || (pip install -q -U 'pip>=22.2' && {cmd}))",
+        )
+        return _resolved_artifacts(self._local_path / report)
+
+    def __install(self, runtime: str, target: str, artifacts: List[ResolvedArtifact]):
+        if not artifacts:
+            (self._local_path / target).mkdir(parents=True, exist_ok=True)
+            return
+        requirements = " ".join(shlex.quote(a.requirement) for a in artifacts)
+        cmd = f"pip install --no-deps -t {target} {requirements}"
+        self.__run(runtime, " && ".join([cmd] + clean_cmds(target)))
+
+    def __exclude_provided_packages(self, tree: Path, runtimes: List[str]):
+        """
+        remove what every runtime of a layer tree provides from it
+        """
+        provided = set.intersection(
+            *(set(PYTHON_PROVIDED_PACKAGES.get(rt, ())) for rt in runtimes)
+        )
+        files = (
+            [self._local_path / Path(self.__manifest).name] if self.__manifest else []
+        )
+        exclude_python_packages(
+            tree / "python",
+            sorted(provided),
+            python_requirement_names(self.__packages or [], files),
+        )
+
+    def bundle_runtimes(self) -> List[Tuple[Path, List[str]]]:
+        """
+        bundle the layer for every runtime
+        :return: One layer compatible with every runtime when all runtimes resolved to
+            the same artifacts, otherwise one layer per runtime, with the runtime names
+            each layer is compatible with.
+        """
+        try:
+            self.pre_bundle()
+            with logger().status(
+                f"resolving requirements for {len(self.__runtimes)} runtimes..."
+            ):
+                with ThreadPoolExecutor(max_workers=len(self.__runtimes)) as pool:
+                    resolved: Dict[str, List[ResolvedArtifact]] = dict(
+                        zip(
+                            self.__runtimes,
+                            pool.map(with_logger(self.__resolve), self.__runtimes),
+                        )
+                    )
+
+            # only wheels that do not depend on the interpreter can be built once
+            shared = {
+                a
+                for a in set.intersection(*(set(a) for a in resolved.values()))
+                if a.portable
+            }
+            specific = {
+                rt: [a for a in artifacts if a not in shared]
+                for rt, artifacts in resolved.items()
+            }
+            logger().info(
+                f"{len(shared)} distributions are shared by all runtimes: "
+                f"{', '.join(sorted(a.name for a in shared))}"
+            )
+            for rt, artifacts in specific.items():
+                logger().info(
+                    f"python{rt} needs {len(artifacts)} runtime specific distributions: "
+                    f"{', '.join(a.name for a in artifacts)}"
+                )
+
+            with logger().status("installing distributions..."):
+                # the shared install and every runtime specific install run concurrently
+                jobs = [(self.__runtimes[0], ".shared/python", sorted(shared))] + [
+                    (rt, f".runtime/{rt}/python", specific[rt])
+                    for rt in self.__runtimes
+                    if specific[rt]
+                ]
+                with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+                    for f in [
+                        pool.submit(with_logger(self.__install), *job) for job in jobs
+                    ]:
+                        f.result()
+                logger().success("distributions installed")
+
+            runtime_names = [f"python{rt}" for rt in self.__runtimes]
+            if not any(specific.values()):
+                logger().info("all runtimes share the same tree, bundling one layer")
+                layers = [("layer", self._local_path / ".shared", runtime_names)]
+            else:
+                logger().info("runtime trees differ, bundling one layer per runtime")
+                layers = []
+                for rt in self.__runtimes:
+                    tree = self._local_path / f"python{rt}"
+                    _link_tree(self._local_path / ".shared", tree)
+                    if specific[rt]:
+                        _link_tree(self._local_path / ".runtime" / rt, tree)
+                    layers.append((f"layer-python{rt}", tree, [f"python{rt}"]))
+
+            if self.__exclude_provided:
+                for _, tree, layer_runtimes in layers:
+                    self.__exclude_provided_packages(
+                        tree, [rt.replace("python", "") for rt in layer_runtimes]
+                    )
+
+            if self.no_zip:
+                artifacts = []
+                for name, tree, _ in layers:
+                    if tree.name != name:
+                        tree = tree.rename(self._local_path / name)
+                    artifacts.append(tree)
+            else:
+                with logger().status("zipping layers..."):
+                    artifacts = [
+                        self._local_path / f"{name}.zip" for name, _, _ in layers
+                    ]
+                    with ThreadPoolExecutor() as pool:
+                        list(
+                            pool.map(
+                                lambda tree, zip_path: zip_files(
+                                    tree, list((tree / "python").rglob("*")), zip_path
+                                ),
+                                [tree for _, tree, _ in layers],
+                                artifacts,
+                            )
+                        )
+
+            outputs = self._finish(artifacts)
+        finally:
+            self._cleanup()
+
+        return list(zip(outputs, [runtimes for _, _, runtimes in layers]))
@@ -1,9 +1,31 @@
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 from string import Template
 from pathlib import Path
-from .bundler import Bundler
+from .bundler import Bundler, EXPORT_METADATA_DIR
 from .logger import logger
 from .cmd import path_copy
+from .archive import zip_files
+from .distributions import LayerItem, node_modules
+from .prune import (
+    DEFAULT_PRUNE_RULES,
+    PruneRule,
+    prune_rule,
+    prune_tree,
+    log_pruned,
+)
+from .provided import (
+    excluded_packages,
+    log_excluded,
+    node_dependency_names,
+    node_packages,
+    path_owner,
+    path_owners,
+    remove_packages,
+)
+from .runtimes import NODEJS_PROVIDED_PACKAGES
+
+# the prefix of node_modules in the names of files streamed out in export mode
+_NODE_MODULES = "nodejs/node_modules/"
 
 NODE_ECR_TEMPLATE = Template("public.ecr.aws/sam/build-nodejs${runtime}:${version}")
 
@@ -22,7 +44,45 @@ class NodeBundler(Bundler):
         packages: List[str] = None,
         manifest: str = None,
         no_zip: bool = False,
+        staging_dir: str = None,
+        dev_dependencies: bool = False,
+        prune: bool = True,
+        prune_globs: List[str] = None,
+        prune_keep: List[str] = None,
+        export: bool = False,
+        profile_resources: bool = False,
+        exclude_provided: bool = True,
     ):
+        """
+        :param dev_dependencies: Also install devDependencies.
+        :param prune: Remove files that are not needed at runtime from node_modules.
+        :param prune_globs: Additional glob patterns to prune.
+        :param prune_keep: Glob patterns that are never pruned.
+        :param export: Build in the container's filesystem and stream the layer out,
+            pruning while streaming.
+        :param profile_resources: Sample the resource usage of the build container.
+        :param exclude_provided: Remove the modules the lambda runtime provides, e.g.
+            aws-sdk, and the dependencies only they need, unless requested explicitly.
+        """
+        self.__runtime = runtime
+        self.__provided = (
+            NODEJS_PROVIDED_PACKAGES.get(runtime, ()) if exclude_provided else ()
+        )
+        # paths of the excluded modules and what was removed in export mode
+        self.__excluded_owners: Dict[str, str] = {}
+        self.__excluded: Dict[str, Tuple[int, int]] = {}
+        self.__dev_dependencies = dev_dependencies
+        self.__prune_rules = []
+        if prune:
+            self.__prune_rules = list(DEFAULT_PRUNE_RULES)
+            if prune_globs:
+                self.__prune_rules.append(
+                    PruneRule(
+                        "custom", files=tuple(prune_globs), dirs=tuple(prune_globs)
+                    )
+                )
+        self.__prune_keep = prune_keep
+        self.__pruned: Dict[str, Tuple[int, int]] = {}
         self.__manifest = manifest
         self.__packages = packages
         self.__artifact_dir = Path(artifact_dir) if artifact_dir else None
@@ -37,12 +97,136 @@ class NodeBundler(Bundler):
             local_dir=local_dir,
             build_artifact=manifest,
             no_zip=no_zip,
+            staging_dir=staging_dir,
+            export=export,
+            profile_resources=profile_resources,
+        )
+
+    def layer_items(self) -> List[LayerItem]:
+        return node_modules(self._local_path / "nodejs" / "node_modules")
+
+    def layer_dir(self) -> Path:
+        return self._local_path / "nodejs"
+
+    def _source_targets(self, rel: Path) -> List[Path]:
+        if not self.__artifact_dir or not is_package(self.__artifact_dir):
+            return []
+        name = self.__artifact_dir.name
+        return [
+            self.layer_dir() / name / rel,
+            self.layer_dir() / "node_modules" / name / rel,
+        ]
+
+    def __install_flags(self) -> str:
+        if self.__dev_dependencies:
+            return ""
+        # --omit was added in npm 7, which ships with nodejs 16
+        major = self.__runtime.split(".")[0]
+        if major.isdigit() and int(major) < 16:
+            return " --production"
+        return " --omit=dev"
+
+    def _build(self, zip_layer: bool):
+        if not self.__prune_rules and not self.__provided:
+            return super(NodeBundler, self)._build(zip_layer)
+
+        if self.export:
+            # excluded and pruned while the layer is streamed out of the container
+            self.__pruned = {rule.name: (0, 0) for rule in self.__prune_rules}
+            super(NodeBundler, self)._build(zip_layer)
+            if self.__excluded:
+                log_excluded(self.__excluded)
+            if self.__prune_rules:
+                log_pruned(self.__pruned)
+            return
+
+        # exclude and prune on the host between installing and zipping
+        super(NodeBundler, self)._build(zip_layer=False)
+        node_dir = self._local_path / "nodejs"
+        node_modules_dir = node_dir / "node_modules"
+        if node_modules_dir.is_dir():
+            if self.__provided:
+                self.__exclude_provided(node_modules_dir)
+            if self.__prune_rules:
+                with logger().status("pruning node_modules..."):
+                    log_pruned(
+                        prune_tree(
+                            node_modules_dir, self.__prune_rules, self.__prune_keep
+                        )
+                    )
+
+        if zip_layer:
+            with logger().status("zipping layer..."):
+                zip_files(
+                    self._local_path,
+                    node_dir.rglob("*"),
+                    self._local_path / "layer.zip",
+                )
+                logger().success("layer zipped")
+
+    def __requested(self) -> Set[str]:
+        """
+        the modules requested explicitly, which are never excluded
+        """
+        manifests = []
+        if self.__manifest:
+            manifests.append(self._local_path / Path(self.__manifest).name)
+        if self.__artifact_dir:
+            manifests.append(self.__artifact_dir / "package.json")
+        return node_dependency_names(
+            self.__packages or [], manifests, self.__dev_dependencies
         )
 
+    def __exclude_provided(self, node_modules_dir: Path):
+        packages = node_packages(node_modules_dir)
+        names = excluded_packages(packages, self.__provided, self.__requested())
+        if names:
+            with logger().status("excluding modules provided by the lambda runtime..."):
+                log_excluded(remove_packages(node_modules_dir, packages, names))
+
+    def _export_metadata_cmd(self) -> Optional[str]:
+        if not self.__provided:
+            return None
+        return (
+            "[ ! -d nodejs/node_modules ] || find nodejs/node_modules -mindepth 2 "
+            "-maxdepth 3 -name package.json "
+            f"-exec cp --parents {{}} {EXPORT_METADATA_DIR}/ \\;"
+        )
+
+    def _read_export_metadata(self, metadata_dir: Path):
+        node_modules_dir = metadata_dir / "nodejs" / "node_modules"
+        if not node_modules_dir.is_dir():
+            return
+        packages = node_packages(node_modules_dir)
+        names = excluded_packages(packages, self.__provided, self.__requested())
+        self.__excluded_owners = path_owners(packages, names)
+        self.__excluded = {name: (0, 0) for name in names}
+
+    def _export_include(self, name: str, size: int) -> bool:
+        # the copied manifest and sources next to nodejs/ are not part of the layer
+        if not name.startswith("nodejs/"):
+            return False
+        if not name.startswith(_NODE_MODULES):
+            return True
+        rel = name[len(_NODE_MODULES) :]
+        owner = path_owner(rel, self.__excluded_owners)
+        if owner:
+            files, total = self.__excluded[owner]
+            self.__excluded[owner] = (files + 1, total + size)
+            return False
+        if not self.__prune_rules:
+            return True
+        rule = prune_rule(rel, self.__prune_rules, self.__prune_keep)
+        if not rule:
+            return True
+        files, total = self.__pruned[rule.name]
+        self.__pruned[rule.name] = (files + 1, total + size)
+        return False
+
     def pre_bundle(self):
         node_dir = self._local_path / "nodejs"
         try:
-            node_dir.mkdir(parents=True)
+            node_dir.mkdir(parents=True, exist_ok=True)
         except Exception as e:
             logger().fatal_error(f"failed to create directory {node_dir} Error: {e}")
 
@@ -61,7 +245,7 @@ class NodeBundler(Bundler):
                 path_copy(package_src, package_target)
                 container_cmds.append(
                     f"pushd nodejs/node_modules/{package_target.name};"
-                    f"npm install --prefix ../../;"
+                    f"npm install{self.__install_flags()} --prefix ../../;"
                     f"popd;"
                 )
 
@@ -71,10 +255,19 @@ class NodeBundler(Bundler):
         if self.__packages or self.__manifest:
             cmd = "pushd nodejs;"
             if self.__manifest:
-                cmd += f" npm install;"
+                # npm installs the package.json of the current directory
+                path_copy(
+                    self._local_path / Path(self.__manifest).name,
+                    node_dir / "package.json",
+                )
+                cmd += f" npm install{self.__install_flags()};"
 
             if self.__packages:
-                cmd += " npm install --save " + " ".join(self.__packages) + ";"
+                cmd += (
+                    f" npm install{self.__install_flags()} --save "
+                    + " ".join(self.__packages)
+                    + ";"
+                )
 
             cmd += "popd"
             container_cmds.append(cmd)
@@ -0,0 +1,261 @@
+from typing import Any, Dict, List, NamedTuple, Optional
+from pathlib import Path
+import subprocess
+import threading
+import json
+import time
+import uuid
+import os
+import re
+from .split import format_size
+from .logger import logger
+
+# seconds between samples, docker stats refreshes about once a second
+SAMPLE_INTERVAL = 1.0
+
+# written next to the layer in the output dir, named by the container so concurrent
+# builds into the same dir keep their own profiles
+PROFILE_FILENAME = "resource-profile-{container}.json"
+
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+_SIZE = re.compile(r"([\d.]+)\s*([A-Za-z]*)")
+_UNITS = {
+    "": 1,
+    "b": 1,
+    "kb": 1000,
+    "mb": 1000**2,
+    "gb": 1000**3,
+    "tb": 1000**4,
+    "kib": 1024,
+    "mib": 1024**2,
+    "gib": 1024**3,
+    "tib": 1024**4,
+}
+
+
+class ResourceSample(NamedTuple):
+    """
+    the resource usage of a container at one point in time, counters are cumulative
+    """
+
+    # seconds since sampling started
+    t: float
+    # 100 is one fully used core
+    cpu_percent: float
+    memory_bytes: int
+    memory_limit_bytes: int
+    block_read_bytes: int
+    block_write_bytes: int
+    net_rx_bytes: int
+    net_tx_bytes: int
+    pids: int
+
+
+def _parse_size(value: str) -> int:
+    match = _SIZE.match(value.strip())
+    if not match:
+        raise ValueError(f"not a size: {value}")
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def _parse_pair(value: str) -> List[int]:
+    return [_parse_size(v) for v in value.split("/")]
+
+
+def parse_stats(line: str, t: float) -> Optional[ResourceSample]:
+    """
+    parse a line of docker stats --format '{{json .}}'
+    :return: The sample or None when the line holds no stats, e.g. while the
+        container is starting.
+    """
+    line = _ANSI_ESCAPE.sub("", line).strip()
+    if not line:
+        return None
+    try:
+        stats = json.loads(line)
+        memory, memory_limit = _parse_pair(stats["MemUsage"])
+        block_read, block_write = _parse_pair(stats["BlockIO"])
+        net_rx, net_tx = _parse_pair(stats["NetIO"])
+        return ResourceSample(
+            t=round(t, 3),
+            cpu_percent=float(stats["CPUPerc"].rstrip("%")),
+            memory_bytes=memory,
+            memory_limit_bytes=memory_limit,
+            block_read_bytes=block_read,
+            block_write_bytes=block_write,
+            net_rx_bytes=net_rx,
+            net_tx_bytes=net_tx,
+            pids=int(stats.get("PIDs") or 0),
+        )
+    except (ValueError, KeyError):
+        return None
+
+
+class ResourceProfiler:
+    """
+    ResourceProfiler samples a container with docker stats while it runs
+    """
+
+    def __init__(self, container_name: str, interval: float = SAMPLE_INTERVAL):
+        """
+        :param container_name: The name of the container, it may not have started yet.
+        :param interval: The seconds between samples.
+        """
+        self.__name = container_name
+        self.__interval = interval
+        self.__samples: List[ResourceSample] = []
+        self.__stopped = threading.Event()
+        self.__proc: Optional[subprocess.Popen] = None
+        self.__lock = threading.Lock()
+        self.__thread = threading.Thread(
+            target=self.__sample, name=f"profile-{container_name}", daemon=True
+        )
+        self.__start = 0.0
+
+    @staticmethod
+    def container_name() -> str:
+        return f"layermake-{uuid.uuid4().hex}"
+
+    def start(self):
+        self.__start = time.monotonic()
+        self.__thread.start()
+
+    def stop(self) -> List[ResourceSample]:
+        """
+        stop sampling
+        :return: The samples in the order they were taken.
+        """
+        self.__stopped.set()
+        with self.__lock:
+            if self.__proc:
+                self.__proc.terminate()
+        self.__thread.join()
+        return self.__samples
+
+    def __sample(self):
+        # docker stats exits at once while the container does not exist yet
+        while not self.__stopped.is_set():
+            with self.__lock:
+                if self.__stopped.is_set():
+                    return
+                self.__proc = subprocess.Popen(
+                    ["docker", "stats", "--format", "{{json .}}", self.__name],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    universal_newlines=True,
+                )
+            for line in self.__proc.stdout:
+                t = time.monotonic() - self.__start
+                if self.__samples and t - self.__samples[-1].t < self.__interval * 0.9:
+                    continue
+                sample = parse_stats(line, t)
+                if sample:
+                    self.__samples.append(sample)
+            self.__proc.wait()
+            self.__stopped.wait(0.2)
+
+
+def _peak_average(values: List[float]) -> Dict[str, float]:
+    return {
+        "peak": max(values),
+        "average": round(sum(values) / len(values), 2),
+    }
+
+
+def summarize(samples: List[ResourceSample]) -> Dict[str, Any]:
+    """
+    peak and average CPU and memory, and the I/O totals and rates of a profile
+    """
+    if not samples:
+        return {"samples": 0}
+    last = samples[-1]
+    duration = max(last.t, SAMPLE_INTERVAL)
+    summary: Dict[str, Any] = {
+        "samples": len(samples),
+        "duration_seconds": last.t,
+        "cpu_percent": _peak_average([s.cpu_percent for s in samples]),
+        "memory_bytes": _peak_average([s.memory_bytes for s in samples]),
+        "memory_limit_bytes": last.memory_limit_bytes,
+        "pids": _peak_average([s.pids for s in samples]),
+    }
+    for counter in (
+        "block_read_bytes",
+        "block_write_bytes",
+        "net_rx_bytes",
+        "net_tx_bytes",
+    ):
+        # counters never decrease, the peak is the total
+        total = max(getattr(s, counter) for s in samples)
+        summary[counter] = {
+            "total": total,
+            "average_per_second": round(total / duration),
+        }
+    return summary
+
+
+def write_profile(
+    path: Path, container: str, samples: List[ResourceSample], summary: Dict[str, Any]
+):
+    """
+    write the time series and its summary as JSON, readers never see a partial file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    try:
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "container": container,
+                    "interval_seconds": SAMPLE_INTERVAL,
+                    "summary": summary,
+                    "samples": [s._asdict() for s in samples],
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def log_summary(summary: Dict[str, Any], cpus: float = None):
+    """
+    log the summary and what it suggests the build is bound by
+    :param cpus: The CPUs the container was limited to, defaults to the host's.
+    """
+    if not summary["samples"]:
+        logger().warn("the build container finished before it could be sampled")
+        return
+    cores = cpus or os.cpu_count() or 1
+    cpu = summary["cpu_percent"]
+    memory = summary["memory_bytes"]
+    limit = summary["memory_limit_bytes"]
+    rx = summary["net_rx_bytes"]
+    logger().info(
+        f"cpu: {cpu['average']:.0f}% average, {cpu['peak']:.0f}% peak "
+        f"(100% is one core, {cores:g} available)"
+    )
+    logger().info(
+        f"memory: {format_size(memory['average'])} average, "
+        f"{format_size(memory['peak'])} peak of {format_size(limit)}"
+    )
+    logger().info(
+        f"block i/o: {format_size(summary['block_read_bytes']['total'])} read, "
+        f"{format_size(summary['block_write_bytes']['total'])} written"
+    )
+    logger().info(
+        f"network: {format_size(rx['total'])} received "
+        f"({format_size(rx['average_per_second'])}/s), "
+        f"{format_size(summary['net_tx_bytes']['total'])} sent"
+    )
+
+    if limit and memory["peak"] >= 0.9 * limit:
+        logger().warn("memory pressure: the build came close to its memory limit")
+    if cpu["average"] >= 70 * cores:
+        logger().success(
+            "cpu-bound: more cores or a compiler cache would speed this build up"
+        )
+    elif cpu["average"] < 50 and rx["average_per_second"] >= 1024 * 1024:
+        logger().success(
+            "network-bound: a package mirror or cache would speed this build up"
+        )
@@ -0,0 +1,292 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+from email.parser import HeaderParser
+import posixpath
+import json
+import csv
+import os
+import re
+from .split import format_size
+from .cmd import rmtree
+from .logger import logger
+
+# the name at the start of a requirement specifier, e.g. boto3 in boto3[crt]>=1.28
+_REQUIREMENT_NAME = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:$|[\[<>=!~;@(\s])")
+
+_NODE_DEPENDENCY_KEYS = ["dependencies", "optionalDependencies", "peerDependencies"]
+
+
+class Package(NamedTuple):
+    """
+    an installed package, its dependencies and the paths it owns
+    """
+
+    name: str
+    requires: Tuple[str, ...]
+    # files and directories relative to the install dir, e.g. python/ or node_modules/
+    paths: Tuple[str, ...]
+
+
+def normalize_name(name: str) -> str:
+    """
+    the normalized form of a python distribution name, e.g. python-dateutil for
+    python_dateutil
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _record_paths(dist_info: Path) -> List[str]:
+    # unlike dist_info_files, the files need not exist, e.g. when only the
+    # metadata was copied out of the build container
+    record = dist_info / "RECORD"
+    if not record.is_file():
+        return []
+    paths = []
+    with open(record, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            path = posixpath.normpath(row[0])
+            # console scripts and data files installed outside the install dir
+            if path.startswith("..") or path.startswith("/"):
+                continue
+            paths.append(path)
+    return paths
+
+
+def python_packages(site_dir: Path) -> Dict[str, Package]:
+    """
+    the distributions installed into a pip --target directory by normalized name
+    :param site_dir: The install dir, only the METADATA and RECORD of each
+        .dist-info directory are read.
+    """
+    packages = {}
+    for dist_info in sorted(site_dir.glob("*.dist-info")):
+        metadata_path = dist_info / "METADATA"
+        name = dist_info.name[: -len(".dist-info")].split("-")[0]
+        requires = []
+        if metadata_path.is_file():
+            metadata = HeaderParser().parsestr(
+                metadata_path.read_text(encoding="utf-8", errors="replace")
+            )
+            name = metadata.get("Name", name)
+            for requirement in metadata.get_all("Requires-Dist") or []:
+                # dependencies of extras are only installed on request
+                if "extra" in requirement.partition(";")[2]:
+                    continue
+                match = _REQUIREMENT_NAME.match(requirement.strip())
+                if match:
+                    requires.append(normalize_name(match.group(1)))
+        name = normalize_name(name)
+        packages[name] = Package(
+            name=name,
+            requires=tuple(requires),
+            paths=tuple(_record_paths(dist_info)) + (dist_info.name,),
+        )
+    return packages
+
+
+def node_packages(node_modules_dir: Path) -> Dict[str, Package]:
+    """
+    the top level modules of a node_modules directory by name, modules nested
+    in their node_modules belong to them
+    :param node_modules_dir: The node_modules dir, only the package.json of each
+        module is read.
+    """
+    dirs = []
+    for entry in sorted(node_modules_dir.iterdir()):
+        if entry.name.startswith("@") and entry.is_dir():
+            dirs.extend(sorted(entry.iterdir()))
+        elif entry.is_dir() and not entry.name.startswith("."):
+            dirs.append(entry)
+
+    packages = {}
+    for d in dirs:
+        name = d.relative_to(node_modules_dir).as_posix()
+        requires: Set[str] = set()
+        try:
+            manifest = json.loads((d / "package.json").read_text())
+            for key in _NODE_DEPENDENCY_KEYS:
+                requires.update(manifest.get(key) or {})
+        except (OSError, ValueError):
+            pass
+        packages[name] = Package(
+            name=name, requires=tuple(sorted(requires)), paths=(name,)
+        )
+    return packages
+
+
+def python_requirement_names(args: Iterable[str], files: Iterable[Path]) -> Set[str]:
+    """
+    the normalized names of the distributions a user requested explicitly
+    :param args: Requirement specifiers, e.g. the packages given on the command line.
+    :param files: Requirement files, missing ones are skipped.
+    """
+    lines = list(args)
+    for f in files:
+        if f.is_file():
+            lines.extend(f.read_text().splitlines())
+
+    names = set()
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        # options, nested requirement files and local paths name no distribution
+        if not line or line.startswith(("-", ".", "/")):
+            continue
+        match = _REQUIREMENT_NAME.match(line)
+        if match:
+            names.add(normalize_name(match.group(1)))
+    return names
+
+
+def node_dependency_names(
+    args: Iterable[str], manifests: Iterable[Path], dev: bool = False
+) -> Set[str]:
+    """
+    the names of the modules a user requested explicitly
+    :param args: Package specs, e.g. @aws-sdk/client-s3@3.400.0.
+    :param manifests: package.json files whose dependencies are requested, missing
+        ones are skipped.
+    :param dev: Whether devDependencies are requested too.
+    """
+    names = set()
+    for arg in args:
+        # urls, git remotes and local paths name no registry module
+        if not arg or ":" in arg or arg.startswith((".", "/", "~")):
+            continue
+        at = arg.find("@", 1)
+        names.add(arg[:at] if at > 0 else arg)
+
+    keys = _NODE_DEPENDENCY_KEYS + (["devDependencies"] if dev else [])
+    for manifest_path in manifests:
+        if not manifest_path.is_file():
+            continue
+        manifest = json.loads(manifest_path.read_text())
+        for key in keys:
+            names.update(manifest.get(key) or {})
+    return names
+
+
+def _closure(
+    packages: Dict[str, Package], start: Iterable[str], stop: Set[str]
+) -> Set[str]:
+    seen: Set[str] = set()
+    stack = [n for n in start if n in packages]
+    while stack:
+        name = stack.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        stack.extend(
+            r for r in packages[name].requires if r in packages and r not in stop
+        )
+    return seen
+
+
+def excluded_packages(
+    packages: Dict[str, Package], provided: Iterable[str], keep: Set[str]
+) -> Set[str]:
+    """
+    the provided packages and the dependencies nothing else in the layer needs
+    :param packages: The installed packages by name.
+    :param provided: Glob patterns of the packages the runtime provides.
+    :param keep: The names of packages that are never excluded.
+    """
+    patterns = list(provided)
+    matched = {n for n in packages if any(fnmatch(n, p) for p in patterns)}
+    provided_names = matched - keep
+    candidates = _closure(packages, provided_names, set())
+    # what the rest of the layer depends on stays, unless the runtime provides it.
+    # A pinned sdk keeps all its dependencies, e.g. a pinned boto3 its botocore.
+    needed = _closure(
+        packages,
+        [n for n in packages if n not in candidates or n in keep],
+        provided_names,
+    ) | _closure(packages, matched & keep, set())
+    return candidates - needed
+
+
+def path_owners(packages: Dict[str, Package], names: Set[str]) -> Dict[str, str]:
+    """
+    the names of the packages owning each of their paths
+    """
+    return {path: name for name in names for path in packages[name].paths}
+
+
+def path_owner(rel: str, owners: Dict[str, str]) -> Optional[str]:
+    """
+    the package owning a path or one of its parents
+    :param rel: The path relative to the install dir.
+    :param owners: The result of path_owners.
+    """
+    path = PurePosixPath(rel)
+    for p in [path, *path.parents]:
+        name = owners.get(p.as_posix())
+        if name:
+            return name
+    return None
+
+
+def remove_packages(
+    install_dir: Path, packages: Dict[str, Package], names: Set[str]
+) -> Dict[str, Tuple[int, int]]:
+    """
+    remove the paths of packages from an install dir
+    :return: The number of files and bytes removed per package.
+    """
+    removed = {}
+    parents: Set[Path] = set()
+    for name in sorted(names):
+        files, size = 0, 0
+        for rel in packages[name].paths:
+            path = install_dir / rel
+            if path.is_dir() and not path.is_symlink():
+                for root, _, file_names in os.walk(path):
+                    for n in file_names:
+                        files += 1
+                        size += os.lstat(os.path.join(root, n)).st_size
+                rmtree(path)
+            elif path.is_symlink() or path.exists():
+                files += 1
+                size += os.lstat(path).st_size
+                path.unlink()
+            else:
+                continue
+            parents.update(path.parents)
+        removed[name] = (files, size)
+
+    # directories emptied by the removal, deepest first
+    for d in sorted(parents, key=lambda p: len(p.parts), reverse=True):
+        if install_dir in d.parents:
+            try:
+                d.rmdir()
+            except OSError:
+                pass
+    return removed
+
+
+def exclude_python_packages(site_dir: Path, provided: Iterable[str], keep: Set[str]):
+    """
+    remove the provided distributions of a python install dir and the dependencies
+    nothing else in it needs
+    :param provided: Glob patterns of the distributions the runtime provides.
+    :param keep: The names of distributions that are never excluded.
+    """
+    if not site_dir.is_dir():
+        return
+    packages = python_packages(site_dir)
+    names = excluded_packages(packages, provided, keep)
+    if names:
+        with logger().status("excluding packages provided by the lambda runtime..."):
+            log_excluded(remove_packages(site_dir, packages, names))
+
+
+def log_excluded(removed: Dict[str, Tuple[int, int]]):
+    total_size = sum(s for _, s in removed.values())
+    for name, (files, size) in sorted(removed.items()):
+        logger().info(f"excluded {name}: {files} files, {format_size(size)}")
+    logger().success(
+        f"saved {format_size(total_size)} by excluding {len(removed)} packages "
+        f"provided by the lambda runtime"
+    )
@@ -0,0 +1,179 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from fnmatch import fnmatch
+from pathlib import Path, PurePath, PurePosixPath
+import os
+from .cmd import rmtree
+from .logger import logger
+
+
+class PruneRule(NamedTuple):
+    """
+    glob patterns of files or directories that are removed from node_modules.
+    Patterns without a slash match names, patterns with one match paths relative to node_modules.
+    """
+
+    name: str
+    files: Tuple[str, ...] = ()
+    dirs: Tuple[str, ...] = ()
+    # directories only matched directly inside a package, e.g. node_modules/yaml/docs
+    # but not node_modules/yaml/dist/doc, which holds code
+    package_dirs: Tuple[str, ...] = ()
+
+
+# rules that only remove files node never loads at runtime
+DEFAULT_PRUNE_RULES = [
+    PruneRule(
+        "docs",
+        files=(
+            "README",
+            "README.*",
+            "readme.*",
+            "CHANGELOG*",
+            "changelog*",
+            "HISTORY*",
+            "CHANGES*",
+            "AUTHORS*",
+            "CONTRIBUTING*",
+            "*.markdown",
+        ),
+        package_dirs=("docs", "doc", "example", "examples"),
+    ),
+    PruneRule("tests", dirs=("__tests__", "__mocks__"), package_dirs=("test", "tests")),
+    PruneRule("typescript", files=("*.ts", "*.tsx", "tsconfig.json", "*.tsbuildinfo")),
+    PruneRule("sourcemaps", files=("*.map",)),
+    PruneRule(
+        "tooling",
+        files=(
+            ".eslintrc*",
+            ".prettierrc*",
+            ".editorconfig",
+            ".npmignore",
+            ".travis.yml",
+            ".gitattributes",
+            ".jshintrc",
+            ".nycrc*",
+            ".babelrc*",
+        ),
+        dirs=(".github", ".circleci", ".nyc_output"),
+        package_dirs=("coverage",),
+    ),
+]
+
+# never removed, whatever the rules say
+PROTECTED = ["package.json", "LICENSE*", "LICENCE*", "license*", "licence*", "*.node"]
+
+
+def _matches(rel: str, patterns) -> bool:
+    name = rel.rsplit("/", 1)[-1]
+    return any(fnmatch(rel if "/" in p else name, p) for p in patterns)
+
+
+def _is_package_root(path: PurePath) -> bool:
+    # a directory named like a rule can still be a package, e.g. node_modules/test
+    parent = path.parent
+    return parent.name == "node_modules" or (
+        parent.name.startswith("@") and parent.parent.name == "node_modules"
+    )
+
+
+def _dir_rule(path: PurePath, rel: str, rules: List[PruneRule]) -> Optional[PruneRule]:
+    in_package = _is_package_root(path.parent)
+    return next(
+        (
+            r
+            for r in rules
+            if _matches(rel, r.dirs) or (in_package and _matches(rel, r.package_dirs))
+        ),
+        None,
+    )
+
+
+def _tree_size(path: Path) -> Tuple[int, int]:
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        for n in names:
+            files += 1
+            size += os.lstat(os.path.join(root, n)).st_size
+    return files, size
+
+
+def prune_tree(
+    node_modules: Path, rules: List[PruneRule], keep: List[str] = None
+) -> Dict[str, Tuple[int, int]]:
+    """
+    remove files matched by the rules from a node_modules tree
+    :param node_modules: The node_modules directory.
+    :param rules: The rules to apply.
+    :param keep: Additional glob patterns that are never removed.
+    :return: The number of files and bytes removed per rule.
+    """
+    protected = PROTECTED + list(keep or [])
+    removed = {rule.name: (0, 0) for rule in rules}
+
+    def count(rule: PruneRule, files: int, size: int):
+        f, s = removed[rule.name]
+        removed[rule.name] = (f + files, s + size)
+
+    for root, dirs, names in os.walk(node_modules):
+        root_path = Path(root)
+        for d in list(dirs):
+            path = root_path / d
+            rel = path.relative_to(node_modules).as_posix()
+            if _is_package_root(path) or _matches(rel, protected):
+                continue
+            rule = _dir_rule(path, rel, rules)
+            if not rule:
+                continue
+            count(rule, *_tree_size(path))
+            if path.is_symlink():
+                path.unlink()
+            else:
+                rmtree(path)
+            dirs.remove(d)
+
+        for n in names:
+            path = root_path / n
+            rel = path.relative_to(node_modules).as_posix()
+            if _matches(rel, protected):
+                continue
+            rule = next((r for r in rules if _matches(rel, r.files)), None)
+            if not rule:
+                continue
+            count(rule, 1, os.lstat(path).st_size)
+            path.unlink()
+
+    return removed
+
+
+def prune_rule(
+    rel: str, rules: List[PruneRule], keep: List[str] = None
+) -> Optional[PruneRule]:
+    """
+    the rule that prune_tree would remove a file with, for trees that are not on disk
+    :param rel: The path of the file relative to node_modules.
+    :param rules: The rules to apply.
+    :param keep: Additional glob patterns that are never removed.
+    """
+    protected = PROTECTED + list(keep or [])
+    parts = rel.split("/")
+    for n in range(1, len(parts)):
+        dir_rel = "/".join(parts[:n])
+        path = PurePosixPath("node_modules", dir_rel)
+        if _is_package_root(path) or _matches(dir_rel, protected):
+            continue
+        rule = _dir_rule(path, dir_rel, rules)
+        if rule:
+            return rule
+    if _matches(rel, protected):
+        return None
+    return next((r for r in rules if _matches(rel, r.files)), None)
+
+
+def log_pruned(removed: Dict[str, Tuple[int, int]]):
+    total_files = sum(f for f, _ in removed.values())
+    total_size = sum(s for _, s in removed.values())
+    for name, (files, size) in removed.items():
+        logger().info(f"pruned {name}: {files} files, {size / 1024 / 1024:.1f} MB")
+    logger().success(
+        f"pruned {total_files} files, {total_size / 1024 / 1024:.1f} MB from node_modules"
+    )
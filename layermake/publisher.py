@@ -1,10 +1,29 @@
-from typing import List
-import shutil
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import threading
+import hashlib
+import random
+import time
+import os
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-from .cmd import rmtree
-from .logger import logger
+from .logger import logger, with_logger
+from .split import MAX_DIRECT_UPLOAD_MB
+
+# error codes that are retried with backoff on top of botocore's adaptive retries
+_THROTTLING_CODES = {
+    "TooManyRequestsException",
+    "ThrottlingException",
+    "Throttling",
+    "RequestLimitExceeded",
+    "SlowDown",
+}
+
+_PUBLISH_ATTEMPTS = 5
 
 
 class LayerPublisher:
@@ -18,12 +37,31 @@ class LayerPublisher:
         profile: str = None,
         arch: List[str] = None,
         no_zip: bool = False,
+        regions: List[str] = None,
+        s3_bucket: str = None,
+        endpoint_url: str = None,
     ):
+        """
+        :param regions: The regions to publish to, defaults to the session's region.
+        :param s3_bucket: Stage the layer in this bucket instead of uploading it with the
+            publish request. "{region}" is replaced with the region being published to.
+        :param endpoint_url: Send lambda and s3 requests to this endpoint, e.g. a local stand-in.
+        """
         boto_session = (
             boto3.Session(profile_name=profile) if profile else boto3.Session()
         )
 
-        self.__client = boto_session.client("lambda")
+        self.__session = boto_session
+        self.__endpoint_url = endpoint_url
+        # defaults to the session's region when publishing, which --no-publish never needs
+        self.__regions = list(regions or [])
+        self.__clients = {}
+        self.__clients_lock = threading.Lock()
+        self.__s3_bucket = s3_bucket
+        # by path and the stat of the file hashed, --watch replaces the same path
+        self.__digests: Dict[Tuple[str, int, int, int], str] = {}
+        self.__uploads: Dict[Tuple[str, str], threading.Lock] = {}
+        self.__uploads_lock = threading.Lock()
         self.__name = name
         self.__license_text = license_text
         self.__license_file = Path(license_file) if license_file else None
@@ -45,37 +83,213 @@ class LayerPublisher:
     def name(self) -> str:
         return self.__name
 
+    @property
+    def regions(self) -> List[str]:
+        if not self.__regions:
+            region = self.__session.region_name
+            if not region:
+                logger().fatal_error(
+                    "no AWS region configured, pass --region or set AWS_REGION"
+                )
+            self.__regions = [region]
+        return self.__regions
+
+    def __client(self, service: str, region: str):
+        """
+        the client of a service in a region, created on first use
+        """
+        # clients are thread safe but creating them from a session is not
+        with self.__clients_lock:
+            if (service, region) not in self.__clients:
+                config = Config(
+                    retries={"mode": "adaptive", "max_attempts": 10},
+                    max_pool_connections=max(10, len(self.regions)),
+                )
+                self.__clients[(service, region)] = self.__session.client(
+                    service,
+                    region_name=region,
+                    endpoint_url=self.__endpoint_url,
+                    config=config,
+                )
+            return self.__clients[(service, region)]
+
+    @property
+    def arch(self) -> List[str]:
+        return self.__arch or ["x86_64"]
+
+    @property
+    def runtimes(self) -> List[str]:
+        return self.__runtimes
+
+    @runtimes.setter
+    def runtimes(self, runtimes: List[str]):
+        self.__runtimes = list(runtimes)
+
     def get_license_info(self) -> str:
         if self.__license_text:
             return self.__license_text
-        if self.__license_text:
-            with open(self.__license_text, "r") as f:
+        if self.__license_file:
+            with open(self.__license_file, "r") as f:
                 return f.read()
         return ""
 
-    def publish_layer(self, output_path: Path, layer_type: str):
+    def publish_layer(
+        self,
+        output_path: Path,
+        layer_type: str,
+        name: str = None,
+        runtimes: List[str] = None,
+    ) -> Dict[str, str]:
+        """
+        publish a layer zip to every region concurrently
+        :param output_path: The layer zip to publish.
+        :param layer_type: The kind of layer, used in the default description.
+        :param name: Overrides the layer name.
+        :param runtimes: Overrides the compatible runtimes.
+        :return: The ARN of the new layer version in each region.
+        """
         if not output_path.exists():
             raise FileNotFoundError(f"layer at: {output_path} is empty")
 
         if self.__no_zip:
             logger().info('layer publishing skipped because "--no-zip" was set')
-            return
+            return {}
 
         if self.__no_pub:
             logger().info('layer publishing skipped because "--no-publish" was set')
-            return
+            return {}
 
-        with logger().status("publishing layer"):
+        name = name or self.name
+        regions = self.regions
+        # read once and shared by every region
+        zip_bytes = None if self.__s3_bucket else output_path.read_bytes()
+        params = dict(
+            LayerName=name,
+            Description=self.__description
+            or f"my {layer_type} layer built with layermake",
+            LicenseInfo=self.get_license_info(),
+            CompatibleRuntimes=runtimes or self.__runtimes,
+            CompatibleArchitectures=self.__arch or ["x86_64"],
+        )
+
+        def publish(region: str) -> str:
+            if zip_bytes is None:
+                bucket, key = self.__upload(region, output_path, name)
+                content = {"S3Bucket": bucket, "S3Key": key}
+            else:
+                content = {"ZipFile": zip_bytes}
+            resp = self.__with_backoff(
+                lambda: self.__client("lambda", region).publish_layer_version(
+                    Content=content, **params
+                )
+            )
+            logger().success(f'{name} version {resp["Version"]} published to {region}')
+            return resp["LayerVersionArn"]
+
+        with logger().status(f"publishing layer {name} to {', '.join(regions)}..."):
+            arns, errors = {}, {}
+            with ThreadPoolExecutor(max_workers=len(regions)) as pool:
+                futures = {r: pool.submit(with_logger(publish), r) for r in regions}
+                for region, future in futures.items():
+                    try:
+                        arns[region] = future.result()
+                    except Exception as e:
+                        errors[region] = e
+
+        if errors:
+            for region, arn in arns.items():
+                logger().info(f"published to {region}: {arn}")
+            logger().fatal_error(
+                "Failed to publish layer: "
+                + "; ".join(f"{r}: {str(e)}" for r, e in errors.items())
+            )
+
+        return arns
+
+    @staticmethod
+    def __with_backoff(fn):
+        """
+        retry throttled calls and server errors with exponential backoff and jitter
+        """
+        for attempt in range(_PUBLISH_ATTEMPTS):
             try:
-                resp = self.__client.publish_layer_version(
-                    LayerName=self.name,
-                    Description=self.__description
-                    or f"my {layer_type} layer built with layermake",
-                    Content={"ZipFile": output_path},
-                    LicenseInfo=self.get_license_info(),
-                    CompatibleRuntimes=self.__runtimes,
-                    CompatibleArchitectures=self.__arch or ["x86_64"],
+                return fn()
+            except (ClientError, S3UploadFailedError) as e:
+                # upload_file wraps the client error of a failed upload
+                error = (
+                    e if isinstance(e, ClientError) else e.__cause__ or e.__context__
+                )
+                if (
+                    not isinstance(error, ClientError)
+                    or attempt == _PUBLISH_ATTEMPTS - 1
+                ):
+                    raise
+                code = error.response.get("Error", {}).get("Code")
+                status = error.response.get("ResponseMetadata", {}).get(
+                    "HTTPStatusCode", 0
+                )
+                if code not in _THROTTLING_CODES and status < 500:
+                    raise
+                delay = min(30.0, 2**attempt) * random.uniform(0.5, 1.0)
+                logger().debug(f"{code or status}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def __upload(self, region: str, output_path: Path, name: str):
+        """
+        upload the layer to the region's bucket once, keyed by its content hash
+        """
+        bucket = self.__s3_bucket.replace("{region}", region)
+        with self.__uploads_lock:
+            st = os.stat(output_path)
+            version = (str(output_path), st.st_ino, st.st_mtime_ns, st.st_size)
+            digest = self.__digests.get(version)
+            if not digest:
+                h = hashlib.sha256()
+                with open(output_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        h.update(chunk)
+                digest = self.__digests[version] = h.hexdigest()
+            key = f"layermake/{name}/{digest}.zip"
+            # regions that share a bucket wait for the first upload instead of repeating it
+            upload_lock = self.__uploads.setdefault((bucket, key), threading.Lock())
+
+        s3 = self.__client("s3", region)
+        with upload_lock:
+            try:
+                s3.head_object(Bucket=bucket, Key=key)
+                logger().debug(f"s3://{bucket}/{key} already uploaded")
+                return bucket, key
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey"):
+                    raise
+
+            self.__with_backoff(lambda: s3.upload_file(str(output_path), bucket, key))
+            logger().info(f"uploaded layer to s3://{bucket}/{key}")
+        return bucket, key
+
+    def publish_layers(
+        self, output_paths: List[Path], layer_type: str
+    ) -> List[Dict[str, str]]:
+        """
+        publish the parts of a split layer as separate layers named <name>-<n>.
+        A function cannot attach two versions of the same layer, so every part gets its own name.
+        :return: The layer version ARNs of each part by region, in the order they should be attached.
+        """
+        if not self.__s3_bucket:
+            # fail before publishing any part rather than leave a partial set behind
+            limit = MAX_DIRECT_UPLOAD_MB * 1024 * 1024
+            too_large = [p for p in output_paths if p.stat().st_size > limit]
+            if too_large:
+                message = (
+                    f"layer parts above the {MAX_DIRECT_UPLOAD_MB} MB limit of direct "
+                    f"uploads: {', '.join(p.name for p in too_large)}; pass --s3-bucket "
+                    f"to publish them"
                 )
-                logger().success(f'version: {resp["Version"]}', concat=True)
-            except Exception as e:
-                logger().fatal_error(f"Failed to publish layer: {str(e)}")
+                if self.__no_zip or self.__no_pub:
+                    logger().warn(message)
+                else:
+                    logger().fatal_error(message)
+        return [
+            self.publish_layer(output_path, layer_type, name=f"{self.name}-{n + 1}")
+            for n, output_path in enumerate(output_paths)
+        ]
@@ -1,12 +1,45 @@
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 from string import Template
 from pathlib import Path
-from .bundler import Bundler
-from .cmd import path_copy, rmtree
+import shutil
+import sys
+import os
+import re
+from .bundler import Bundler, EXPORT_METADATA_DIR
+from .cmd import path_copy, popen, rmtree
+from .archive import zip_files
+from .distributions import LayerItem, python_distributions
+from .installers import get_installer
+from .provided import (
+    excluded_packages,
+    exclude_python_packages,
+    log_excluded,
+    path_owner,
+    path_owners,
+    python_packages,
+    python_requirement_names,
+)
+from .runtimes import PYTHON_PROVIDED_PACKAGES
 from .logger import logger
 
 PYTHON_ECR_TEMPLATE = Template("public.ecr.aws/sam/build-python${runtime}:${version}")
 
+# glibc minor version of the lambda base image of each runtime, defaults to amazon linux 2
+_RUNTIME_GLIBC = {"3.12": 34, "3.13": 34}
+_DEFAULT_GLIBC = 26
+
+_ARCH_PLATFORMS = {"x86_64": "x86_64", "arm64": "aarch64"}
+
+# what pip reports when --only-binary finds no compatible wheel for a requirement
+_NO_WHEEL = re.compile(r"No matching distribution found for (\S+)")
+_NETWORK_ERROR = re.compile(
+    r"NewConnectionError|ConnectTimeoutError|ReadTimeoutError|ProxyError|SSLError"
+    r"|Could not fetch URL"
+)
+
+_CLEAN_FILES = ["*.pyo", "*.pyc"]
+_CLEAN_DIRS = ["__pycache__", ".cache", ".mypy_cache", ".pytest_cache"]
+
 
 def _is_package(path: Path) -> bool:
     """
@@ -15,6 +48,59 @@ def _is_package(path: Path) -> bool:
     return path.is_dir() and (path / "__init__.py").is_file()
 
 
+def clean_cmds(target: str) -> List[str]:
+    """
+    container commands that remove bytecode and cache dirs from an install target
+    """
+    return [
+        "find %s -name '%s' -exec rm -f {} +" % (target, p) for p in _CLEAN_FILES
+    ] + ["find %s -name '%s' -exec rm -rf {} +" % (target, p) for p in _CLEAN_DIRS]
+
+
+def clean_tree(target: Path):
+    """
+    remove bytecode and cache dirs from an install target on the host
+    """
+    for p in _CLEAN_DIRS:
+        for d in list(target.rglob(p)):
+            if d.is_dir():
+                rmtree(d)
+    for p in _CLEAN_FILES:
+        for f in target.rglob(p):
+            f.unlink(missing_ok=True)
+
+
+def native_platforms(runtime: str, arch: str) -> List[str]:
+    """
+    the pip --platform tags of wheels that run on the lambda base image of a runtime
+    :param runtime: The python version, e.g. 3.11.
+    :param arch: The lambda architecture, x86_64 or arm64.
+    """
+    machine = _ARCH_PLATFORMS[arch]
+    glibc = _RUNTIME_GLIBC.get(runtime, _DEFAULT_GLIBC)
+    platforms = [f"manylinux_2_{n}_{machine}" for n in range(glibc, 4, -1)]
+    # legacy aliases of manylinux_2_17, manylinux_2_12 and manylinux_2_5
+    platforms.append(f"manylinux2014_{machine}")
+    if machine == "x86_64":
+        platforms.extend([f"manylinux2010_{machine}", f"manylinux1_{machine}"])
+    return platforms
+
+
+def _run_pip(cmd: List[str]) -> Tuple[int, str]:
+    """
+    run pip and return its exit code and output
+    """
+    logger().debug("executing command:", " ".join(cmd))
+    output, return_code = [], 0
+    for line in popen(cmd):
+        if isinstance(line, str):
+            logger().debug(line)
+            output.append(line)
+        else:
+            return_code = line
+    return return_code, "".join(output)
+
+
 class PythonBundler(Bundler):
     """
     PythonBundler is a bundler for python layers
@@ -29,7 +115,35 @@ class PythonBundler(Bundler):
         packages: List[str] = None,
         manifest: str = None,
         no_zip: bool = False,
+        staging_dir: str = None,
+        native: bool = False,
+        arch: str = "x86_64",
+        installer: str = "pip",
+        export: bool = False,
+        profile_resources: bool = False,
+        exclude_provided: bool = True,
     ):
+        """
+        :param native: Install with the host's pip using its cross platform options and
+            only fall back to Docker when a distribution has no compatible wheel.
+        :param arch: The lambda architecture wheels are selected for in native mode.
+        :param installer: The engine installing in the build container, pip or uv.
+        :param export: Build in the container's filesystem and stream the layer out.
+        :param profile_resources: Sample the resource usage of the build container.
+        :param exclude_provided: Remove the packages the lambda runtime provides, e.g.
+            boto3, and the dependencies only they need, unless requested explicitly.
+        """
+        self.__runtime = runtime
+        self.__provided = (
+            PYTHON_PROVIDED_PACKAGES.get(runtime, ()) if exclude_provided else ()
+        )
+        # paths of the excluded packages and what was removed in export mode
+        self.__excluded_owners: Dict[str, str] = {}
+        self.__excluded: Dict[str, Tuple[int, int]] = {}
+        self.__installer = get_installer(installer)
+        self.__native = native
+        self.__arch = arch
+        self.__native_installed = False
         self.__manifest = manifest
         self.__packages = packages
         self.__artifact_dir = Path(artifact_dir) if artifact_dir else None
@@ -46,7 +160,191 @@ class PythonBundler(Bundler):
             local_dir=local_dir,
             build_artifact=manifest,
             no_zip=no_zip,
+            staging_dir=staging_dir,
+            export=export,
+            profile_resources=profile_resources,
+        )
+
+    def layer_items(self) -> List[LayerItem]:
+        return python_distributions(self._local_path / "python")
+
+    def layer_dir(self) -> Path:
+        return self._local_path / "python"
+
+    def _source_targets(self, rel: Path) -> List[Path]:
+        if not self.__artifact_dir:
+            return []
+        if _is_package(self.__artifact_dir):
+            return [self.layer_dir() / self.__artifact_dir.name / rel]
+        return [self.layer_dir() / rel]
+
+    def __native_install(self) -> bool:
+        """
+        install the manifest and packages with the host's pip into .native
+        :return: Whether every distribution had a compatible wheel.
+        """
+        if self.__artifact_dir and (
+            (self.__artifact_dir / "requirements.txt").is_file()
+            or (self.__artifact_dir / "setup.py").is_file()
+        ):
+            logger().info(f"{self.__artifact_dir} has to be built, using Docker")
+            return False
+
+        target = self._local_path / ".native"
+        cmd = [sys.executable, "-m", "pip", "install", "-t", str(target)]
+        for platform in native_platforms(self.__runtime, self.__arch):
+            cmd.extend(["--platform", platform])
+        cmd.extend(
+            [
+                "--python-version",
+                self.__runtime,
+                "--implementation",
+                "cp",
+                "--only-binary=:all:",
+            ]
         )
+        if self.__manifest:
+            cmd.extend(["-r", str(self._local_path / Path(self.__manifest).name)])
+        if self.__packages:
+            cmd.extend(self.__packages)
+
+        with logger().status("installing natively with pip..."):
+            logger().info(
+                f"installing wheels for python{self.__runtime} {self.__arch} with the host's pip"
+            )
+            return_code, output = _run_pip(cmd)
+            if return_code != 0:
+                missing = _NO_WHEEL.findall(output)
+                # unreachable indexes also end in no matching distribution
+                if return_code != 1 or not missing or _NETWORK_ERROR.search(output):
+                    logger().fatal_error(
+                        f"failed installing natively with pip, exit code "
+                        f"{return_code}:\n{output.strip()}"
+                    )
+                missing = sorted(set(missing))
+                # a typo fails the same way, a probe that accepts sdists tells them apart
+                self.__probe_index(target, missing)
+                logger().info(
+                    f"no compatible wheel for {', '.join(missing)}, falling back to Docker"
+                )
+                if target.exists():
+                    rmtree(target)
+                return False
+            logger().success("installed natively without Docker")
+        return True
+
+    def __probe_index(self, target: Path, requirements: List[str]):
+        """
+        fail unless the index has some distribution of the requirements, wheel or sdist
+        """
+        cmd = [sys.executable, "-m", "pip", "install", "--dry-run", "--no-deps"]
+        cmd.extend(["--ignore-installed", "-q", "-t", str(target)])
+        cmd.extend(["--python-version", self.__runtime, "--implementation", "cp"])
+        return_code, output = _run_pip(cmd + requirements)
+        if return_code != 0:
+            logger().fatal_error(
+                f"{', '.join(requirements)} cannot be installed for "
+                f"python{self.__runtime}:\n{output.strip()}"
+            )
+
+    def _build(self, zip_layer: bool):
+        if (
+            self.__native
+            and (self.__packages or self.__manifest)
+            and self.__native_install()
+        ):
+            return self.__native_build(zip_layer)
+
+        if not self.__provided:
+            return super(PythonBundler, self)._build(zip_layer)
+
+        if self.export:
+            # excluded while the layer is streamed out of the container
+            super(PythonBundler, self)._build(zip_layer)
+            if self.__excluded:
+                log_excluded(self.__excluded)
+            return
+
+        # exclude on the host between installing and zipping
+        super(PythonBundler, self)._build(zip_layer=False)
+        self.__exclude_provided()
+        if zip_layer:
+            self.__zip_layer()
+
+    def __native_build(self, zip_layer: bool):
+        self.__native_installed = True
+        self.pre_bundle()
+
+        native = self._local_path / ".native"
+        build_target = self._local_path / "python"
+        build_target.mkdir(parents=True, exist_ok=True)
+        for p in native.iterdir():
+            target = build_target / p.name
+            if p.is_dir() and target.is_dir():
+                shutil.copytree(p, target, dirs_exist_ok=True)
+            else:
+                os.replace(p, target)
+        rmtree(native)
+        clean_tree(build_target)
+        if self.__provided:
+            self.__exclude_provided()
+
+        if zip_layer:
+            self.__zip_layer()
+        self.post_bundle()
+
+    def __zip_layer(self):
+        with logger().status("zipping layer..."):
+            zip_files(
+                self._local_path,
+                (self._local_path / "python").rglob("*"),
+                self._local_path / "layer.zip",
+            )
+            logger().success("layer zipped")
+
+    def __requested(self) -> Set[str]:
+        """
+        the distributions requested explicitly, which are never excluded
+        """
+        files = []
+        if self.__manifest:
+            files.append(self._local_path / Path(self.__manifest).name)
+        if self.__artifact_dir:
+            files.append(self.__artifact_dir / "requirements.txt")
+        return python_requirement_names(self.__packages or [], files)
+
+    def __exclude_provided(self):
+        exclude_python_packages(
+            self._local_path / "python", self.__provided, self.__requested()
+        )
+
+    def _export_metadata_cmd(self) -> Optional[str]:
+        if not self.__provided:
+            return None
+        return (
+            "[ ! -d python ] || find python -maxdepth 2 -path 'python/*.dist-info/*' "
+            "\\( -name METADATA -o -name RECORD \\) "
+            f"-exec cp --parents {{}} {EXPORT_METADATA_DIR}/ \\;"
+        )
+
+    def _read_export_metadata(self, metadata_dir: Path):
+        site_dir = metadata_dir / "python"
+        if not site_dir.is_dir():
+            return
+        packages = python_packages(site_dir)
+        names = excluded_packages(packages, self.__provided, self.__requested())
+        self.__excluded_owners = path_owners(packages, names)
+        self.__excluded = {name: (0, 0) for name in names}
+
+    def _export_include(self, name: str, size: int) -> bool:
+        if not self.__excluded_owners or not name.startswith("python/"):
+            return True
+        owner = path_owner(name[len("python/") :], self.__excluded_owners)
+        if not owner:
+            return True
+        files, total = self.__excluded[owner]
+        self.__excluded[owner] = (files + 1, total + size)
+        return False
 
     def pre_bundle(self):
         container_cmds = []
@@ -71,7 +369,11 @@ class PythonBundler(Bundler):
             if (package_src / "requirements.txt").is_file() or (
                 package_src / "setup.py"
             ).is_file():
-                container_cmds.append(f"pip install src/{package_src.name}/. -t python")
+                container_cmds.append(
+                    self.__installer.install_cmd(
+                        "python", [f"src/{package_src.name}/."]
+                    )
+                )
 
             if _is_package(package_src):
                 package_target = build_target / package_src.name
@@ -81,30 +383,22 @@ class PythonBundler(Bundler):
                 # copy the contents of the dir straight to the build target
                 path_copy(package_src, build_target)
 
-        if self.__packages or self.__manifest:
-            cmd = "pip install -t python"
+        if (self.__packages or self.__manifest) and not self.__native_installed:
+            args = []
 
             if self.__manifest:
-                cmd += f" -r {Path(self.__manifest).name}"
+                args.append(f"-r {Path(self.__manifest).name}")
 
             if self.__packages:
-                cmd += " " + " ".join(self.__packages)
+                args.extend(self.__packages)
 
-            container_cmds.append(cmd)
+            container_cmds.append(self.__installer.install_cmd("python", args))
 
-        container_cmds.extend(
-            ["find python -name '%s' -exec rm -f {} +" % p for p in ["*.pyo", "*.pyc"]]
-        )
-        container_cmds.extend(
-            [
-                "find python -name '%s' -exec rm -rf {} +" % p
-                for p in [
-                    "__pycache__",
-                    ".cache",
-                    ".mypy_cache",
-                    ".pytest_cache",
-                ]
-            ]
-        )
+        if container_cmds and not self.__native_installed:
+            self._container = self.__installer.image(self._container)
+            self._container_volumes.extend(self.__installer.volumes())
+            self._container_env.update(self.__installer.env())
+
+        container_cmds.extend(clean_cmds("python"))
 
         self._container_cmd = "; ".join(container_cmds)
@@ -0,0 +1,49 @@
+from typing import Dict, Tuple
+
+NODEJS_RUNTIMES = ["4.3", "6.10", "8.10", "10.x", "12.x", "14.x", "16.x", "18.x"]
+PYTHON_RUNTIMES = ["3.6", "3.7", "3.8", "3.9", "3.10", "3.11", "3.12"]
+BINARY_RUNTIMES = [
+    "nodejs",
+    "nodejs4.3",
+    "nodejs6.10",
+    "nodejs8.10",
+    "nodejs10.x",
+    "nodejs12.x",
+    "nodejs14.x",
+    "nodejs16.x",
+    "nodejs18.x",
+    "java8",
+    "java8.al2",
+    "java11",
+    "python2.7",
+    "python3.6",
+    "python3.7",
+    "python3.8",
+    "python3.9",
+    "python3.10",
+    "python3.11",
+    "python3.12",
+    "dotnetcore1.0",
+    "dotnetcore2.0",
+    "dotnetcore2.1",
+    "dotnetcore3.1",
+    "dotnet6",
+    "nodejs4.3-edge",
+    "go1.x",
+    "ruby2.5",
+    "ruby2.7",
+    "provided",
+    "provided.al2",
+]
+
+# packages the lambda runtime provides, they are excluded from layers unless requested
+# their dependencies, e.g. urllib3, go only when nothing else in the layer needs them
+_PYTHON_SDK = ("boto3", "botocore", "s3transfer")
+PYTHON_PROVIDED_PACKAGES: Dict[str, Tuple[str, ...]] = {
+    runtime: _PYTHON_SDK for runtime in PYTHON_RUNTIMES
+}
+# glob patterns, nodejs 18 replaced the v2 sdk with the modular v3 sdk
+NODEJS_PROVIDED_PACKAGES: Dict[str, Tuple[str, ...]] = {
+    runtime: ("aws-sdk",) if int(runtime.split(".")[0]) <= 16 else ("@aws-sdk/*",)
+    for runtime in NODEJS_RUNTIMES
+}
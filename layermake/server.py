@@ -0,0 +1,544 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from pathlib import Path
+import socketserver
+import http.client
+import threading
+import secrets
+import inspect
+import hashlib
+import logging
+import socket
+import json
+import time
+import uuid
+import os
+from .api import (
+    LayerBuild,
+    build_python_layer,
+    build_node_layer,
+    build_binary_layer,
+    publish,
+)
+from .cache import cache_dir, output_lock
+from .cmd import docker_image_id
+from .python import PYTHON_ECR_TEMPLATE
+from .node import NODE_ECR_TEMPLATE
+from .logger import LoggingAdapter, logger
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8677
+
+BUILD_FUNCTIONS: Dict[str, Callable[..., LayerBuild]] = {
+    "python": build_python_layer,
+    "nodejs": build_node_layer,
+    "binary": build_binary_layer,
+}
+
+# host paths, resolved against the client's working directory and confined to the
+# server's allowed roots
+_PATH_PARAMS = {
+    "output",
+    "manifest",
+    "artifact_dir",
+    "artifact",
+    "staging_dir",
+    "dockerfile",
+    "ccache_dir",
+    "license_file",
+}
+
+# finished jobs are forgotten after this many seconds
+_JOB_TTL = 3600
+
+QUEUED, RUNNING, PUBLISHING, SUCCEEDED, FAILED = (
+    "queued",
+    "running",
+    "publishing",
+    "succeeded",
+    "failed",
+)
+
+
+class JobError(ValueError):
+    """
+    a job request is invalid
+    """
+
+
+class Job:
+    """
+    a build and optional publish requested by a client, and the log it writes
+    """
+
+    def __init__(self, key: str, request: Dict[str, Any]):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.request = request
+        self.state = QUEUED
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        self.__lines: List[str] = []
+        self.__changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.state in (SUCCEEDED, FAILED)
+
+    def log(self, line: str):
+        with self.__changed:
+            self.__lines.append(line)
+            self.__changed.notify_all()
+
+    def update(self, state: str, result: Dict[str, Any] = None, error: str = None):
+        with self.__changed:
+            self.state = state
+            self.result = result
+            self.error = error
+            if self.done:
+                self.finished_at = time.time()
+            self.__changed.notify_all()
+
+    def follow(self) -> Iterator[str]:
+        """
+        the log lines written so far and the ones that follow, until the job is done
+        """
+        n = 0
+        while True:
+            with self.__changed:
+                while n == len(self.__lines) and not self.done:
+                    self.__changed.wait()
+                lines = self.__lines[n:]
+                done = self.done
+            n += len(lines)
+            yield from lines
+            if done and n == len(self.__lines):
+                return
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "type": self.request["type"],
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class _JobLogHandler(logging.Handler):
+    def __init__(self, job: Job):
+        super(_JobLogHandler, self).__init__()
+        self.__job = job
+        self.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%H:%M:%S"))
+
+    def emit(self, record: logging.LogRecord):
+        self.__job.log(self.format(record))
+
+
+def _resolve_paths(
+    params: Dict[str, Any], cwd: Optional[str], roots: Optional[List[Path]]
+) -> Dict[str, Any]:
+    resolved = {}
+    for k, v in params.items():
+        if k in _PATH_PARAMS and v is not None:
+            if not isinstance(v, str):
+                raise JobError(f"{k} must be a path")
+            v = str(Path(cwd or ".") / v)
+            path = Path(v).resolve()
+            if roots is not None and not any(
+                path == root or root in path.parents for root in roots
+            ):
+                raise JobError(f"{k} {v} is outside the directories this server serves")
+        resolved[k] = v
+    return resolved
+
+
+def _check_params(fn: Callable, params: Dict[str, Any], positional: int = 0):
+    try:
+        inspect.signature(fn).bind(*[None] * positional, **{**params, "logger": None})
+    except TypeError as e:
+        raise JobError(f"invalid parameters for {fn.__name__}: {e}")
+
+
+def normalize_request(
+    request: Dict[str, Any], roots: List[Path] = None
+) -> Dict[str, Any]:
+    """
+    validate a job request and resolve its relative paths
+    :param request: {"type": "python", "build": {...}, "publish": {...}, "cwd": "..."}.
+        build holds the parameters of the build function of the type, publish those of
+        api.publish, and is left out to only build.
+    :param roots: The resolved directories host paths must be in, None allows any.
+    :raises JobError: When the request is invalid.
+    """
+    if not isinstance(request, dict):
+        raise JobError("a job must be a JSON object")
+    job_type = request.get("type")
+    if job_type not in BUILD_FUNCTIONS:
+        raise JobError(f"type must be one of {', '.join(BUILD_FUNCTIONS)}")
+    build = request.get("build") or {}
+    publish_params = request.get("publish")
+    if not isinstance(build, dict) or not isinstance(
+        publish_params, (dict, type(None))
+    ):
+        raise JobError("build and publish must be JSON objects")
+    if "logger" in build or (publish_params and "logger" in publish_params):
+        raise JobError("logger cannot be set by a job")
+
+    cwd = request.get("cwd")
+    if not isinstance(cwd, (str, type(None))):
+        raise JobError("cwd must be a path")
+    build = _resolve_paths({"output": "layer", **build}, cwd, roots)
+    _check_params(BUILD_FUNCTIONS[job_type], build)
+    if publish_params is not None:
+        publish_params = _resolve_paths(publish_params, cwd, roots)
+        _check_params(publish, publish_params, positional=1)
+    return {"type": job_type, "build": build, "publish": publish_params}
+
+
+class JobQueue:
+    """
+    runs jobs with a limited number of concurrent builds and publishes.
+    Identical requests that are queued or running share one job.
+    """
+
+    def __init__(
+        self, max_builds: int = 2, max_publishes: int = 4, roots: List[str] = None
+    ):
+        """
+        :param roots: Directories the host paths of jobs must be in, e.g. their outputs
+            and ccache dirs. None allows any path.
+        """
+        self.__roots = [Path(r).resolve() for r in roots] if roots is not None else None
+        self.__build_slots = threading.BoundedSemaphore(max_builds)
+        self.__publish_slots = threading.BoundedSemaphore(max_publishes)
+        self.__jobs: Dict[str, Job] = {}
+        self.__in_flight: Dict[str, Job] = {}
+        self.__lock = threading.Lock()
+
+    def submit(self, request: Dict[str, Any]) -> Tuple[Job, bool]:
+        """
+        queue a job
+        :return: The job and whether an identical job was already in flight.
+        :raises JobError: When the request is invalid.
+        """
+        request = normalize_request(request, self.__roots)
+        key = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+        with self.__lock:
+            self.__forget_finished()
+            job = self.__in_flight.get(key)
+            if job:
+                return job, True
+            job = Job(key, request)
+            self.__jobs[job.id] = job
+            self.__in_flight[key] = job
+        threading.Thread(
+            target=self.__run, args=(job,), name=f"layermake-job-{job.id}", daemon=True
+        ).start()
+        return job, False
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def jobs(self) -> List[Job]:
+        with self.__lock:
+            return list(self.__jobs.values())
+
+    def __forget_finished(self):
+        expired = time.time() - _JOB_TTL
+        for job_id, job in list(self.__jobs.items()):
+            if job.done and job.finished_at < expired:
+                del self.__jobs[job_id]
+
+    def __run(self, job: Job):
+        log = logging.Logger(f"layermake.job.{job.id}", logging.INFO)
+        log.addHandler(_JobLogHandler(job))
+        adapter = LoggingAdapter(log)
+        request = job.request
+        try:
+            # jobs with the same output dir take turns, the layer of one must not
+            # replace the layer of another before it is published
+            with output_lock(Path(request["build"]["output"])):
+                with self.__build_slots:
+                    job.update(RUNNING)
+                    build = BUILD_FUNCTIONS[request["type"]](
+                        **request["build"], logger=adapter
+                    )
+                result: Dict[str, Any] = {
+                    "paths": [str(p) for p in build.paths],
+                    "runtimes": build.runtimes,
+                }
+                if request["publish"] is not None:
+                    with self.__publish_slots:
+                        job.update(PUBLISHING)
+                        layers = publish(build, **request["publish"], logger=adapter)
+                    result["layers"] = [layer._asdict() for layer in layers]
+            job.update(SUCCEEDED, result=result)
+        except Exception as e:
+            # the error is in the result, fatal errors are in the log already
+            job.update(FAILED, error=str(e))
+        finally:
+            with self.__lock:
+                self.__in_flight.pop(job.key, None)
+        logger().info(f"job {job.id} {job.state}")
+
+
+def warm_image(name: str) -> str:
+    """
+    pull a build image so that the first job using it does not wait for it
+    :param name: A runtime such as python3.12 or nodejs20.x, or an image name.
+    """
+    if name.startswith("python") and "/" not in name:
+        name = PYTHON_ECR_TEMPLATE.substitute(
+            runtime=name.replace("python", ""), version="latest"
+        )
+    elif name.startswith("nodejs") and "/" not in name:
+        name = NODE_ECR_TEMPLATE.substitute(
+            runtime=name.replace("nodejs", ""), version="latest"
+        )
+    with logger().status(f"warming {name}..."):
+        image_id = docker_image_id(name)
+        logger().success(f"{name} is ready ({image_id})")
+    return name
+
+
+def token_path(host: str, port: int) -> Path:
+    """
+    where the server listening on host and port keeps its token for local clients
+    """
+    return cache_dir() / "server" / f"{host}-{port}.token"
+
+
+def _write_token(path: Path, token: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # readable by the user only, like the unix socket
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    queue: JobQueue = None
+    # required as a bearer token when set
+    token: Optional[str] = None
+
+    def address_string(self) -> str:
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format: str, *args):
+        logger().debug(f"{self.address_string()} {format % args}")
+
+    def __send_json(self, status: int, value: Any):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __reject(self, status: int, error: str):
+        # the body of the request may not have been read
+        self.close_connection = True
+        self.__send_json(status, {"error": error})
+
+    def __authorized(self) -> bool:
+        """
+        reject requests of web pages and of clients without the server's token
+        """
+        # browsers send an Origin with cross-origin requests, layermake clients never do
+        if self.headers.get("Origin"):
+            self.__reject(403, "cross-origin requests are not allowed")
+            return False
+        if self.token and not secrets.compare_digest(
+            self.headers.get("Authorization", ""), f"Bearer {self.token}"
+        ):
+            self.__reject(401, "missing or invalid token")
+            return False
+        return True
+
+    def __job(self, job_id: str) -> Optional[Job]:
+        job = self.queue.get(job_id)
+        if not job:
+            self.__send_json(404, {"error": f"no job {job_id}"})
+        return job
+
+    def do_POST(self):
+        if not self.__authorized():
+            return
+        if urlparse(self.path).path != "/jobs":
+            return self.__reject(404, f"no route {self.path}")
+        # a web page cannot send application/json without a CORS preflight
+        if self.headers.get_content_type() != "application/json":
+            return self.__reject(415, "jobs must be sent as application/json")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            job, deduplicated = self.queue.submit(json.loads(self.rfile.read(length)))
+        except (ValueError, JobError) as e:
+            return self.__send_json(400, {"error": str(e)})
+        self.__send_json(202, {"job": job.to_dict(), "deduplicated": deduplicated})
+
+    def do_GET(self):
+        if not self.__authorized():
+            return
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts == ["jobs"]:
+            return self.__send_json(200, [j.to_dict() for j in self.queue.jobs()])
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self.__job(parts[1])
+            return job and self.__send_json(200, job.to_dict())
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "logs":
+            job = self.__job(parts[1])
+            return job and self.__stream_logs(job)
+        self.__send_json(404, {"error": f"no route {self.path}"})
+
+    def __stream_logs(self, job: Job):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for line in job.follow():
+                chunk = (line + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            logger().debug(f"client stopped following the log of job {job.id}")
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(
+    queue: JobQueue,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    socket_path: str = None,
+    token: str = None,
+):
+    """
+    serve the job API until interrupted
+    :param queue: Runs the submitted jobs.
+    :param socket_path: Listen on this unix socket instead of host and port. Only the
+        user running the server can connect to it.
+    :param token: The bearer token clients must send. Generated when listening on a
+        port and written to token_path for local clients.
+    """
+    token_file = None
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        umask = os.umask(0o177)
+        try:
+            server = _UnixHTTPServer(
+                socket_path,
+                type("Handler", (_Handler,), {"queue": queue, "token": token}),
+            )
+        finally:
+            os.umask(umask)
+        address = socket_path
+    else:
+        token = token or secrets.token_urlsafe(32)
+        server = ThreadingHTTPServer(
+            (host, port),
+            type("Handler", (_Handler,), {"queue": queue, "token": token}),
+        )
+        address = f"http://{host}:{server.server_port}"
+        token_file = token_path(host, server.server_port)
+        _write_token(token_file, token)
+        logger().info(f"clients authenticate with the token in {token_file}")
+    logger().success(f"layermake is serving on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger().info("shutting down")
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+        if token_file:
+            token_file.unlink(missing_ok=True)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None):
+        super(_UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.__socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.__socket_path)
+
+
+class Client:
+    """
+    submits jobs to a layermake server and follows them
+    """
+
+    def __init__(self, url: str = None, socket_path: str = None, token: str = None):
+        """
+        :param url: The server URL, defaults to http://127.0.0.1:8677.
+        :param socket_path: Connect to this unix socket instead.
+        :param token: The server's token, defaults to the one a local server wrote.
+        """
+        self.__socket_path = socket_path
+        self.__url = urlparse(url or f"http://{DEFAULT_HOST}:{DEFAULT_PORT}")
+        if not token and not socket_path:
+            local_token = token_path(self.__url.hostname, self.__url.port or 80)
+            if local_token.is_file():
+                token = local_token.read_text().strip()
+        self.__headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+    def __connect(self) -> http.client.HTTPConnection:
+        if self.__socket_path:
+            return _UnixHTTPConnection(self.__socket_path)
+        return http.client.HTTPConnection(self.__url.hostname, self.__url.port or 80)
+
+    def __request(self, method: str, path: str, body: Any = None) -> Any:
+        conn = self.__connect()
+        try:
+            data = json.dumps(body).encode() if body is not None else None
+            conn.request(
+                method,
+                path,
+                body=data,
+                headers={"Content-Type": "application/json", **self.__headers},
+            )
+            response = conn.getresponse()
+            value = json.loads(response.read() or b"null")
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise JobError(value.get("error") if isinstance(value, dict) else value)
+        return value
+
+    def submit(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        :return: {"job": ..., "deduplicated": ...}
+        """
+        return self.__request("POST", "/jobs", request)
+
+    def job(self, job_id: str) -> Dict[str, Any]:
+        return self.__request("GET", f"/jobs/{job_id}")
+
+    def follow(self, job_id: str) -> Iterator[str]:
+        """
+        the log lines of a job until it is done
+        """
+        conn = self.__connect()
+        try:
+            conn.request("GET", f"/jobs/{job_id}/logs", headers=self.__headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise JobError(f"cannot follow job {job_id}: {response.status}")
+            for line in response:
+                yield line.decode().rstrip("\n")
+        finally:
+            conn.close()
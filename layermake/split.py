@@ -0,0 +1,71 @@
+from typing import List, Optional
+from .distributions import LayerItem
+from .logger import logger
+
+# maximum number of layers a single function can attach
+MAX_LAYERS = 5
+
+# the unzipped size limit lambda enforces for a layer, and for a function together with
+# all of its layers
+MAX_LAYER_SIZE_MB = 250
+
+# the zipped size limit of a layer uploaded directly instead of staged in S3
+MAX_DIRECT_UPLOAD_MB = 50
+
+_MB = 1024 * 1024
+
+
+def format_size(size: int) -> str:
+    return f"{size / _MB:.1f} MB"
+
+
+def pack_layers(
+    items: List[LayerItem],
+    max_part_size: int,
+    max_total_size: Optional[int] = None,
+    max_parts: int = MAX_LAYERS,
+) -> List[List[LayerItem]]:
+    """
+    Bin-pack items into as few parts as possible using first-fit decreasing.
+    :param items: The distributions or modules to pack.
+    :param max_part_size: The unzipped size budget of a single part in bytes.
+    :param max_total_size: The combined unzipped size limit of all parts in bytes.
+    :param max_parts: The maximum number of parts that may be produced.
+    """
+    total = sum(i.size for i in items)
+    if max_total_size and total > max_total_size:
+        logger().fatal_error(
+            f"layer content is {format_size(total)} which exceeds the combined "
+            f"limit of {format_size(max_total_size)}"
+        )
+
+    parts: List[List[LayerItem]] = []
+    part_sizes: List[int] = []
+    for item in sorted(items, key=lambda i: i.size, reverse=True):
+        if item.size > max_part_size:
+            logger().fatal_error(
+                f"{item.name} is {format_size(item.size)} which does not fit in a "
+                f"single layer of {format_size(max_part_size)}"
+            )
+        for n, size in enumerate(part_sizes):
+            if size + item.size <= max_part_size:
+                parts[n].append(item)
+                part_sizes[n] += item.size
+                break
+        else:
+            parts.append([item])
+            part_sizes.append(item.size)
+
+    if len(parts) > max_parts:
+        logger().fatal_error(
+            f"layer content is {format_size(total)} and needs {len(parts)} layers "
+            f"of {format_size(max_part_size)} but at most {max_parts} can be attached"
+        )
+
+    for n, part in enumerate(parts):
+        logger().info(
+            f"layer part {n + 1}: {format_size(part_sizes[n])} "
+            f"({', '.join(i.name for i in part)})"
+        )
+
+    return parts
@@ -0,0 +1,138 @@
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from pathlib import Path
+import time
+import os
+from .bundler import Bundler
+from .logger import logger
+
+# directories that never affect the layer
+_IGNORED_DIRS = {".git", "__pycache__", ".mypy_cache", ".pytest_cache", "node_modules"}
+
+# files that change what gets installed and need a full rebuild, per layer type
+PYTHON_INSTALL_FILES = {"requirements.txt", "setup.py", "setup.cfg", "pyproject.toml"}
+NODE_INSTALL_FILES = {"package.json", "package-lock.json"}
+
+Snapshot = Dict[Path, Tuple[int, int]]
+
+
+def _snapshot(paths: List[Path]) -> Snapshot:
+    snap = {}
+    for path in paths:
+        if path.is_file():
+            st = path.stat()
+            snap[path] = (st.st_mtime_ns, st.st_size)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [d for d in dirs if d not in _IGNORED_DIRS]
+            for n in names:
+                if n.endswith(".pyc"):
+                    continue
+                p = Path(root) / n
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                snap[p] = (st.st_mtime_ns, st.st_size)
+    return snap
+
+
+class Watcher:
+    """
+    polls files and directory trees for changes
+    """
+
+    def __init__(self, paths: List[Path], interval: float = 0.5, debounce: float = 1.0):
+        """
+        :param paths: The files and directories to watch.
+        :param interval: Seconds between polls.
+        :param debounce: Seconds without further changes before a batch of changes is reported.
+        """
+        self.__paths = paths
+        self.__interval = interval
+        self.__debounce = debounce
+        self.__snapshot = _snapshot(paths)
+
+    def changes(self) -> Iterator[Set[Path]]:
+        """
+        yield the set of changed, added and removed files after every debounced batch of changes
+        """
+        pending: Set[Path] = set()
+        last_change = 0.0
+        while True:
+            time.sleep(self.__interval)
+            snap = _snapshot(self.__paths)
+            changed = {
+                p
+                for p in snap.keys() | self.__snapshot.keys()
+                if snap.get(p) != self.__snapshot.get(p)
+            }
+            self.__snapshot = snap
+            if changed:
+                pending |= changed
+                last_change = time.monotonic()
+            elif pending and time.monotonic() - last_change >= self.__debounce:
+                yield pending
+                pending = set()
+
+
+def watch(
+    bundler_factory: Callable[[], Bundler],
+    artifact_dir: Optional[Path],
+    manifest: Optional[Path],
+    install_files: Set[str],
+    on_layer: Callable[[Path], None],
+    no_zip: bool = False,
+):
+    """
+    build a layer and rebuild it whenever the artifact dir or manifest changes until interrupted.
+    Source changes are synced into the staged tree, only changes to the manifest or
+    install files re-run the install step.
+    :param bundler_factory: Creates a new bundler for a full build.
+    :param artifact_dir: The --dir tree to watch.
+    :param manifest: The manifest file to watch.
+    :param install_files: Names of files in the artifact dir that need a full rebuild.
+    :param on_layer: Called with the layer zip after every build, e.g. to publish it.
+    :param no_zip: Only keep the staged tree up to date.
+    """
+    watched = [p for p in [artifact_dir, manifest] if p]
+    if not watched:
+        logger().fatal_error("--watch needs --dir or --manifest")
+
+    def rebuild(bundler: Bundler):
+        if not no_zip:
+            with bundler.holding_output():
+                on_layer(bundler.zip_tree())
+
+    bundler = bundler_factory()
+    try:
+        bundler.build_tree()
+        rebuild(bundler)
+        watcher = Watcher(watched)
+        logger().info(f"watching {', '.join(str(p) for p in watched)} for changes...")
+        for changed in watcher.changes():
+            reinstall = any(
+                (manifest and p == manifest)
+                or (
+                    artifact_dir
+                    and p.parent == artifact_dir
+                    and p.name in install_files
+                )
+                for p in changed
+            )
+            if reinstall:
+                logger().info("install files changed, rebuilding layer")
+                bundler.discard_tree()
+                bundler = bundler_factory()
+                bundler.build_tree()
+            else:
+                with logger().status(f"syncing {len(changed)} changed files..."):
+                    bundler.sync_sources(
+                        artifact_dir, {p.relative_to(artifact_dir) for p in changed}
+                    )
+                    logger().success(f"synced {len(changed)} changed files")
+            rebuild(bundler)
+            logger().info("waiting for changes...")
+    except KeyboardInterrupt:
+        logger().info("stopped watching")
+    finally:
+        bundler.discard_tree(keep_tree=no_zip)